@@ -0,0 +1,7 @@
+"""Benchmarks for FORTRESS.
+
+They are not part of the installed package. Run them from the root of the
+repository, e.g.:
+
+  python -m benchmarks.complexity
+"""
@@ -0,0 +1,225 @@
+"""Complexity checks of the hot paths on pathological inputs.
+
+For every case an adversarial input is generated at doubling sizes and the
+runtime of the routine under test is measured. The growth exponent is the
+slope of the runtimes over the sizes on a log-log scale: 1 means linear,
+2 quadratic. A case fails if its exponent exceeds the threshold, which
+catches changes that add super-linear behavior.
+
+Usage:
+
+  python -m benchmarks.complexity [-k PATTERN] [--threshold EXP]
+
+Returns non-zero if any case grows faster than allowed.
+"""
+import argparse
+import fnmatch
+import math
+import sys
+import timeit
+
+from fortress.lib import fortress_api
+from fortress.lib import fortress_style
+from fortress.lib import unwrapped_line
+
+# Sizes are multiplied by these factors.
+SCALES = [1, 2, 4, 8]
+
+# Maximum allowed growth exponent.
+DEFAULT_THRESHOLD = 1.4
+
+
+def _TokenizedLine(line, isFreeForm=True):
+  cLine = unwrapped_line.UnwrappedLine(line, isFreeForm)
+  cLine.tokenize()
+  return cLine
+
+
+def _LongLine(n):
+  """A long assignment without any strings."""
+  return "x = " + " + ".join("a%d" % i for i in range(n))
+
+
+def _TabLine(n):
+  """A line with tabs between all tokens."""
+  return "\t".join("a%d" % (i % 10) for i in range(n))
+
+
+def _QuoteLine(n):
+  """A DATA statement full of strings with quotes and '!' inside."""
+  return "data names /" + ", ".join("'it''s ! %d'" % i for i in range(n)) \
+         + "/" + " " * n + "x"
+
+
+def _UnterminatedQuoteLine(n):
+  """A line with a string which is never terminated."""
+  return "call foo(" + "\"a\\\"" * n + " ! not a comment"
+
+
+def _SpaceLine(n):
+  """Many whitespace runs, which trigger backtracking in lazy patterns."""
+  return "x" + " " * n + "y" + " " * n + "&"
+
+
+def _WhereLine(n):
+  """A 'where' statement with deeply nested brackets."""
+  return "where (" + "(" * n + "a" + ")" * n + " > 0)"
+
+
+def _ContinuationChain(n):
+  """A statement continued over many lines."""
+  lines = ["      call foo(a0, &"]
+  lines.extend("        & a%d, &" % i for i in range(1, n))
+  lines.append("        & b)")
+  return "\n".join(lines) + "\n"
+
+
+def _FixedContinuationChain(n):
+  """A fixed-form statement continued over many lines."""
+  lines = ["      call foo(a0,"]
+  lines.extend("     &  a%d," % i for i in range(1, n))
+  lines.append("     &  b)")
+  return "\n".join(lines) + "\n"
+
+
+def _ReplaceTabs(n):
+  line = _TabLine(n)
+  def run():
+    unwrapped_line.UnwrappedLine(line, True).replaceTabsBySpaces(4)
+  return run
+
+
+def _Tokenize(generator, isFreeForm=True):
+  def setup(n):
+    line = generator(n)
+    def run():
+      unwrapped_line.UnwrappedLine(line, isFreeForm).tokenize()
+    return run
+  return setup
+
+
+def _AddSpacesInCode(n):
+  line = "if(" + ")then ".join("'s%d' // endif(x" % i for i in range(n)) \
+         + ")then"
+  def run():
+    _TokenizedLine(line).addSpacesInCode()
+  return run
+
+
+def _ReplaceStrings(n):
+  cLine = _TokenizedLine("")
+  string = _UnterminatedQuoteLine(n)
+  def run():
+    cLine.replaceStrings(string)
+  return run
+
+
+def _IdentifyWhere(n):
+  cLine = _TokenizedLine(_WhereLine(n))
+  def run():
+    cLine.identifyIndentation([])
+  return run
+
+
+def _FormatCode(generator, style):
+  def setup(n):
+    source = generator(n)
+    def run():
+      fortress_style.SetGlobalStyle(style())
+      fortress_api.FormatCode(source)
+    return run
+  return setup
+
+
+# (name, setup, base size): setup(n) returns the function to time.
+CASES = [
+  ('replaceTabsBySpaces/many-tabs', _ReplaceTabs, 4000),
+  ('tokenize/long-line', _Tokenize(_LongLine), 2000),
+  ('tokenize/quote-heavy', _Tokenize(_QuoteLine), 1000),
+  ('tokenize/unterminated-quotes', _Tokenize(_UnterminatedQuoteLine), 2000),
+  ('tokenize/whitespace-runs', _Tokenize(_SpaceLine), 4000),
+  ('tokenize/fixed-form-long-line', _Tokenize(_LongLine, False), 2000),
+  ('addSpacesInCode/keyword-heavy', _AddSpacesInCode, 500),
+  ('replaceStrings/escaped-quotes', _ReplaceStrings, 2000),
+  ('identifyIndentation/deep-where', _IdentifyWhere, 2000),
+  ('FormatCode/continuation-chain',
+   _FormatCode(_ContinuationChain, fortress_style.CreateStrictStyle), 250),
+  ('FormatCode/fixed-continuation-chain',
+   _FormatCode(_FixedContinuationChain,
+               lambda: dict(fortress_style.CreateStrictStyle(),
+                            CONVERT_FIXED_TO_FREE=True)), 250),
+]
+
+
+def MeasureGrowth(setup, base, scales=SCALES, repeat=5):
+  """Measure the runtimes of a case at increasing sizes.
+
+  Arguments:
+    setup  : (function) Returns the function to time for a given size.
+    base   : (int) The smallest size.
+    scales : (list of int) Factors the base size is multiplied with.
+    repeat : (int) Number of measurements per size, the minimum is taken.
+
+  Returns:
+    Tuple of (exponent, timings), timings is a list of (size, seconds).
+  """
+  timings = []
+  for scale in scales:
+    size = base * scale
+    run = setup(size)
+    # calibrate the number of calls so each measurement takes a few ms
+    number = 1
+    while number < 1000 and timeit.timeit(run, number=number) < 0.005:
+      number *= 2
+    seconds = min(timeit.repeat(run, number=number, repeat=repeat)) / number
+    timings.append((size, seconds))
+  return _GrowthExponent(timings), timings
+
+
+def _GrowthExponent(timings):
+  """Least-squares slope of log(seconds) over log(size)."""
+  xs = [math.log(size) for size, _ in timings]
+  ys = [math.log(max(seconds, 1e-9)) for _, seconds in timings]
+  meanX = sum(xs) / len(xs)
+  meanY = sum(ys) / len(ys)
+  return sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys)) \
+         / sum((x - meanX) ** 2 for x in xs)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+      description='Check that the hot paths of FORTRESS scale linearly.')
+  parser.add_argument('-k',
+                      metavar='PATTERN',
+                      action='append',
+                      default=None,
+                      help='only run cases matching the pattern')
+  parser.add_argument('--threshold',
+                      type=float,
+                      default=DEFAULT_THRESHOLD,
+                      help='maximum allowed growth exponent (default: %(default)s)')
+  args = parser.parse_args(argv[1:])
+
+  fortress_style.SetGlobalStyle(fortress_style.CreateStrictStyle())
+
+  failed = []
+  for name, setup, base in CASES:
+    if args.k and not any(fnmatch.fnmatch(name, '*%s*' % p) for p in args.k):
+      continue
+    exponent, timings = MeasureGrowth(setup, base)
+    status = 'ok' if exponent <= args.threshold else 'FAIL'
+    print('{:<40} {:>6.2f}  {:<4}  {}'.format(
+        name, exponent, status,
+        ' '.join('{}:{:.2e}s'.format(size, seconds)
+                 for size, seconds in timings)))
+    if status != 'ok':
+      failed.append(name)
+
+  if failed:
+    print('super-linear growth in: ' + ', '.join(failed))
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
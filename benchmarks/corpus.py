@@ -0,0 +1,279 @@
+"""Deterministic generator of synthetic Fortran sources.
+
+The generated code resembles real legacy code: subroutines and functions in
+a module or as external units, declarations, nested DO/IF/SELECT blocks,
+labels, continuation lines, comments, preprocessor directives and tabs. The
+same size and seed always give the same source.
+
+Usage:
+
+  python -m benchmarks.corpus OUTDIR [--lines N] [--seed S]
+
+writes 'fixed.f' and 'free.f90' of about N lines each into OUTDIR.
+"""
+import argparse
+import os
+import random
+import sys
+
+# Source forms
+FIXED = 'fixed'
+FREE = 'free'
+
+_TYPES = ['integer', 'real*8', 'double precision', 'logical', 'character*16']
+_OPERATORS = ['+', '-', '*', '/']
+_RELATIONS = ['.eq.', '.ne.', '.lt.', '.gt.', '.le.', '.ge.']
+
+
+class _Writer(object):
+  """Collects lines in fixed or free form."""
+
+  def __init__(self, form, rng):
+    self.form = form
+    self.rng = rng
+    self.lines = []
+    self.depth = 0
+    self.nextLabel = 10
+
+  def comment(self, text):
+    if self.form == FIXED:
+      self.lines.append(self.rng.choice(['c', 'C', '*']) + '     ' + text)
+    else:
+      self.lines.append('  ' * self.depth + '! ' + text)
+
+  def preproc(self, text):
+    self.lines.append(self.rng.choice(['#', '#  ']) + text)
+
+  def blank(self):
+    self.lines.append('')
+
+  def label(self):
+    self.nextLabel += 10
+    return self.nextLabel
+
+  def statement(self, code, label=None, trailing=None):
+    """Adds a statement, continued over several lines if it is long."""
+    pieces = _Split(code)
+    indent = '  ' * self.depth
+    if self.form == FIXED:
+      prefix = ('%-5d ' % label) if label else '      '
+      # now and then, indent with a tab instead of spaces
+      if not label and self.rng.random() < 0.05:
+        prefix = '\t'
+      lines = [prefix + indent + pieces[0]]
+      lines.extend('     ' + self.rng.choice('&+1$') + indent + '   ' + piece
+                   for piece in pieces[1:])
+    else:
+      prefix = ('%d ' % label) if label else ''
+      lines = [indent + prefix + pieces[0]]
+      lines.extend(indent + '    ' + self.rng.choice(['& ', '']) + piece
+                   for piece in pieces[1:])
+      lines = [line + ' &' for line in lines[:-1]] + lines[-1:]
+      if self.rng.random() < 0.05:
+        lines = [line.replace('  ', '\t', 1) for line in lines]
+    if trailing:
+      lines[-1] += '   ' + ('! ' + trailing if self.form == FREE else '')
+    # some trailing whitespace
+    if self.rng.random() < 0.1:
+      lines[-1] += ' ' * self.rng.randint(1, 3)
+    self.lines.extend(lines)
+
+
+def _Split(code):
+  """Splits long code at commas outside of strings into continuation pieces."""
+  if len(code) < 50:
+    return [code]
+  items = []
+  start = 0
+  quote = None
+  for pos, c in enumerate(code):
+    if quote:
+      if c == quote:
+        quote = None
+    elif c in '"\'':
+      quote = c
+    elif c == ',':
+      items.append(code[start:pos])
+      start = pos + 1
+  items.append(code[start:])
+
+  pieces = []
+  current = ''
+  for item in items:
+    if current and len(current) + len(item) > 40:
+      pieces.append(current + ',')
+      current = item.lstrip()
+    else:
+      current = current + ',' + item if current else item
+  pieces.append(current)
+  return pieces
+
+
+def _Name(rng, prefix='v'):
+  return '%s%d' % (prefix, rng.randint(0, 99))
+
+
+def _Expression(rng, terms=None):
+  terms = terms or rng.randint(1, 6)
+  expr = _Name(rng)
+  for _ in range(terms - 1):
+    operand = rng.choice([_Name(rng), str(rng.randint(1, 9)),
+                          '%d.%de-%d' % (rng.randint(1, 9), rng.randint(0, 9),
+                                         rng.randint(1, 9)),
+                          '%s(%s)' % (_Name(rng, 'a'), _Name(rng, 'i'))])
+    expr += rng.choice(_OPERATORS) + operand
+  return expr
+
+
+def _Condition(rng):
+  return '%s%s%s' % (_Name(rng), rng.choice(_RELATIONS), _Expression(rng, 2))
+
+
+def _Block(writer, depth):
+  """Writes a random statement, possibly a nested block."""
+  rng = writer.rng
+  kind = rng.random()
+  if depth < 4 and kind < 0.12:
+    label = writer.label() if writer.form == FIXED and rng.random() < 0.5 \
+        else None
+    if label:
+      writer.statement('do %d %s=1,%s' % (label, _Name(rng, 'i'), _Name(rng, 'n')))
+    else:
+      writer.statement('do %s=1,%s' % (_Name(rng, 'i'), _Name(rng, 'n')))
+    _Body(writer, depth + 1)
+    if label:
+      writer.statement('continue', label=label)
+    else:
+      writer.statement(rng.choice(['enddo', 'end do']))
+  elif depth < 4 and kind < 0.22:
+    writer.statement(rng.choice(['if(%s)then', 'if (%s) then']) % _Condition(rng))
+    _Body(writer, depth + 1)
+    if rng.random() < 0.4:
+      writer.statement(rng.choice(['else', 'elseif(%s)then' % _Condition(rng)]))
+      _Body(writer, depth + 1)
+    writer.statement(rng.choice(['endif', 'end if']))
+  elif depth < 4 and kind < 0.25:
+    writer.statement('select case (%s)' % _Name(rng))
+    for value in range(rng.randint(1, 3)):
+      writer.statement('case (%d)' % value)
+      _Body(writer, depth + 1)
+    writer.statement('end select')
+  elif kind < 0.30:
+    writer.comment(rng.choice(['compute the update', 'TODO: check bounds',
+                               'this is a "quoted" remark', 'apply ! marks']))
+  elif kind < 0.32:
+    writer.preproc('ifdef DEBUG')
+    writer.statement("write(*,*) 'debug: %s = ', %s" % ((_Name(rng),) * 2))
+    writer.preproc('endif')
+  elif kind < 0.40:
+    args = ', '.join(_Expression(rng, 2) for _ in range(rng.randint(2, 8)))
+    writer.statement('call %s(%s)' % (_Name(rng, 'sub'), args))
+  elif kind < 0.45:
+    writer.statement("write(*,'(a,i5)') 'it''s %s ! not a comment', %s"
+                     % ((_Name(rng),) * 2), trailing='print progress')
+  elif kind < 0.47 and writer.form == FIXED:
+    label = writer.label()
+    writer.statement('goto %d' % label)
+    writer.statement('continue', label=label)
+  else:
+    writer.statement('%s = %s' % (_Name(rng), _Expression(rng)),
+                     trailing=rng.choice([None, None, None, 'update']))
+
+
+def _Body(writer, depth):
+  writer.depth += 1
+  for _ in range(writer.rng.randint(1, 5)):
+    _Block(writer, depth)
+  writer.depth -= 1
+
+
+def _Unit(writer, index):
+  """Writes a subroutine or function."""
+  rng = writer.rng
+  name = 'unit%d' % index
+  args = ', '.join(_Name(rng, 'x') for _ in range(rng.randint(1, 6)))
+  isFunction = rng.random() < 0.3
+  if isFunction:
+    writer.statement('%s function %s(%s)' % (rng.choice(['real*8', 'integer']),
+                                             name, args))
+  else:
+    writer.statement('subroutine %s(%s)' % (name, args))
+  writer.depth += 1
+  writer.statement('implicit none')
+  for _ in range(rng.randint(2, 6)):
+    writer.statement('%s %s' % (rng.choice(_TYPES), ', '.join(
+        _Name(rng) for _ in range(rng.randint(1, 12)))))
+  if rng.random() < 0.3:
+    writer.statement('common /blk%d/ %s, %s' % (index % 7, _Name(rng),
+                                                _Name(rng)))
+  writer.depth -= 1
+  _Body(writer, 0)
+  writer.depth += 1
+  writer.statement('return')
+  writer.depth -= 1
+  writer.statement(('end function %s' if isFunction else 'end subroutine %s')
+                   % name)
+  writer.blank()
+
+
+def Generate(form, lines, seed=0):
+  """Generate Fortran source of roughly the given number of lines.
+
+  Arguments:
+    form  : (str) FIXED or FREE.
+    lines : (int) Number of lines to generate, at least.
+    seed  : (int) Seed of the random generator.
+
+  Returns:
+    The source as a unicode string ending with a newline.
+  """
+  rng = random.Random('%s-%d' % (form, seed))
+  writer = _Writer(form, rng)
+  writer.comment('generated by benchmarks.corpus (seed %d)' % seed)
+  writer.preproc('include "config.h"')
+  index = 0
+  while len(writer.lines) < lines:
+    if form == FREE and index % 20 == 0:
+      if index:
+        writer.statement('end module mod%d' % (index // 20 - 1))
+      writer.statement('module mod%d' % (index // 20))
+      writer.statement('contains')
+    _Unit(writer, index)
+    index += 1
+  if form == FREE:
+    writer.statement('end module mod%d' % ((index - 1) // 20))
+  return '\n'.join(writer.lines) + '\n'
+
+
+def WriteCorpus(directory, lines, seed=0):
+  """Write a fixed-form and a free-form file into directory.
+
+  Returns:
+    Dict mapping the form to the written filename.
+  """
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  filenames = {}
+  for form, extension in [(FIXED, '.f'), (FREE, '.f90')]:
+    filenames[form] = os.path.join(directory, form + extension)
+    with open(filenames[form], 'w') as fd:
+      fd.write(Generate(form, lines, seed))
+  return filenames
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+      description='Generate a synthetic Fortran corpus.')
+  parser.add_argument('directory')
+  parser.add_argument('--lines', type=int, default=10000,
+                      help='lines per file (default: %(default)s)')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args(argv[1:])
+  for form, filename in sorted(WriteCorpus(args.directory, args.lines,
+                                           args.seed).items()):
+    print('%s: %s' % (form, filename))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,239 @@
+"""End-to-end throughput benchmarks.
+
+Times fortress_api.FormatCode, fortress_api.FormatFile and the command line
+on generated sources (see benchmarks.corpus) of both forms under the strict
+and the Fortran2003 style. For every combination the throughput in lines per
+second and the peak memory are recorded.
+
+Results can be saved as a JSON baseline and compared against a baseline of an
+earlier run:
+
+  python -m benchmarks.throughput --save before.json
+  ... change something ...
+  python -m benchmarks.throughput --compare before.json
+
+Returns non-zero if the throughput of any benchmark dropped by more than the
+tolerance compared to the baseline.
+
+Huge files are split over several processes (see parallel_reformatter), to
+measure this use e.g.:
+
+  python -m benchmarks.throughput --lines 400000 --jobs 4
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fortress
+from fortress.lib import fortress_api
+from fortress.lib import fortress_style
+
+from benchmarks import corpus
+
+# Name of the style -> (style factory, command line arguments)
+STYLES = {
+  'strict': (fortress_style.CreateStrictStyle, ['--strict']),
+  'fortran2003': (fortress_style.CreateFortran2003Style, []),
+}
+
+FORMS = [(corpus.FIXED, '.f'), (corpus.FREE, '.f90')]
+
+TARGETS = ['FormatCode', 'FormatFile', 'cli']
+
+# Root of the repository, so the command line uses this checkout.
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _Best(run, repeat):
+  """Returns the minimal wall time of repeat calls of run."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    best = seconds if best is None else min(best, seconds)
+  return best
+
+
+def _PeakMemory(run):
+  """Returns the peak memory allocated by Python during run in KiB."""
+  tracemalloc.start()
+  try:
+    run()
+    return tracemalloc.get_traced_memory()[1] // 1024
+  finally:
+    tracemalloc.stop()
+
+
+def _RunCommandLine(arguments):
+  """Runs fortress in a subprocess and returns its peak RSS in KiB."""
+  env = dict(os.environ, PYTHONPATH=_ROOT)
+  process = subprocess.Popen([sys.executable, '-W', 'ignore', '-m', 'fortress']
+                             + arguments,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE,
+                             env=env)
+  stderr = process.stderr.read()
+  _, status, usage = os.wait4(process.pid, 0)
+  process.returncode = os.waitstatus_to_exitcode(status)
+  # 0: unchanged, 2: changed
+  if process.returncode not in (0, 2):
+    raise RuntimeError('fortress failed: ' + stderr.decode('utf-8', 'replace'))
+  return usage.ru_maxrss
+
+
+def Measure(target, style, filename, source, repeat, jobs=1):
+  """Measure one benchmark.
+
+  Arguments:
+    target   : (str) One of TARGETS.
+    style    : (str) One of STYLES.
+    filename : (str) File containing source.
+    source   : (unicode) The code to format.
+    repeat   : (int) The best of this many runs is taken.
+    jobs     : (int) Number of processes huge files are formatted with.
+
+  Returns:
+    Dict with 'seconds', 'lines_per_second' and 'peak_memory_kb'.
+  """
+  createStyle, arguments = STYLES[style]
+  fortress_style.SetGlobalStyle(createStyle())
+
+  if target == 'FormatCode':
+    run = lambda: fortress_api.FormatCode(source, filename=filename,
+                                          jobs=jobs)
+    peakMemory = _PeakMemory(run)
+  elif target == 'FormatFile':
+    run = lambda: fortress_api.FormatFile(filename, jobs=jobs)
+    peakMemory = _PeakMemory(run)
+  else:
+    peaks = []
+    run = lambda: peaks.append(_RunCommandLine(
+        arguments + ['-j', str(jobs), filename]))
+    peakMemory = None
+
+  seconds = _Best(run, repeat)
+  if peakMemory is None:
+    peakMemory = min(peaks)
+
+  lines = source.count('\n')
+  return dict(seconds=seconds,
+              lines_per_second=lines / seconds,
+              peak_memory_kb=peakMemory)
+
+
+def RunAll(sizes, repeat, targets=TARGETS, styles=sorted(STYLES), seed=0,
+           jobs=1):
+  """Run all benchmarks.
+
+  Returns:
+    Dict mapping 'target/style/form/lines' to the measurement.
+  """
+  results = {}
+  directory = tempfile.mkdtemp(prefix='fortress-bench-')
+  try:
+    for lines in sizes:
+      for form, extension in FORMS:
+        source = corpus.Generate(form, lines, seed)
+        filename = os.path.join(directory, '%s%d%s' % (form, lines, extension))
+        with open(filename, 'w') as fd:
+          fd.write(source)
+        for style in styles:
+          for target in targets:
+            name = '/'.join([target, style, form, str(lines)])
+            results[name] = Measure(target, style, filename, source, repeat,
+                                    jobs)
+            _PrintResult(name, results[name])
+  finally:
+    shutil.rmtree(directory)
+  return results
+
+
+def _PrintResult(name, result, baseline=None):
+  line = '{:<36} {:>10.0f} lines/s {:>9d} KiB'.format(
+      name, result['lines_per_second'], result['peak_memory_kb'])
+  if baseline:
+    line += '  {:+6.1%} speed  {:+6.1%} memory'.format(
+        result['lines_per_second'] / baseline['lines_per_second'] - 1,
+        float(result['peak_memory_kb']) / max(baseline['peak_memory_kb'], 1) - 1)
+  print(line)
+
+
+def Compare(results, baseline, tolerance):
+  """Compare results against a baseline.
+
+  Returns:
+    List of the names of benchmarks whose throughput dropped by more than
+    tolerance (a fraction).
+  """
+  regressions = []
+  print('\ncompared to baseline:')
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    _PrintResult(name, results[name], baseline[name])
+    if results[name]['lines_per_second'] \
+        < (1 - tolerance) * baseline[name]['lines_per_second']:
+      regressions.append(name)
+  return regressions
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+      description='Measure the end-to-end throughput of FORTRESS.')
+  parser.add_argument('--lines',
+                      default='5000',
+                      help='comma separated sizes of the generated sources '
+                           '(default: %(default)s)')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='take the best of this many runs (default: %(default)s)')
+  parser.add_argument('--target', action='append', choices=TARGETS,
+                      help='only run these targets')
+  parser.add_argument('--style', action='append', choices=sorted(STYLES),
+                      help='only run these styles')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--jobs', type=int, default=1,
+                      help='processes huge files are formatted with '
+                           '(default: %(default)s)')
+  parser.add_argument('--save', metavar='FILE',
+                      help='store the results as JSON baseline')
+  parser.add_argument('--compare', metavar='FILE',
+                      help='compare the results against a JSON baseline')
+  parser.add_argument('--tolerance', type=float, default=0.1,
+                      help='allowed relative drop of throughput when comparing '
+                           '(default: %(default)s)')
+  args = parser.parse_args(argv[1:])
+
+  sizes = [int(size) for size in args.lines.split(',')]
+  results = RunAll(sizes, args.repeat,
+                   targets=args.target or TARGETS,
+                   styles=args.style or sorted(STYLES),
+                   seed=args.seed,
+                   jobs=args.jobs)
+
+  if args.save:
+    with open(args.save, 'w') as fd:
+      json.dump(dict(fortress=fortress.__version__,
+                     python=platform.python_version(),
+                     seed=args.seed,
+                     results=results), fd, indent=2, sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as fd:
+      baseline = json.load(fd)
+    regressions = Compare(results, baseline['results'], args.tolerance)
+    if regressions:
+      print('throughput regressed in: ' + ', '.join(regressions))
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -8,14 +8,25 @@ If no input file is specified, FORTRESS reads the code from STDIN.
 """
 import argparse
 import logging
+import multiprocessing
 import os
 import sys
 import textwrap
 
+from fortress.lib import archive_files
 from fortress.lib import fortress_api
+from fortress.lib import fortress_linter
+from fortress.lib import lint_cache
 from fortress.lib import file_resources
+from fortress.lib import file_watcher
+from fortress.lib import git_staged
+from fortress.lib import isolation
+from fortress.lib import memory_profile
+from fortress.lib import profiling
 from fortress.lib import py3compat
 from fortress.lib import fortress_style
+from fortress.lib import symbol_index
+from fortress.lib import text_edits
 
 __version__ = '0.2'
 __authors__ = [
@@ -34,6 +45,9 @@ def main(argv):
   Returns:
     0 if there were no changes, non-zero otherwise.
   """
+  if len(argv) > 1 and argv[1] == 'index':
+    return IndexMain(argv)
+
   parser = argparse.ArgumentParser(formatter_class = argparse.RawDescriptionHelpFormatter,
                                    description = textwrap.dedent('''\
                                    FORTRESS is a formatter/modernizer of legacy FORTRAN code.
@@ -60,6 +74,19 @@ def main(argv):
                                   '--in-place',
                                   action='store_true',
                                   help='make changes to files in place')
+  diff_inplace_group.add_argument('-o',
+                                  '--output-dir',
+                                  metavar='DIR',
+                                  default=None,
+                                  help='write the files into DIR, mirroring '
+                                       'the directories given; unchanged '
+                                       'files are linked, not copied')
+  diff_inplace_group.add_argument('--edits',
+                                  action='store_true',
+                                  help='print the edits to apply to the code '
+                                       'read from stdin as JSON lists of '
+                                       '[line, column, end line, end column, '
+                                       'text]')
 
 # Either recursive or linespecific (single file)
   lines_recursive_group = parser.add_mutually_exclusive_group()
@@ -97,6 +124,77 @@ def main(argv):
                       action='store_true',
                       help='lint files')
 
+  parser.add_argument('--linter',
+                      metavar='EXECUTABLE',
+                      default=fortress_linter.DEFAULT_LINTER,
+                      help='compiler used for linting, "{}" runs the checks '
+                           'of the formatter without a compiler '
+                           '(default: %(default)s)'.format(
+                               fortress_linter.BUILTIN_LINTER))
+
+  parser.add_argument('-j',
+                      '--jobs',
+                      metavar='N',
+                      type=int,
+                      default=None,
+                      help='number of files linted concurrently, or of '
+                           'processes reformatting a huge file '
+                           '(default: number of CPUs)')
+
+  parser.add_argument('--lint-flag',
+                      metavar='FLAG',
+                      action='append',
+                      default=None,
+                      help='additional flag passed to the linter, '
+                           'e.g. --lint-flag=-I../include')
+
+  parser.add_argument('--lint-cache',
+                      metavar='DIR',
+                      nargs='?',
+                      const=lint_cache.DefaultCacheDirectory(),
+                      default=None,
+                      help='replay lint results of unchanged files from a cache '
+                           '(default DIR: %(const)s)')
+
+  parser.add_argument('--watch',
+                      metavar='DIR',
+                      action='append',
+                      default=None,
+                      help='keep running and reformat changed files below DIR '
+                           'in place')
+
+  parser.add_argument('--mem-report',
+                      action='store_true',
+                      help='print the peak memory per file and phase of '
+                           'formatting to stderr (slows formatting down)')
+
+  parser.add_argument('--max-memory',
+                      metavar='SIZE',
+                      default=None,
+                      help='memory budget per file, e.g. 2G: larger files '
+                           'are formatted in a low-memory mode, or skipped')
+
+  parser.add_argument('--timeout',
+                      metavar='SECONDS',
+                      type=float,
+                      default=None,
+                      help='give up on files taking longer, formatting every '
+                           'file in a separate process')
+
+  parser.add_argument('--git-staged',
+                      action='store_true',
+                      help='check the content of the Fortran files staged in '
+                           'git instead of files: print the names of the '
+                           'files which are not formatted, or the diffs')
+
+  parser.add_argument('--profile',
+                      metavar='OUT',
+                      default=None,
+                      help='profile the run: write the cProfile statistics '
+                           'to OUT (pstats) and sampled stacks to '
+                           'OUT' + profiling.FOLDED_SUFFIX + ' (collapsed '
+                           'stacks for flame graphs)')
+
   parser.add_argument('files', nargs='*')
 
 # Catch arguments:
@@ -113,6 +211,17 @@ def main(argv):
 
   lines = getLines(args.lines) if args.lines is not None else None
 
+# -j: Number of linters or processes
+  if args.jobs is not None and args.jobs < 1:
+    parser.error('-j/--jobs must be at least 1')
+
+# --edits: For editors, which pipe their buffer through stdin
+  if args.edits and (args.files or args.watch or args.git_staged or
+                     args.lint or args.mem_report or
+                     args.max_memory is not None):
+    parser.error('--edits applies to the code read from stdin only, not with '
+                 '--mem-report or --max-memory')
+
 # -s: Style file provided
   if args.strict:
     fortress_style.SetGlobalStyle(fortress_style.CreateStrictStyle())
@@ -123,41 +232,260 @@ def main(argv):
       fortress_style.SetGlobalStyle(fortress_style.CreateFortran2003Style())
 
 
+# --mem-report, --max-memory: Measure and bound the memory per file
+  max_memory = None
+  if args.max_memory is not None:
+    try:
+      max_memory = memory_profile.ParseSize(args.max_memory)
+    except ValueError as e:
+      parser.error(str(e))
+  if (args.mem_report or max_memory is not None) and \
+      (args.watch or args.lint):
+    parser.error('cannot use --mem-report or --max-memory with --watch or '
+                 '--lint')
+  if args.timeout is not None and (args.mem_report or args.watch or
+                                   args.lint or args.git_staged or
+                                   not args.files):
+    parser.error('--timeout applies to files and directories only, not to '
+                 'stdin, and not with --mem-report, --watch, --lint or '
+                 '--git-staged')
+  memory = None
+  if args.mem_report:
+    try:
+      memory = memory_profile.MemoryReport()
+    except RuntimeError as e:
+      parser.error(str(e))
+
+# --profile: Profile the run, which has to stay in this process and untraced
+  if args.profile and (args.timeout is not None or args.mem_report):
+    parser.error('cannot use --profile with --timeout or --mem-report')
+  profiler = None
+  if args.profile:
+    profiler = profiling.Profiler()
+    profiler.start()
+
+  try:
+# --watch: Reformat files when they change
+    if args.watch:
+      if args.files or args.lines or args.diff or args.output_dir or \
+          args.lint or args.git_staged:
+        parser.error('cannot use --watch with files, --lines, --diff, '
+                     '--output-dir, --lint or --git-staged')
+      try:
+        WatchFiles(args.watch, args.exclude)
+      except KeyboardInterrupt:
+        pass
+      return 0
+
+# --git-staged: Format the content of the index, e.g. in a pre-commit hook
+    if args.git_staged:
+      if args.files or args.lines or args.in_place or args.output_dir or \
+          args.lint:
+        parser.error('cannot use --git-staged with files, --lines, --in-place, '
+                     '--output-dir or --lint')
+      try:
+        changed = FormatStaged(args.exclude,
+                               print_diff=args.diff,
+                               jobs=args.jobs or multiprocessing.cpu_count(),
+                               memory=memory,
+                               max_memory=max_memory)
+      except (IOError, OSError) as e:
+        sys.stderr.write('fortress: cannot read staged files from git: '
+                         '{}\n'.format(e))
+        return 1
+      return 2 if changed else 0
+
 # Lines case:
-  if not args.files:
-    if args.in_place or args.diff:
-      parser.error('cannot use --in-place or --diff flags when reading '
-                   'from stdin')
-    original_source = []
+    if not args.files:
+      if args.lint:
+        parser.error('cannot use --lint when reading from stdin')
+      if args.in_place or args.diff or args.output_dir:
+        parser.error('cannot use --in-place, --diff or --output-dir flags when '
+                     'reading from stdin')
+      original_source = []
+
+      while True:
+        try:
+          # Use 'raw_input' instead of 'sys.stdin.read', because otherwise the
+          # user will need to hit 'Ctrl-D' more than once if they're inputting
+          # the program by hand.
+          original_source.append(py3compat.raw_input())
+        except EOFError:
+          break
+
+      if args.edits:
+        edits = fortress_api.FormatCodeEdits(
+            py3compat.unicode('\n'.join(original_source) + '\n'),
+            filename='<stdin>',
+            lines=lines,
+            jobs=args.jobs or multiprocessing.cpu_count())
+        sys.stdout.write(text_edits.ToJson(edits) + '\n')
+        return 2 if edits else 0
 
-    while True:
       try:
-        # Use 'raw_input' instead of 'sys.stdin.read', because otherwise the
-        # user will need to hit 'Ctrl-D' more than once if they're inputting
-        # the program by hand.
-        original_source.append(py3compat.raw_input())
-      except EOFError:
-        break
-
-    reformatted_source, changed = fortress_api.FormatCode(
-          py3compat.unicode('\n'.join(original_source) + '\n'),
-          filename='<stdin>',
-          lines=lines)
+        reformatted_source, changed = fortress_api.FormatCode(
+              py3compat.unicode('\n'.join(original_source) + '\n'),
+              filename='<stdin>',
+              lines=lines,
+              jobs=args.jobs or multiprocessing.cpu_count(),
+              memory=memory,
+              max_memory=max_memory)
+      except memory_profile.MemoryBudgetError as e:
+        sys.stderr.write('fortress: {}\n'.format(e))
+        return 1
+
+      # STDOUT:
+      sys.stdout.write(reformatted_source)
+
+      return 2 if changed else 0
+
+# Archive case: Format the members of a tar or zip archive
+    if any(archive_files.IsArchive(f) for f in args.files):
+      if len(args.files) > 1 or args.lines or args.in_place or \
+          args.output_dir or args.lint or args.timeout is not None:
+        parser.error('cannot use an archive with other files, --lines, '
+                     '--in-place, --output-dir, --lint or --timeout')
+      if not args.diff and sys.stdout.isatty():
+        parser.error('not writing an archive to a terminal, redirect the '
+                     'output or use --diff')
+      try:
+        changed = FormatArchive(args.files[0],
+                                args.exclude,
+                                print_diff=args.diff,
+                                jobs=args.jobs or multiprocessing.cpu_count(),
+                                memory=memory,
+                                max_memory=max_memory)
+      except (archive_files.ArchiveError, IOError) as e:
+        sys.stderr.write('fortress: cannot read archive {}: {}\n'.format(
+            args.files[0], e))
+        return 1
+      return 2 if changed else 0
 
-    # STDOUT:
-    sys.stdout.write(reformatted_source)
+# Recursive or file list case:
+    files = file_resources.GetCommandLineFiles(args.files,
+                                               args.recursive,
+                                               args.exclude)
+
+# -t: Lint instead of formatting
+    if args.lint:
+      if args.output_dir:
+        parser.error('cannot use --output-dir with --lint')
+      try:
+        cache = lint_cache.LintCache(args.lint_cache) if args.lint_cache else None
+        found = LintFiles(files,
+                          jobs=args.jobs,
+                          linter=args.linter,
+                          flags=args.lint_flag,
+                          cache=cache)
+      except OSError as e:
+        sys.stderr.write('fortress: cannot run linter {}: {}\n'.format(
+            args.linter, e))
+        return 1
+      return 2 if found else 0
+
+# -o: Mirror the files into another tree
+    if args.output_dir:
+      try:
+        mirrored = file_resources.GetMirroredFiles(args.files,
+                                                   args.recursive,
+                                                   args.output_dir)
+      except ValueError as e:
+        parser.error(str(e))
 
+    runner = isolation.BatchRunner(args.timeout)
+    try:
+      if args.output_dir:
+        changed = FormatFilesToDirectory(mirrored,
+                                         files,
+                                         lines,
+                                         jobs=args.jobs or
+                                         multiprocessing.cpu_count(),
+                                         memory=memory,
+                                         max_memory=max_memory,
+                                         runner=runner)
+      else:
+        changed = FormatFiles(files,
+                              lines,
+                              in_place=args.in_place,
+                              print_diff=args.diff,
+                              jobs=args.jobs or multiprocessing.cpu_count(),
+                              memory=memory,
+                              max_memory=max_memory,
+                              runner=runner)
+    finally:
+      runner.close()
+    runner.writeSummary(sys.stderr)
+    if runner.failed:
+      return 1
     return 2 if changed else 0
 
-# Recursive or file list case:
-  files = file_resources.GetCommandLineFiles(args.files,
-                                             args.recursive,
-                                             args.exclude)
-  changed = FormatFiles(files,
-                        lines,
-                        in_place=args.in_place,
-                        print_diff=args.diff)
-  return 2 if changed else 0
+  finally:
+    if memory:
+      memory.close()
+      memory.write(sys.stderr)
+    if profiler:
+      profiler.stop()
+      try:
+        profiler.write(args.profile)
+      except IOError as e:
+        sys.stderr.write('fortress: cannot write profile: {}\n'.format(e))
+
+
+def IndexMain(argv):
+  """Main program of 'fortress index'.
+
+  Arguments:
+    argv: command-line arguments, such as sys.argv, with 'index' in argv[1].
+
+  Returns:
+    0 on success, 2 if --find did not find anything.
+  """
+  parser = argparse.ArgumentParser(prog='fortress index',
+                                   description='Update the index of program '
+                                   'units of a source tree, or look up a '
+                                   'unit in it.')
+  parser.add_argument('--db',
+                      metavar='FILE',
+                      default=symbol_index.DEFAULT_INDEX,
+                      help='index file (default: %(default)s)')
+  parser.add_argument('-e',
+                      '--exclude',
+                      metavar='PATTERN',
+                      action='append',
+                      default=None,
+                      help='patterns for files to exclude from the index')
+  parser.add_argument('--find',
+                      metavar='NAME',
+                      default=None,
+                      help='print the program units called NAME instead of '
+                           'updating the index')
+  parser.add_argument('--kind',
+                      metavar='KIND',
+                      default=None,
+                      help='only find units of this kind, e.g. subroutine')
+  parser.add_argument('paths', nargs='*',
+                      help='files and directories to index (default: .)')
+  args = parser.parse_args(argv[2:])
+
+  index = symbol_index.SymbolIndex(args.db)
+  try:
+    if args.find is not None:
+      units = index.find(args.find, args.kind)
+      for path, start, end, kind, name, parent in units:
+        line = '{}:{}-{}: {} {}'.format(path, start, end, kind, name)
+        if parent is not None:
+          line += ' (in {})'.format(parent)
+        print(line)
+      return 0 if units else 2
+
+    files = file_resources.GetCommandLineFiles(args.paths or ['.'],
+                                               True,
+                                               args.exclude)
+    parsed = index.update(files, logger=logging.warning)
+    logging.info('Indexed %d of %d files', parsed, len(files))
+  finally:
+    index.close()
+  return 0
 
 
 # TODO: Error handling in getLines
@@ -188,7 +516,11 @@ def getLines(line_strings):
 def FormatFiles(filenames,
                 lines,
                 in_place=False,
-                print_diff=False):
+                print_diff=False,
+                jobs=1,
+                memory=None,
+                max_memory=None,
+                runner=None):
   """Format a list of files.
 
   Arguments:
@@ -204,28 +536,290 @@ def FormatFiles(filenames,
     print_diff: (bool) Instead of returning the reformatted source, return a
       diff that turns the formatted source into reformatter source.
 
+    jobs: (int) Number of processes a huge file is reformatted with.
+
+    memory: (memory_profile.MemoryReport) Records the peak memory of every
+      file, if given.
+
+    max_memory: (int) Memory budget per file in bytes, files exceeding it
+      fail.
+
+    runner: (isolation.BatchRunner) Formats the files and records the ones
+      which fail, instead of stopping at them. Defaults to formatting in this
+      process.
+
+  Returns:
     True if the source code changed in any of the files being formatted.
+
+  Raises:
+    ValueError: raised if both in_place and print_diff are set.
   """
+  if in_place and print_diff:
+    raise ValueError('Cannot pass both in_place and print_diff.')
+
+  runner = runner or isolation.BatchRunner()
   changed = False
   for filename in filenames:
     logging.info('Reformatting %s', filename)
-    try:
-      reformatted_code, encoding, has_change = fortress_api.FormatFile(
-          filename,
-          in_place=in_place,
+    # written here, so a worker killed by a timeout never leaves a file
+    # half-written
+    result = runner.run(filename,
+                        fortress_api.FormatFile,
+                        filename,
+                        lines=lines,
+                        print_diff=print_diff,
+                        logger=logging.warning,
+                        jobs=jobs,
+                        memory=memory,
+                        max_memory=max_memory)
+    if result is None:
+      continue
+    reformatted_code, encoding, has_change = result
+    changed |= has_change
+    if not in_place:
+      file_resources.WriteReformattedCode(filename, reformatted_code, False,
+                                          encoding)
+    elif has_change and os.path.getsize(filename):
+      # like FormatFile, empty files are not written
+      file_resources.WriteReformattedCode(filename, reformatted_code, True,
+                                          encoding)
+  return changed
+
+
+def FormatFilesToDirectory(mirrored, filenames, lines, jobs=1, memory=None,
+                           max_memory=None, runner=None):
+  """Format files into an output tree.
+
+  Only the files which change are written, all others are linked into the
+  output tree (see file_resources.LinkFile), so the output grows with the
+  number of changed files, not with the size of the tree.
+
+  Arguments:
+    mirrored: (list of tuples) Every file and where it goes in the output
+      tree, see file_resources.GetMirroredFiles.
+
+    filenames: (list of unicode) The files to reformat, other files are only
+      linked.
+
+    lines: (list of tuples of integers) Lines to format, see FormatFiles.
+
+    jobs: (int) Number of processes a huge file is reformatted with.
+
+    memory, max_memory, runner: see FormatFiles. Files which fail are linked
+      unchanged.
+
+  Returns:
+    True if the source code changed in any of the files being formatted.
+  """
+  runner = runner or isolation.BatchRunner()
+  formatted = set(filenames)
+  changed = False
+  for source, destination in mirrored:
+    if source in formatted:
+      logging.info('Reformatting %s', source)
+      reformatted_code, encoding, has_change = runner.run(
+          source,
+          fortress_api.FormatFile,
+          source,
           lines=lines,
+          logger=logging.warning,
+          jobs=jobs,
+          memory=memory,
+          max_memory=max_memory) or (None, None, False)
+      if has_change:
+        changed = True
+        file_resources.WriteMirroredCode(destination, reformatted_code,
+                                         encoding)
+        continue
+    file_resources.LinkFile(source, destination)
+  return changed
+
+
+def FormatArchive(filename, exclude=None, print_diff=False, jobs=1,
+                  memory=None, max_memory=None):
+  """Format the Fortran files in a tar or zip archive.
+
+  The archive is read as a stream and its files are formatted in memory,
+  nothing is extracted to disk.
+
+  Arguments:
+    filename: (unicode) The archive, see archive_files.IsArchive.
+
+    exclude: (list of unicode) Patterns of members to skip.
+
+    print_diff: (bool) Print the diffs of all files instead of the
+      reformatted archive.
+
+    jobs: (int) Number of processes a huge file is reformatted with.
+
+    memory, max_memory: see FormatFiles.
+
+  Returns:
+    True if the source code changed in any of the files being formatted.
+  """
+  changed = []
+
+  def Rewrite(name, content):
+    logging.info('Reformatting %s in %s', name, filename)
+    try:
+      source, encoding = file_resources.DecodeContent(content)
+    except (UnicodeDecodeError, SyntaxError) as e:
+      logging.warning('%s: %s', name, e)
+      return None
+    try:
+      reformatted_code, has_change = fortress_api.FormatCode(
+          source,
+          filename=name,
           print_diff=print_diff,
-          logger=logging.warning)
-      changed |= has_change
-    except SyntaxError as e:
-      e.filename = filename
-      raise
-    if reformatted_code is not None:
-      file_resources.WriteReformattedCode(filename, reformatted_code, in_place,
-                                          encoding)
+          jobs=jobs,
+          memory=memory,
+          max_memory=max_memory)
+    except memory_profile.MemoryBudgetError as e:
+      logging.warning('Skipping %s', e)
+      return None
+    if not has_change:
+      return None
+    changed.append(name)
+    if print_diff:
+      py3compat.EncodeAndWriteToStdout(reformatted_code, encoding)
+      return None
+    return reformatted_code.encode(encoding)
+
+  output = None
+  if not print_diff:
+    output = sys.stdout.buffer if py3compat.PY3 else sys.stdout
+  archive_files.RewriteArchive(filename, Rewrite, exclude, output)
+  return bool(changed)
+
+
+def FormatStaged(exclude=None, print_diff=False, jobs=1, memory=None,
+                 max_memory=None):
+  """Format the staged content of the Fortran files in git.
+
+  All staged files are read through a single git process and formatted in
+  memory, neither the working tree nor the index are changed.
+
+  Arguments:
+    exclude: (list of unicode) Patterns of files to skip.
+
+    print_diff: (bool) Print the diffs instead of the names of the files
+      which are not formatted.
+
+    jobs: (int) Number of processes a huge file is reformatted with.
+
+    memory, max_memory: see FormatFiles.
+
+  Returns:
+    True if the staged content of any file is not formatted.
+  """
+  staged = git_staged.StagedFiles(exclude)
+  contents = git_staged.ReadBlobs(blob for _, blob in staged)
+  changed = False
+  for (path, _), content in zip(staged, contents):
+    if not file_resources.IsFortranContent(path, content):
+      # a C header
+      continue
+    logging.info('Reformatting staged %s', path)
+    try:
+      source, encoding = file_resources.DecodeContent(content)
+    except (UnicodeDecodeError, SyntaxError) as e:
+      logging.warning('%s: %s', path, e)
+      continue
+    try:
+      reformatted_code, has_change = fortress_api.FormatCode(
+          source,
+          filename=path,
+          print_diff=print_diff,
+          jobs=jobs,
+          memory=memory,
+          max_memory=max_memory)
+    except memory_profile.MemoryBudgetError as e:
+      logging.warning('Skipping %s', e)
+      continue
+    if not has_change:
+      continue
+    changed = True
+    if print_diff:
+      py3compat.EncodeAndWriteToStdout(reformatted_code, encoding)
+    else:
+      print(path)
   return changed
 
 
+def WatchFiles(directories, exclude=None):
+  """Reformat files in place whenever they change.
+
+  Runs until interrupted. Only the files which changed are reformatted, and
+  the changes made by the formatter itself are not reported again.
+
+  Arguments:
+    directories: (list of unicode) Directories to watch, recursively.
+
+    exclude: (list of unicode) Patterns of files to ignore.
+  """
+  watcher = file_watcher.FileWatcher(directories, exclude)
+  try:
+    for filenames in watcher.changes():
+      for filename in filenames:
+        try:
+          reformatted_code, encoding, changed = fortress_api.FormatFile(
+              filename, logger=logging.warning)
+        except (IOError, UnicodeDecodeError, SyntaxError) as e:
+          # keep watching, the file may be fixed later
+          logging.warning('%s: %s', filename, e)
+          continue
+        if changed:
+          file_resources.WriteReformattedCode(filename, reformatted_code,
+                                              True, encoding)
+          watcher.ignoreWrite(filename)
+          logging.warning('Reformatted %s', filename)
+  finally:
+    watcher.close()
+
+
+def LintFiles(filenames,
+              jobs=None,
+              linter=fortress_linter.DEFAULT_LINTER,
+              flags=None,
+              cache=None):
+  """Lint a list of files.
+
+  Files are linted in the order of their module dependencies. The linters
+  run concurrently and their diagnostics are printed as soon as a file is
+  finished.
+
+  Arguments:
+    filenames: (list of unicode) A list of files to lint.
+
+    jobs: (int) Maximal number of concurrently running linters. Defaults to
+      the number of CPUs.
+
+    linter: (unicode) The compiler used as linter.
+
+    flags: (list of unicode) Additional flags passed to the linter.
+
+    cache: (LintCache) Cache to replay the results of unchanged files from.
+
+  Returns:
+    True if there were diagnostics for any of the files.
+  """
+  found = False
+  for filename, messages in fortress_linter.LintTree(filenames,
+                                                     jobs=jobs,
+                                                     linter=linter,
+                                                     flags=flags,
+                                                     cache=cache):
+    logging.info('Linted %s', filename)
+    for message in messages:
+      print(message)
+    sys.stdout.flush()
+    found |= bool(messages)
+
+  if cache:
+    cache.prune()
+  return found
+
+
 # TODO: Error handling
 def run_main():
     sys.exit(main(sys.argv))
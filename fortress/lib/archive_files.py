@@ -0,0 +1,140 @@
+"""Rewrite the Fortran files in tar and zip archives.
+
+Archives are never extracted to disk: tar archives are read and written as
+streams, member after member, so only one member is in memory at a time and
+the output can go to a pipe. Zip archives are read through their central
+directory, which needs a seekable file, but are written as a stream as well.
+
+Fortran members are selected by their names, like the files of a directory
+(see file_resources.IsFortranOrHeaderName), and headers by their content. All
+other members are copied to the output unchanged.
+"""
+
+import copy
+import fnmatch
+import io
+import shutil
+import stat
+import tarfile
+import zipfile
+
+from fortress.lib import file_resources
+
+# Suffixes of tar archives and their compression
+_TAR_SUFFIXES = (
+    ('.tar', ''),
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.bz2', 'bz2'),
+    ('.tbz2', 'bz2'),
+    ('.tar.xz', 'xz'),
+    ('.txz', 'xz'),
+)
+
+
+class ArchiveError(Exception):
+  """An archive is broken."""
+
+
+def _TarCompression(filename):
+  """Returns the compression of a tar archive, None if it is none."""
+  name = filename.lower()
+  for suffix, compression in _TAR_SUFFIXES:
+    if name.endswith(suffix):
+      return compression
+  return None
+
+
+def IsArchive(filename):
+  """Return True if filename is a tar or zip archive, by its name."""
+  return _TarCompression(filename) is not None or \
+      filename.lower().endswith('.zip')
+
+
+def _Selected(name, exclude):
+  """Whether the member called name is a Fortran file not excluded."""
+  if exclude and any(fnmatch.fnmatch(name, p) for p in exclude):
+    return False
+  return file_resources.IsFortranOrHeaderName(name)
+
+
+def RewriteArchive(filename, rewrite, exclude=None, output=None):
+  """Rewrite the Fortran files of an archive.
+
+  Arguments:
+    filename : (unicode) The tar or zip archive, see IsArchive.
+    rewrite  : (function) Called with the name and the content (bytes) of
+               every Fortran file in the archive, in the order of the
+               archive, but not with C headers. Returns the new content, or
+               None to keep it.
+    exclude  : (list of unicode) Patterns of members to skip.
+    output   : (binary file) The rewritten archive, of the same format as
+               the input, is written to it. Nothing is written if None.
+
+  Raises:
+    ArchiveError : the archive is broken.
+    IOError      : the archive cannot be read.
+  """
+  try:
+    if _TarCompression(filename) is None:
+      _RewriteZip(filename, rewrite, exclude, output)
+    else:
+      _RewriteTar(filename, rewrite, exclude, output)
+  except (tarfile.TarError, zipfile.BadZipfile) as e:
+    raise ArchiveError(e)
+
+
+def _RewriteTar(filename, rewrite, exclude, output):
+  """RewriteArchive of a tar archive."""
+  compression = _TarCompression(filename)
+  with tarfile.open(filename, 'r|*') as source:
+    target = tarfile.open(fileobj=output,
+                          mode='w|' + compression,
+                          format=tarfile.PAX_FORMAT) if output else None
+    try:
+      for member in source:
+        if member.isfile() and _Selected(member.name, exclude):
+          content = source.extractfile(member).read()
+          rewritten = rewrite(member.name, content) \
+              if file_resources.IsFortranContent(member.name, content) \
+              else None
+          if rewritten is not None:
+            content = rewritten
+            member.size = len(content)
+          if target:
+            target.addfile(member, io.BytesIO(content))
+        elif target:
+          target.addfile(member,
+                         source.extractfile(member) if member.isfile()
+                         else None)
+    finally:
+      if target:
+        target.close()
+
+
+def _RewriteZip(filename, rewrite, exclude, output):
+  """RewriteArchive of a zip archive."""
+  with zipfile.ZipFile(filename) as source:
+    target = zipfile.ZipFile(output, 'w') if output else None
+    try:
+      for info in source.infolist():
+        # the information is updated when written
+        written = copy.copy(info)
+        if info.filename.endswith('/'):
+          if target:
+            target.writestr(written, b'')
+        elif _Selected(info.filename, exclude) and \
+            not stat.S_ISLNK(info.external_attr >> 16):
+          content = source.read(info)
+          rewritten = rewrite(info.filename, content) \
+              if file_resources.IsFortranContent(info.filename, content) \
+              else None
+          if target:
+            target.writestr(written,
+                            content if rewritten is None else rewritten)
+        elif target:
+          with source.open(info) as src, target.open(written, 'w') as dst:
+            shutil.copyfileobj(src, dst)
+    finally:
+      if target:
+        target.close()
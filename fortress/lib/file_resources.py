@@ -7,13 +7,29 @@ This module provides functions for interfacing with files:
 
 """
 
+import errno
 import fnmatch
+import io
 import os
 import re
+import shutil
+import sys
 
 from lib2to3.pgen2 import tokenize
+from fortress.lib import header_language
 from fortress.lib import py3compat
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None  # Windows
+
+# ioctl cloning a file (copy-on-write), see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+# (device of the source, device of the destination) which failed to clone
+_NO_CLONE = set()
+
 
 def WriteReformattedCode(filename, reformatted_code, in_place, encoding):
   """Emit the reformatted code.
@@ -36,18 +52,153 @@ def WriteReformattedCode(filename, reformatted_code, in_place, encoding):
     py3compat.EncodeAndWriteToStdout(reformatted_code, encoding)
 
 
+def WriteMirroredCode(destination, reformatted_code, encoding):
+  """Write the reformatted code into a file of an output tree.
+
+  A file at destination is removed first, as it may be a hard link to the
+  unformatted file (see LinkFile).
+
+  Arguments:
+    destination      : (unicode) The name of the file in the output tree.
+    reformatted_code : (unicode) The reformatted code.
+    encoding         : (unicode) The encoding of the file.
+  """
+  _MakeParent(destination)
+  if os.path.lexists(destination):
+    os.remove(destination)
+  WriteReformattedCode(destination, reformatted_code, True, encoding)
+
+
+def LinkFile(source, destination):
+  """Put a file into an output tree without writing its content again.
+
+  The file is cloned (a copy-on-write reflink) if the file system supports
+  it, else hard linked. It is only copied if neither works, e.g. across file
+  systems. A hard link to source at destination is kept.
+
+  Arguments:
+    source      : (unicode) The file to mirror.
+    destination : (unicode) The name of the file in the output tree.
+  """
+  _MakeParent(destination)
+  if os.path.lexists(destination):
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+      return
+    os.remove(destination)
+
+  devices = (os.stat(source).st_dev,
+             os.stat(os.path.dirname(destination) or '.').st_dev)
+  if fcntl and sys.platform.startswith('linux') and devices not in _NO_CLONE:
+    try:
+      with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+      return
+    except (IOError, OSError):
+      # not supported by the file system, do not try again
+      _NO_CLONE.add(devices)
+      if os.path.lexists(destination):
+        os.remove(destination)
+
+  try:
+    os.link(source, destination)
+  except (OSError, AttributeError):
+    shutil.copy2(source, destination)
+
+
+def _MakeParent(filename):
+  """Create the directories filename is in."""
+  directory = os.path.dirname(filename)
+  if directory and not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+
+def GetMirroredFiles(command_line_file_list, recursive, output_dir):
+  """Return where the files on the command line go in an output tree.
+
+  The contents of directories are mirrored into output_dir, files are put
+  into output_dir itself. All files are returned, not only Fortran files.
+
+  Returns:
+    A list of tuples (source, destination).
+
+  Raises:
+    ValueError: output_dir is inside of a directory on the command line.
+  """
+  output = os.path.realpath(output_dir)
+  mirrored = []
+  for filename in command_line_file_list:
+    if os.path.isdir(filename):
+      if not recursive:
+        raise Exception(
+            "directory specified without '--recursive' flag: %s" % filename)
+      root = os.path.realpath(filename)
+      if output == root or output.startswith(os.path.join(root, '')):
+        raise ValueError('output directory %s is inside of %s' %
+                         (output_dir, filename))
+      for dirpath, _, filelist in os.walk(filename):
+        for f in filelist:
+          source = os.path.join(dirpath, f)
+          if os.path.isfile(source):
+            mirrored.append((source, os.path.join(
+                output_dir, os.path.relpath(source, filename))))
+    elif os.path.isfile(filename):
+      mirrored.append((filename,
+                       os.path.join(output_dir, os.path.basename(filename))))
+  return mirrored
+
+
 def GetCommandLineFiles(command_line_file_list, recursive, exclude):
   """Return the list of files specified on the command line."""
   return _FindFortranFiles(command_line_file_list, recursive, exclude)
 
 
-def IsFortranOrHeaderFile(filename, headers_too=True):
-  """Return True if filename is a Fortran file."""
+def IsFortranOrHeaderName(filename, headers_too=True):
+  """Return True if filename has the extension of a Fortran file.
+
+  Unlike IsFortranOrHeaderFile, the file is not opened, so this also works
+  for files which are not on disk, e.g. the members of an archive. Headers
+  may be C headers though, check their content with IsFortranContent.
+  """
   if headers_too:
-    if os.path.splitext(filename)[1] in ['.F','.F90','.f','.f90','.h']: # TODO: This can be dangerous. Esp. when it's a C-header.
+    return os.path.splitext(filename)[1] in ['.F','.F90','.f','.f90','.h']
+  return os.path.splitext(filename)[1] in ['.F','.F90','.f','.f90']
+
+
+def IsFortranContent(filename, content):
+  """Return False if filename is a C header, by its content.
+
+  Arguments:
+    filename : (unicode) A name accepted by IsFortranOrHeaderName.
+    content  : (bytes) The content of the file, or its beginning (see
+               header_language.SNIFF_BYTES).
+  """
+  return not _IsHeaderName(filename) or \
+      header_language.IsFortranHeader(content)
+
+
+def _IsHeaderName(filename):
+  """Whether filename has the extension of headers, which may be C."""
+  return os.path.splitext(filename)[1] == '.h'
+
+
+def IsFortranOrHeaderFile(filename, headers_too=True):
+  """Return True if filename is a Fortran file.
+
+  Headers are only read as far as needed to tell Fortran from C.
+  """
+  if IsFortranOrHeaderName(filename, headers_too):
+    if not _IsHeaderName(filename):
       return True
-  elif os.path.splitext(filename)[1] in ['.F','.F90','.f','.f90']:
-    return True
+    try:
+      with open(filename, 'rb') as fd:
+        return header_language.IsFortranHeader(
+            fd.read(header_language.SNIFF_BYTES + 1))
+    except IOError:
+      return False
 
   try:
     with open(filename, 'rb') as fd:
@@ -76,6 +227,23 @@ def IsFortranOrHeaderFile(filename, headers_too=True):
   return False
 
 
+def DecodeContent(content):
+  """Decode the content of a file like fortress_api.ReadFile.
+
+  Arguments:
+    content : (bytes) The content of the file.
+
+  Returns:
+    Tuple of (source, encoding).
+
+  Raises:
+    UnicodeDecodeError : the content does not match its encoding.
+    SyntaxError        : the encoding cookie is invalid.
+  """
+  encoding = tokenize.detect_encoding(io.BytesIO(content).readline)[0]
+  return content.decode(encoding), encoding
+
+
 def _FindFortranFiles(filenames, recursive, exclude):
   """Find all Fortran files."""
   fortran_files = []
@@ -0,0 +1,217 @@
+"""Watch directory trees for changed Fortran files.
+
+On Linux the kernel reports changes through inotify (used via ctypes), so
+an idle watcher does not use any CPU. Elsewhere, or if inotify is not
+available, the trees are scanned for changed modification times every few
+seconds.
+
+Changes are debounced: after the first change, the watcher waits until no
+further change happened for a short time, so bursts of writes (an editor
+saving several files, a 'git checkout') are handled as one batch.
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from fortress.lib import file_resources
+
+# Seconds without changes before a batch is reported
+DEBOUNCE = 0.2
+
+# Seconds between two scans of the polling watcher
+POLL_INTERVAL = 2.0
+
+# inotify events, see inotify(7)
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+# struct inotify_event without the name
+_EVENT = struct.Struct('iIII')
+
+
+def _Walk(directory):
+  """Yields all files below directory."""
+  for dirpath, _, filelist in os.walk(directory):
+    for f in filelist:
+      yield os.path.join(dirpath, f)
+
+
+class _InotifyWatcher:
+  """Changes reported by the kernel."""
+
+  def __init__(self, directories):
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    self.libc = libc
+    self.fd = libc.inotify_init1(_IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    self.directories = directories
+    # watch descriptor -> directory
+    self.watches = {}
+    for directory in directories:
+      self._addTree(directory)
+
+  def _addTree(self, directory):
+    for dirpath, _, _ in os.walk(directory):
+      wd = self.libc.inotify_add_watch(self.fd,
+                                       dirpath.encode(sys.getfilesystemencoding()),
+                                       _WATCH_MASK)
+      if wd < 0:
+        # e.g. fs.inotify.max_user_watches exceeded
+        raise OSError(ctypes.get_errno(), 'cannot watch ' + dirpath)
+      self.watches[wd] = dirpath
+
+  def read(self, timeout):
+    """Waits for changes, at most timeout seconds (forever if None).
+
+    Returns:
+      The set of files which changed, empty if the timeout expired.
+    """
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return set()
+    data = os.read(self.fd, 65536)
+
+    changed = set()
+    offset = 0
+    while offset < len(data):
+      wd, mask, _, length = _EVENT.unpack_from(data, offset)
+      name = data[offset + _EVENT.size:offset + _EVENT.size + length]
+      offset += _EVENT.size + length
+      name = name.rstrip(b'\0').decode(sys.getfilesystemencoding())
+
+      if mask & _IN_Q_OVERFLOW:
+        logging.warning('inotify queue overflow, rescanning')
+        for directory in self.directories:
+          changed.update(_Walk(directory))
+      elif mask & _IN_IGNORED:
+        self.watches.pop(wd, None)
+      elif wd in self.watches:
+        path = os.path.join(self.watches[wd], name)
+        if mask & _IN_ISDIR:
+          # files may have been written before the watch was added
+          if mask & (_IN_CREATE | _IN_MOVED_TO):
+            self._addTree(path)
+            changed.update(_Walk(path))
+        elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+          changed.add(path)
+    return changed
+
+  def close(self):
+    os.close(self.fd)
+
+
+class _PollingWatcher:
+  """Changes found by scanning the trees repeatedly."""
+
+  def __init__(self, directories, interval=POLL_INTERVAL):
+    self.directories = directories
+    self.interval = interval
+    self.snapshot = self._scan()
+
+  def _scan(self):
+    snapshot = {}
+    for directory in self.directories:
+      for path in _Walk(directory):
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        snapshot[path] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+  def read(self, timeout):
+    """See _InotifyWatcher.read."""
+    time.sleep(self.interval if timeout is None
+               else min(self.interval, timeout))
+    snapshot = self._scan()
+    changed = set(path for path, state in snapshot.items()
+                  if self.snapshot.get(path) != state)
+    self.snapshot = snapshot
+    return changed
+
+  def close(self):
+    pass
+
+
+class FileWatcher:
+  """Report batches of changed Fortran files below some directories."""
+
+  def __init__(self, directories, exclude=None, debounce=DEBOUNCE,
+               poll=False):
+    """
+    Arguments:
+      directories : (list of unicode) Directories to watch, recursively.
+      exclude     : (list of unicode) Patterns of files to ignore.
+      debounce    : (float) Seconds without changes before a batch is
+                    reported.
+      poll        : (bool) Scan for changes even if inotify is available.
+    """
+    self.exclude = exclude or []
+    self.debounce = debounce
+    # path -> (mtime, size) right after we wrote it
+    self.written = {}
+    self.backend = None
+    if not poll and sys.platform.startswith('linux'):
+      try:
+        self.backend = _InotifyWatcher(directories)
+      except (OSError, AttributeError) as err:
+        # AttributeError: libc without inotify
+        logging.warning('inotify not available (%s), polling instead', err)
+    if self.backend is None:
+      self.backend = _PollingWatcher(directories)
+
+  def ignoreWrite(self, filename):
+    """Do not report the change of filename just written by the caller."""
+    try:
+      stat = os.stat(filename)
+    except OSError:
+      return
+    self.written[filename] = (stat.st_mtime, stat.st_size)
+
+  def _isReported(self, path):
+    try:
+      stat = os.stat(path)
+    except OSError:
+      # vanished meanwhile
+      return False
+    if self.written.pop(path, None) == (stat.st_mtime, stat.st_size):
+      return False
+    if any(fnmatch.fnmatch(path, p) for p in self.exclude):
+      return False
+    return file_resources.IsFortranOrHeaderFile(path)
+
+  def changes(self):
+    """Waits for changes and yields them in batches.
+
+    Yields:
+      Sorted lists of changed Fortran files.
+    """
+    while True:
+      changed = self.backend.read(None)
+      while True:
+        more = self.backend.read(self.debounce)
+        if not more:
+          break
+        changed |= more
+
+      batch = sorted(path for path in changed if self._isReported(path))
+      if batch:
+        yield batch
+
+  def close(self):
+    self.backend.close()
@@ -2,8 +2,10 @@
 
 The main APIs that FORTRESS exposes to drive the reformatting.
 
-  FormatFile(): reformat a file.
-  FormatCode(): reformat a string of code.
+  FormatFile()     : reformat a file.
+  FormatCode()     : reformat a string of code.
+  FormatCodeEdits(): reformat a string of code into the edits to apply to it.
+  LintFile()       : lint a file with the built-in checks.
 
 These APIs have some common arguments:
 
@@ -14,6 +16,26 @@ These APIs have some common arguments:
 
   print_diff: (bool) Instead of returning the reformatted source, return a
     diff that turns the formatted source into reformatter source.
+
+  diagnostics: (list) If given, the built-in lint checks run while formatting
+    and their LintMessages are appended to this list.
+
+  jobs: (int) Number of processes a file of at least
+    parallel_reformatter.MIN_LINES lines is reformatted with. Not used
+    together with diagnostics.
+
+  memory: (memory_profile.MemoryReport) If given, the peak memory of every
+    phase of formatting is recorded in it.
+
+  max_memory: (int) Budget in bytes. Code which would need more memory (see
+    memory_profile.Estimate) is reformatted in a low-memory mode, or refused
+    with a memory_profile.MemoryBudgetError if even that exceeds the budget
+    or diagnostics are requested.
+
+  style: (fortress_style.Style or dict) The style to format with, defaults to
+    the global style (see fortress_style.SetGlobalStyle). The style is not
+    read from global state otherwise, so threads can format code with
+    different styles at the same time.
 """
 
 import difflib
@@ -21,9 +43,12 @@ import re
 import sys
 
 from fortress.lib import file_resources # Writing and reading files
+from fortress.lib import memory_profile
+from fortress.lib import parallel_reformatter
 from fortress.lib import reformatter    # Doing the real work
 from fortress.lib import py3compat
 from fortress.lib import fortress_style
+from fortress.lib import text_edits
 
 from lib2to3.pgen2 import tokenize      # For encoding in ReadFile - alt: chardet
 
@@ -31,7 +56,12 @@ def FormatFile(filename,
                lines=None,
                print_diff=False,
                in_place=False,
-               logger=None):
+               logger=None,
+               diagnostics=None,
+               jobs=1,
+               memory=None,
+               max_memory=None,
+               style=None):
   """Format a single Fortran file and return the formatted code.
 
   Arguments:
@@ -47,21 +77,28 @@ def FormatFile(filename,
     is a diff if print_diff is True.
 
   Raises:
-    IOError    : raised if there was an error reading the file.
-    ValueError : raised if in_place and print_diff are both specified.
+    IOError           : raised if there was an error reading the file.
+    ValueError        : raised if in_place and print_diff are both specified.
+    MemoryBudgetError : raised if the file exceeds max_memory.
   """
   _CheckPythonVersion()
 
   if in_place and print_diff:
     raise ValueError('Cannot pass both in_place and print_diff.')
 
-  original_source, encoding = ReadFile(filename, logger)
+  with memory_profile.Phase(memory, filename, 'read'):
+    original_source, encoding = ReadFile(filename, logger)
 
   # Reformat code:
   reformatted_source, changed = FormatCode(original_source,
                                            filename=filename,
                                            lines=lines,
-                                           print_diff=print_diff)
+                                           print_diff=print_diff,
+                                           diagnostics=diagnostics,
+                                           jobs=jobs,
+                                           memory=memory,
+                                           max_memory=max_memory,
+                                           style=style)
   if in_place:
     if original_source:
       file_resources.WriteReformattedCode(filename, reformatted_source,
@@ -74,7 +111,12 @@ def FormatFile(filename,
 def FormatCode(unformatted_source,
                filename='<unknown>',
                lines=None,
-               print_diff=False):
+               print_diff=False,
+               diagnostics=None,
+               jobs=1,
+               memory=None,
+               max_memory=None,
+               style=None):
   """Format a string of Fortran code.
 
   This provides an alternative entry point to FORTRESS.
@@ -87,29 +129,133 @@ def FormatCode(unformatted_source,
   Returns:
     Tuple of (reformatted_source, changed). reformatted_source conforms to the
     desired formatting style. changed is True if the source changed.
+
+  Raises:
+    MemoryBudgetError : raised if the code exceeds max_memory.
   """
   _CheckPythonVersion()
 
+  style = fortress_style.GetStyle(style)
+
+  original_source = unformatted_source
   if not unformatted_source.endswith('\n'):
     unformatted_source += '\n'
 
+  lowMemory = max_memory is not None and \
+      memory_profile.Estimate(unformatted_source) > max_memory
+  if lowMemory:
+    needed = memory_profile.Estimate(unformatted_source,
+                                     parallel_reformatter.CHUNK_LINES)
+    if diagnostics is not None or needed > max_memory:
+      if memory:
+        memory.setMode(filename, memory_profile.SKIPPED)
+      raise memory_profile.MemoryBudgetError(
+          '{}: needs about {}, more than the memory budget of {}'.format(
+              filename, memory_profile.FormatSize(needed),
+              memory_profile.FormatSize(max_memory)))
+    if memory:
+      memory.setMode(filename, memory_profile.LOW_MEMORY)
+
   # Reformat:
-  Reform = reformatter.Reformatter(unformatted_source, lines)
-  Reform.reformat()
-  reformatted_source = Reform.generateCodeLines()
+  with memory_profile.Phase(memory, filename, 'tokenize'):
+    Reform = _CreateReformatter(unformatted_source, filename, lines,
+                                diagnostics is not None, jobs, lowMemory,
+                                style)
+  with memory_profile.Phase(memory, filename, 'reformat'):
+    Reform.reformat()
+  with memory_profile.Phase(memory, filename, 'generate'):
+    reformatted_source = Reform.generateCodeLines()
+
+  if diagnostics is not None:
+    diagnostics.extend(sorted(Reform.diagnostics,
+                              key=lambda m: (m.line, m.column)))
+  # release the tokenized lines before the diff needs its memory
+  del Reform
 
   if unformatted_source == reformatted_source:
-    return '' if print_diff else reformatted_source, False
+    if print_diff:
+      # the diff of the lines does not show an added line break
+      return '', False
+    return reformatted_source, reformatted_source != original_source
+
+  if not print_diff:
+    return reformatted_source, True
 
   # Diff:
-  code_diff = _GetUnifiedDiff(unformatted_source,
-                              reformatted_source,
-                              filename=filename)
+  with memory_profile.Phase(memory, filename, 'diff'):
+    code_diff = _GetUnifiedDiff(unformatted_source,
+                                reformatted_source,
+                                filename=filename)
+  return code_diff, code_diff != ''
+
 
-  if print_diff:
-    return code_diff, code_diff != ''
+def FormatCodeEdits(unformatted_source,
+                    filename='<unknown>',
+                    lines=None,
+                    jobs=1,
+                    style=None):
+  """Format a string of Fortran code into the edits to apply to it.
 
-  return reformatted_source, True
+  Editors apply the edits to their buffer instead of replacing all of it, see
+  text_edits for the JSON form of the edits.
+
+  Arguments:
+    unformatted_source  : (unicode) The code to format.
+    filename            : (unicode) The name of the file being reformatted.
+    remaining arguments : see comment at the top of this module.
+
+  Returns:
+    A list of text_edits.TextEdits in the order of the code, empty if the code
+    is formatted already. Applied to unformatted_source (see
+    text_edits.ApplyEdits), they give the reformatted code.
+  """
+  _CheckPythonVersion()
+
+  style = fortress_style.GetStyle(style)
+
+  source = unformatted_source
+  if not source.endswith('\n'):
+    source += '\n'
+  Reform = _CreateReformatter(source, filename, lines, False, jobs, False,
+                              style)
+  Reform.reformat()
+
+  # the code of both is the lines joined by line breaks
+  sourceLines = unformatted_source.split('\n')
+  formattedLines = list(Reform.generateLines())
+  edits = text_edits.LineEdits(sourceLines, formattedLines)
+  if len(formattedLines) > len(sourceLines):
+    # e.g. the line break missing at the end
+    end = len(sourceLines[-1]) + 1
+    edits.append(text_edits.TextEdit(
+        len(sourceLines), end, len(sourceLines), end,
+        '\n' + '\n'.join(formattedLines[len(sourceLines):])))
+  return edits
+
+
+def LintFile(filename, logger=None, style=None):
+  """Lint a single Fortran file with the built-in checks.
+
+  The checks run in the formatting pass, so no compiler is needed. They
+  report tabs, trailing whitespace, overlong lines, broken continuations and
+  unbalanced or mismatched blocks.
+
+  Arguments:
+    filename : (unicode) The file to lint.
+    logger   : (io streamer) A stream to output logging.
+    style    : see comment at the top of this module.
+
+  Returns:
+    A list of LintMessages sorted by line.
+
+  Raises:
+    IOError: raised if there was an error reading the file.
+  """
+  diagnostics = []
+  original_source, _ = ReadFile(filename, logger)
+  FormatCode(original_source, filename=filename, diagnostics=diagnostics,
+             style=style)
+  return diagnostics
 
 
 def ReadFile(filename, logger=None):
@@ -149,6 +295,22 @@ def ReadFile(filename, logger=None):
     raise
 
 
+def _CreateReformatter(source, filename, lines, lint, jobs, lowMemory, style):
+  """Returns the Reformatter of source, see FormatCode."""
+  if lowMemory or jobs > 1 and not lint and \
+      source.count('\n') >= parallel_reformatter.MIN_LINES:
+    return parallel_reformatter.ParallelReformatter(
+        source,
+        lines,
+        filename=filename,
+        jobs=1 if lowMemory else jobs,
+        style=style)
+  return reformatter.Reformatter(source, lines,
+                                 filename=filename,
+                                 lint=lint,
+                                 style=style)
+
+
 def _GetUnifiedDiff(before, after, filename='code'):
   """Get a unified diff of the changes.
 
@@ -2,36 +2,252 @@ __date__    = "$Date: 2016/02/17 $"
 __license__ = "MIT"
 __author__ = "Roland Siegbert <r@rscircus.org>"
 
-import subprocess
+import collections
+import locale
+import multiprocessing
+import os
 import re
+import shutil
+import subprocess
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+from fortress.lib import module_graph
+
+# Compiler used for linting unless specified otherwise
+DEFAULT_LINTER = "gfortran"
+
+# Name of the linter running the in-process checks of the formatter
+BUILTIN_LINTER = "builtin"
+
+# Flags which are always passed to the linter
+LINT_FLAGS = ['-fsyntax-only',  # perform syntax checks only
+              '-Wall',          # print all warnings
+              '-Wextra']
+
+# Location of a diagnostic ('file:line:col:'), the message may follow on the
+# same line.
+_LOCATION_RE = re.compile(r"^(?P<file>.+?):(?P<line>\d+):(?P<col>\d+):\s*(?P<rest>.*)$")
+
+# Kind and text of a diagnostic, possibly prefixed by the program name
+_MESSAGE_RE = re.compile(r"^(?:[^\s:]+:\s*)?(?P<type>Fatal Error|Error|Warning|Note):\s*(?P<message>.*)$")
+
+
+class LintMessage(collections.namedtuple('LintMessage',
+                                         'filename line column type message')):
+  """A single diagnostic of the linter.
+
+  Line and column are 1-based, they are 0 if the linter did not report a
+  location.
+  """
+  __slots__ = ()
+
+  def __str__(self):
+    return '{0}:{1}:{2}: {3}: {4}'.format(*self)
+
+
+def ParseDiagnostics(lines, filename):
+  """Parse the output of gfortran into LintMessages.
+
+  Arguments:
+    lines    : (iterable of unicode) The output of the linter, line by line.
+    filename : (unicode) The linted file, used if no location is reported.
+
+  Yields:
+    A LintMessage as soon as its message line was read.
+  """
+  location = None
+  for line in lines:
+    line = line.rstrip("\r\n")
+    match = _LOCATION_RE.match(line)
+    if match:
+      location = (match.group('file'),
+                  int(match.group('line')),
+                  int(match.group('col')))
+      line = match.group('rest')
+      if not line:
+        continue
+
+    match = _MESSAGE_RE.match(line)
+    if match:
+      msgFile, msgLine, msgCol = location or (filename, 0, 0)
+      yield LintMessage(msgFile, msgLine, msgCol,
+                        match.group('type'), match.group('message'))
+      location = None
+
 
 class FortranLinter:
   """Use gfortran as linter"""
-  def __init__(self, fileName):
+  def __init__(self, fileName, linter=DEFAULT_LINTER, flags=None,
+               moduleDir=None):
 
-    self.linter = "gfortran"
+    self.linter = linter
     self.fileName = fileName
+    self.flags = LINT_FLAGS + list(flags or [])
+    # directory to write and search module files
+    self.moduleDir = moduleDir
+
+  def command(self):
+    """Returns the command line used for linting."""
+    moduleFlags = ['-J', self.moduleDir] if self.moduleDir else []
+    return [self.linter] + self.flags + moduleFlags + [self.fileName]
 
   def lint(self):
-    p = subprocess.Popen([self.linter,
-                          '-fsyntax-only',  # perform syntax checks only
-                          '-Wall',          # print all warnings
-                          '-Wextra',
-                          self.fileName],
-                          stdout = subprocess.PIPE,
-                          stderr = subprocess.PIPE,
-                          stdin  = subprocess.PIPE)
-
-    # adding group names in Python style here => better identification
-    catchRe = "(.+):(?P<line>\\d+):(?P<col>\\d+):((.|\\n)*)(?P<type>(Error|Warning|Note)):\\s*(?P<message>.*)"
-
-    # execute linter:
-    stdOut, stdErr = p.communicate()
-    caughtIter = re.finditer(catchRe, stdErr)
-
-    # print errors:
-    for el in caughtIter:
-      print "Line:      " + el.group('line')
-      print "Column:    " + el.group('col')
-      print "Errortype: " + el.group('type')
-      print "Message:   " + el.group('message')
+    """Run the linter on the file.
+
+    The output is parsed while the linter is still running. It echoes
+    source lines, which need not be in the encoding of the locale, so
+    undecodable bytes are replaced.
+
+    Returns:
+      A list of LintMessages.
+
+    Raises:
+      OSError: raised if the linter could not be executed.
+    """
+    with open(os.devnull, 'r') as devnull:
+      p = subprocess.Popen(self.command(),
+                           stdout = subprocess.PIPE,
+                           stderr = subprocess.STDOUT,
+                           stdin  = devnull)
+      encoding = locale.getpreferredencoding(False)
+      try:
+        messages = list(ParseDiagnostics(
+            (line.decode(encoding, 'replace') for line in p.stdout),
+            self.fileName))
+      finally:
+        p.stdout.close()
+        p.wait()
+    return messages
+
+
+def _IncludeDirectories(flags):
+  """Returns the directories given by '-I DIR' or '-IDIR' in flags."""
+  directories = []
+  for i, flag in enumerate(flags):
+    if flag == '-I' and i + 1 < len(flags):
+      directories.append(flags[i + 1])
+    elif flag.startswith('-I') and len(flag) > 2:
+      directories.append(flag[2:])
+  return directories
+
+
+def LintFiles(filenames, jobs=None, linter=DEFAULT_LINTER, flags=None,
+              cache=None, moduleDir=None, uncached=(), dependencies=None):
+  """Lint several files concurrently.
+
+  Arguments:
+    filenames    : (list of unicode) The files to lint.
+    jobs         : (int) Maximal number of concurrently running linters.
+                   Defaults to the number of CPUs.
+    linter       : (unicode) The linter executable.
+    flags        : (list of unicode) Additional flags passed to the linter.
+    cache        : (LintCache) If given, results of unchanged files are
+                   replayed from the cache and new results are stored in it.
+    moduleDir    : (unicode) Directory to write and search module files.
+    uncached     : (set of unicode) Files which are linted even if cached,
+                   e.g. because their module files are needed.
+    dependencies : (dict) Filename to the set of files defining the modules
+                   it uses, directly or not. Their content, and that of the
+                   files included by them or the file, is part of the key of
+                   the cached results.
+
+  Yields:
+    Tuples of (filename, messages). Cached results come first, the others
+    in the order the linters finish.
+
+  Raises:
+    OSError: raised if the linter could not be executed.
+  """
+  if linter == BUILTIN_LINTER:
+    # no subprocesses needed, and fast enough to skip the cache
+    # (imported here as the formatter depends on this module)
+    from fortress.lib import fortress_api
+    for filename in filenames:
+      try:
+        messages = fortress_api.LintFile(filename)
+      except (IOError, OSError, UnicodeDecodeError, SyntaxError) as err:
+        # reported like the files gfortran cannot read
+        messages = [LintMessage(filename, 0, 0, 'Fatal Error', str(err))]
+      yield filename, messages
+    return
+
+  def lint(job):
+    filename, key = job
+    messages = FortranLinter(filename, linter, flags, moduleDir).lint()
+    if key:
+      cache.put(key, filename, messages)
+    return filename, messages
+
+  pending = []
+  includeDirs = _IncludeDirectories(LINT_FLAGS + list(flags or []))
+  for filename in filenames:
+    key = None
+    if cache and filename not in uncached:
+      modules = sorted((dependencies or {}).get(filename, ()))
+      keyDependencies = set(modules)
+      for f in [filename] + modules:
+        keyDependencies.update(module_graph.FindIncludes(f, includeDirs))
+      try:
+        key = cache.key(filename, linter,
+                        FortranLinter(filename, linter, flags).flags,
+                        keyDependencies)
+      except (IOError, OSError):
+        # leave it to the linter to report unreadable files
+        pass
+      else:
+        messages = cache.get(key, filename)
+        if messages is not None:
+          yield filename, messages
+          continue
+    pending.append((filename, key))
+
+  if pending:
+    pool = ThreadPool(jobs or multiprocessing.cpu_count())
+    try:
+      for result in pool.imap_unordered(lint, pending):
+        yield result
+    finally:
+      pool.terminate()
+
+
+def LintTree(filenames, jobs=None, linter=DEFAULT_LINTER, flags=None,
+             cache=None):
+  """Lint files in the order of their module dependencies.
+
+  Files are linted in waves (see module_graph.TopologicalWaves): the files
+  of a wave run concurrently, after all files defining modules they use.
+  The module files are written to a scratch directory, which is removed
+  afterwards.
+
+  Arguments:
+    see LintFiles.
+
+  Yields:
+    Tuples of (filename, messages), wave by wave.
+
+  Raises:
+    OSError: raised if the linter could not be executed.
+  """
+  if linter == BUILTIN_LINTER:
+    # the built-in checks do not need any modules
+    for result in LintFiles(filenames, linter=linter):
+      yield result
+    return
+
+  dependencies = module_graph.BuildDependencies(filenames)
+  # module files of these are needed by others
+  providers = set(dep for deps in dependencies.values() for dep in deps)
+  # the results of a file depend on the interfaces of the modules it uses
+  used = module_graph.TransitiveDependencies(dependencies)
+
+  moduleDir = tempfile.mkdtemp(prefix='fortress-mod-')
+  try:
+    for wave in module_graph.TopologicalWaves(dependencies):
+      for result in LintFiles(wave, jobs, linter, flags, cache,
+                              moduleDir=moduleDir, uncached=providers,
+                              dependencies=used):
+        yield result
+  finally:
+    shutil.rmtree(moduleDir, ignore_errors=True)
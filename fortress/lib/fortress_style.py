@@ -16,6 +16,44 @@ def SetGlobalStyle(style):
   global _style
   _style = style
 
+def GetGlobalStyle():
+  """Get the style dict, e.g. to set it in another process."""
+  return _style
+
+def GetStyle(style=None):
+  """Get style as a Style, the global style if None."""
+  if style is None:
+    style = _style
+  return style if isinstance(style, Style) else Style(style)
+
+class Style(dict):
+  """An immutable, hashable style.
+
+  Styles are passed along with the code to format (see fortress_api), so the
+  code of different threads can be formatted with different styles at the
+  same time. The global style is only the default.
+  """
+  __slots__ = ()
+
+  def _readOnly(self, *args, **kwargs):
+    raise TypeError('a Style is immutable, use replace()')
+
+  __setitem__ = __delitem__ = __ior__ = _readOnly
+  clear = pop = popitem = setdefault = update = _readOnly
+
+  def __hash__(self):
+    return hash(frozenset(self.items()))
+
+  def __reduce__(self):
+    return Style, (dict(self),)
+
+  def __repr__(self):
+    return 'Style(%s)' % dict.__repr__(self)
+
+  def replace(self, **settings):
+    """Get a copy of the style with some settings changed."""
+    return Style(self, **settings)
+
 def CreateFortran2003Style():
   return dict(
     INDENT_WIDTH=4,
@@ -23,6 +61,7 @@ def CreateFortran2003Style():
     UNINDENT_PREPROCESSOR_DIRECTIVES=True,
     REPLACE_TABS_BY_SPACES=True,
     CONVERT_FIXED_TO_FREE=False,
+    DETECT_SOURCE_FORM=True,
     ADD_SPACES_AROUND_OPERATORS=False,
     FIX_LINE_ENDINGS=True,
     ADD_REMARKS=False,
@@ -36,6 +75,7 @@ def CreateStrictStyle():
     UNINDENT_PREPROCESSOR_DIRECTIVES=True,
     REPLACE_TABS_BY_SPACES=True,
     CONVERT_FIXED_TO_FREE=False,
+    DETECT_SOURCE_FORM=True,
     ADD_SPACES_AROUND_OPERATORS=True,
     FIX_LINE_ENDINGS=True,
     ADD_REMARKS=False,
@@ -91,6 +131,7 @@ _STYLE_CONVERTER = dict(
   UNINDENT_PREPROCESSOR_DIRECTIVES=_BoolConverter,
   REPLACE_TABS_BY_SPACES=_BoolConverter,
   CONVERT_FIXED_TO_FREE=_BoolConverter,
+  DETECT_SOURCE_FORM=_BoolConverter,
   ADD_SPACES_AROUND_OPERATORS=_BoolConverter,
   FIX_LINE_ENDINGS=_BoolConverter,
   ADD_REMARKS=_BoolConverter,
@@ -0,0 +1,97 @@
+"""Read the staged content of Fortran files from git.
+
+A pre-commit hook has to check the content in the index, which may differ
+from the working tree. Instead of extracting every staged file (e.g. with
+'git show :path' into a temporary file), the blobs of all staged files are
+streamed through a single 'git cat-file --batch' process.
+"""
+
+import fnmatch
+import subprocess
+import sys
+
+from fortress.lib import file_resources
+
+
+def _Git(arguments):
+  """Returns the output of a git command.
+
+  Raises:
+    IOError: git failed, with its error message.
+  """
+  process = subprocess.Popen(['git'] + arguments,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+  output, errors = process.communicate()
+  if process.returncode:
+    raise IOError(errors.decode('utf-8', 'replace').strip())
+  return output
+
+
+def StagedFiles(exclude=None):
+  """Returns the Fortran files added, copied, modified or renamed in the index.
+
+  Arguments:
+    exclude : (list of unicode) Patterns of files to skip.
+
+  Returns:
+    A list of tuples (path, blob id), paths are relative to the top of the
+    repository.
+
+  Raises:
+    IOError: not in a git repository.
+    OSError: git is not installed.
+  """
+  # 'git diff' falls back to comparing files outside of repositories
+  _Git(['rev-parse', '--git-dir'])
+  fields = _Git(['diff', '--cached', '--raw', '-z', '--no-abbrev',
+                 '--diff-filter=ACMR']).split(b'\0')
+  staged = []
+  i = 0
+  while i + 1 < len(fields):
+    # ':<old mode> <new mode> <old id> <new id> <status>', then the path, or
+    # the old and the new path of renames and copies
+    _, mode, _, blob, status = fields[i].split()
+    i += 3 if status[:1] in (b'R', b'C') else 2
+    path = fields[i - 1].decode(sys.getfilesystemencoding())
+    # regular files only, no symbolic links or submodules
+    if not mode.startswith(b'100'):
+      continue
+    if exclude and any(fnmatch.fnmatch(path, p) for p in exclude):
+      continue
+    if file_resources.IsFortranOrHeaderName(path):
+      staged.append((path, blob.decode('ascii')))
+  return staged
+
+
+def ReadBlobs(blobs):
+  """Read blobs from the object database of git.
+
+  Arguments:
+    blobs : (iterable of str) Ids of the blobs.
+
+  Yields:
+    The content of every blob (bytes), in the given order.
+
+  Raises:
+    IOError: a blob is missing.
+  """
+  process = subprocess.Popen(['git', 'cat-file', '--batch'],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+  try:
+    for blob in blobs:
+      # the output is flushed after every object
+      process.stdin.write(blob.encode('ascii') + b'\n')
+      process.stdin.flush()
+      header = process.stdout.readline().split()
+      if len(header) != 3:
+        raise IOError('git cat-file: ' + b' '.join(header).decode('ascii'))
+      content = process.stdout.read(int(header[2]))
+      # newline behind the content
+      process.stdout.read(1)
+      yield content
+  finally:
+    process.stdin.close()
+    process.stdout.close()
+    process.wait()
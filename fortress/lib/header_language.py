@@ -0,0 +1,91 @@
+"""Tell Fortran include files from C headers, which share the extension '.h'.
+
+Mixed C and Fortran trees have many more C headers than Fortran includes, and
+formatting a C header as Fortran damages it. The language is guessed from the
+first SNIFF_BYTES of the file, so it costs next to nothing: every line is
+evidence for C or for Fortran, or neither.
+
+  * comments with '/*' or '//', braces, statements ending with ';',
+    declarations like 'typedef' or 'struct', '#include <...>', '#pragma' and
+    '#define's with C syntax only exist in C,
+  * comments with '!' or 'c' in column 1, lines continued with '&' and
+    statements like 'integer', 'parameter' or 'common' only exist in Fortran.
+
+Block comments of C are skipped. Without more evidence for Fortran than for
+C, the file is taken as a C header and left alone.
+"""
+
+import re
+
+# Number of leading bytes looked at
+SNIFF_BYTES = 4096
+
+# Declarations and directives which only exist in C and C++
+_C_START_RE = re.compile(
+    r"(?:#\s*(?:include\s*<|pragma\b|if(?:def)?\s+(?:defined\s*\(?\s*)?"
+    r"__cplusplus)|(?:typedef|struct|union|extern|static|inline|void|"
+    r"unsigned|signed|const|class|namespace|template)\b)", re.IGNORECASE)
+
+# Macros with C syntax: hexadecimal literals, C operators, sizeof and casts
+_C_DEFINE_RE = re.compile(
+    r"#\s*define\s.*(?:\b0x[0-9a-f]|->|<<|>>|\bsizeof\b|"
+    r"\(\s*(?:unsigned|int|long|char|void|size_t)\b)", re.IGNORECASE)
+
+# Statements found in Fortran include files
+_FORTRAN_START_RE = re.compile(
+    r"(?:integer|real|double\s*precision|complex|logical|character|"
+    r"parameter|common|data|dimension|equivalence|implicit|external|"
+    r"intrinsic|save|include\s*['\"]|use|type|interface|end|module|"
+    r"subroutine|function|procedure|namelist|enumerator)\b", re.IGNORECASE)
+
+
+def _LineEvidence(line):
+  """Returns +1 if line indicates Fortran, -1 for C, 0 otherwise."""
+  stripped = line.strip()
+  if not stripped:
+    return 0
+  if stripped[0] == '!':
+    return 1
+  if line[0] in 'cC' and (len(line) == 1 or line[1] in ' \t'):
+    # fixed-form comment
+    return 1
+  if stripped[0] == '#':
+    return -1 if _C_START_RE.match(stripped) or \
+        _C_DEFINE_RE.match(stripped) else 0
+  if stripped.startswith('//') or _C_START_RE.match(stripped) or \
+      stripped[-1] == ';' or '{' in stripped or '}' in stripped:
+    return -1
+  if stripped[-1] == '&' or _FORTRAN_START_RE.match(stripped):
+    return 1
+  return 0
+
+
+def IsFortranHeader(head):
+  """Return True if a header file is Fortran, not C.
+
+  Arguments:
+    head : (bytes or unicode) The beginning of the file, only the first
+           SNIFF_BYTES are looked at.
+  """
+  truncated = len(head) > SNIFF_BYTES
+  head = head[:SNIFF_BYTES]
+  if isinstance(head, bytes):
+    # the markers are ASCII
+    head = head.decode('latin-1')
+  lines = head.split('\n')
+  if truncated:
+    # the last line is cut off
+    lines.pop()
+
+  evidence = 0
+  inComment = False
+  for line in lines:
+    if inComment:
+      inComment = '*/' not in line
+      continue
+    if line.lstrip().startswith('/*'):
+      evidence -= 1
+      inComment = '*/' not in line.lstrip()[2:]
+      continue
+    evidence += _LineEvidence(line.rstrip())
+  return evidence > 0
@@ -0,0 +1,150 @@
+"""Isolate the files of a batch run from each other.
+
+A file which cannot be formatted must not stop a run over many files: a
+BatchRunner records the failure with its reason and the run goes on with the
+next file. A file can also stall a run, e.g. by heavy backtracking of a
+regular expression. With a timeout, files are therefore formatted in a worker
+process, which is killed when a file takes longer, and replaced by a new one
+for the next file. The worker runs in a process group of its own, so the
+processes of a huge file (see parallel_reformatter) are killed with it.
+
+The summary of a run lists the failed files and the slowest ones.
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+
+from fortress.lib import fortress_style
+
+# Files taking at least this many seconds are listed as slow
+SLOW_SECONDS = 1.0
+
+# Number of slow files listed
+MAX_SLOW = 10
+
+
+def _Serve(connection, style):
+  """Main loop of a worker: call the functions sent through connection."""
+  if hasattr(os, 'setpgrp'):
+    os.setpgrp()
+  fortress_style.SetGlobalStyle(style)
+  while True:
+    try:
+      function, args, kwargs = connection.recv()
+    except EOFError:
+      return
+    try:
+      result = (True, function(*args, **kwargs))
+    except Exception as e:  # pylint: disable=broad-except
+      result = (False, _Reason(e))
+    connection.send(result)
+
+
+def _Reason(error):
+  """Returns the reason of a failure for the summary."""
+  return '{}: {}'.format(type(error).__name__, error)
+
+
+class _Worker:
+  """A worker process, see _Serve."""
+
+  def __init__(self):
+    self.connection, child = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(
+        target=_Serve, args=(child, fortress_style.GetGlobalStyle()))
+    self.process.start()
+    child.close()
+
+  def call(self, function, args, kwargs, timeout):
+    """Call function in the worker.
+
+    Returns:
+      Tuple of (succeeded, result or reason of the failure). The worker is
+      unusable if None instead of succeeded, and has to be killed.
+    """
+    try:
+      self.connection.send((function, args, kwargs))
+      if not self.connection.poll(timeout):
+        return None, 'timed out after {:g}s'.format(timeout)
+      return self.connection.recv()
+    except (EOFError, IOError, OSError):
+      self.process.join(1)
+      return None, 'worker died (exit code {})'.format(self.process.exitcode)
+
+  def kill(self):
+    self.connection.close()
+    try:
+      os.killpg(self.process.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+      # no process groups, or the worker did not create its own yet
+      self.process.terminate()
+    self.process.join()
+
+
+class BatchRunner:
+  """Runs the formatting of files, see the module documentation."""
+
+  def __init__(self, timeout=None):
+    """
+    Arguments:
+      timeout : (float) Seconds a file may take. If None, files are formatted
+                in this process, without a time limit.
+    """
+    self.timeout = timeout
+    self.worker = None
+    # (filename, reason)
+    self.failed = []
+    # (seconds, filename)
+    self.timings = []
+
+  def run(self, filename, function, *args, **kwargs):
+    """Returns function(*args, **kwargs), formatting filename.
+
+    Returns None and records the reason if the function raised an exception
+    or took longer than the timeout.
+    """
+    start = time.time()
+    try:
+      if self.timeout is None:
+        try:
+          return function(*args, **kwargs)
+        except Exception as e:  # pylint: disable=broad-except
+          self.failed.append((filename, _Reason(e)))
+          return None
+
+      if self.worker is None:
+        self.worker = _Worker()
+      succeeded, result = self.worker.call(function, args, kwargs,
+                                           self.timeout)
+      if succeeded is None:
+        self.worker.kill()
+        self.worker = None
+      if not succeeded:
+        self.failed.append((filename, result))
+        return None
+      return result
+    finally:
+      self.timings.append((time.time() - start, filename))
+
+  def close(self):
+    """Stop the worker process."""
+    if self.worker is not None:
+      self.worker.kill()
+      self.worker = None
+
+  def writeSummary(self, stream):
+    """Write the failed and the slow files, if any."""
+    if self.failed:
+      stream.write('fortress: {} of {} files failed:\n'.format(
+          len(self.failed), len(self.timings)))
+      for filename, reason in self.failed:
+        stream.write('  {}: {}\n'.format(filename, reason))
+
+    slow = sorted((t for t in self.timings if t[0] >= SLOW_SECONDS),
+                  reverse=True)
+    if slow:
+      stream.write('fortress: slowest files:\n')
+      for seconds, filename in slow[:MAX_SLOW]:
+        stream.write('  {}: {:.1f}s\n'.format(filename, seconds))
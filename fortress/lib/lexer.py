@@ -0,0 +1,123 @@
+"""Lexer for the code part of Fortran lines.
+
+The code of a line (see UnwrappedLine.tokenize) is split once into a tuple of
+tokens, which all passes of the formatter work on. A token is its text,
+lower-cased and interned, without the whitespace around it; so the tokens of a
+line take little memory and are compared with keywords directly, e.g.
+tokens[0] == "do" or "function" in tokens.
+
+Kinds of tokens, see Kind:
+
+  NAME        : identifiers and keywords.
+  LITERAL     : numbers and the logical constants .true. and .false.
+  STRING      : character literals, including their quotes.
+  OPEN_STRING : character literal continued on the next line.
+  OPERATOR    : operators and punctuation, e.g. '(', '**', '.and.' or '::'.
+
+Character literals are single tokens, so their contents are never looked at
+again and cannot be mistaken for keywords (a token 'if' is never part of a
+string). A backslash escapes the character following it, as in
+UnwrappedLine.tokenize.
+
+Words are runs of word characters, as delimited by '\\b' in regular
+expressions: '2if' is a single NAME, not a number followed by 'if'.
+
+The positions of the tokens are only needed to rewrite the code, Spans
+computes them on demand.
+"""
+
+import re
+
+from fortress.lib import py3compat
+
+# Kinds of tokens
+NAME = 'name'
+LITERAL = 'literal'
+STRING = 'string'
+OPEN_STRING = 'open string'
+OPERATOR = 'operator'
+
+_LOGICAL_CONSTANTS = ('.true.', '.false.')
+
+_LITERAL = r"(?:\d+(?:\.(?![a-z]+\.)\d*)?|\.\d+)(?:[deq][+-]?\d+)?(?:_\w+)?"
+
+_TOKEN_RE = re.compile(r"""
+  \s*(
+    "(?:[^"\\]|\\.)*(?:"|\\)?
+  | '(?:[^'\\]|\\.)*(?:'|\\)?
+  | """ + _LITERAL + r"""(?!\w)
+  | \w+
+  | \.[a-z]+\.|\*\*|//|==|/=|<=|>=|=>|::|[^\w\s]
+  )""", re.IGNORECASE | re.VERBOSE | re.DOTALL)
+
+_LITERAL_RE = re.compile(_LITERAL + r"\Z", re.IGNORECASE)
+
+# Terminated character literals
+_STRING_RE = {
+  '"': re.compile(r'"(?:[^"\\]|\\.)*"\Z', re.DOTALL),
+  "'": re.compile(r"'(?:[^'\\]|\\.)*'\Z", re.DOTALL),
+}
+
+# Rest of a character literal begun on a previous line, per quote
+_STRING_REST_RE = {
+  '"': re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL),
+  "'": re.compile(r"(?:[^'\\]|\\.)*'", re.DOTALL),
+}
+
+# Shared result for lines without code
+_NO_TOKENS = ()
+
+
+def Lex(code, quote=None):
+  """Split the code of a line into tokens.
+
+  Arguments:
+    code  : (unicode) The code, without label, continuation marks and
+            comment.
+    quote : (unicode) If given, code begins inside a character literal
+            delimited by quote (continued from the previous line). The
+            first token is this literal, with the quote prepended.
+
+  Returns:
+    A tuple of tokens.
+  """
+  if not code:
+    return _NO_TOKENS
+  intern = py3compat.intern
+  if quote:
+    match = _STRING_REST_RE[quote].match(code)
+    if not match:
+      return (intern(quote + code.lower()),)
+    return (intern(quote + match.group().lower()),) + \
+        tuple(map(intern, _TOKEN_RE.findall(code.lower(), match.end())))
+  return tuple(map(intern, _TOKEN_RE.findall(code.lower())))
+
+
+def Spans(code, quote=None):
+  """Returns the positions of the tokens Lex finds in code.
+
+  Returns:
+    A list of tuples (start, end), one per token, indexing code.
+  """
+  spans = []
+  pos = 0
+  if code and quote:
+    match = _STRING_REST_RE[quote].match(code)
+    if not match:
+      return [(0, len(code))]
+    spans.append((0, match.end()))
+    pos = match.end()
+  spans.extend(match.span(1) for match in _TOKEN_RE.finditer(code, pos))
+  return spans
+
+
+def Kind(token):
+  """Returns the kind of a token, see the module documentation."""
+  c = token[0]
+  if c == '"' or c == "'":
+    return STRING if _STRING_RE[c].match(token) else OPEN_STRING
+  if token in _LOGICAL_CONSTANTS or _LITERAL_RE.match(token):
+    return LITERAL
+  if c == '_' or c.isalnum():
+    return NAME
+  return OPERATOR
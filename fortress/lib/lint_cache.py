@@ -0,0 +1,175 @@
+"""Content-addressed cache of lint results.
+
+Linting a file which did not change since the last run gives the same
+diagnostics again, so they are stored on disk and replayed instead of
+starting the linter. An entry is keyed by
+
+  * the content of the file,
+  * the extension of the file, which selects the source form (and whether
+    the file is preprocessed, e.g. '.F90'),
+  * the linter executable and its version,
+  * the exact list of flags passed to the linter,
+  * the content of the files it depends on: the files defining the modules it
+    uses, directly or not, and the files they and the file include.
+
+Every entry is a small JSON file named after its key. The cache is bounded
+in number of entries and total size; when it grows beyond that, the least
+recently used entries are evicted.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+
+from fortress.lib import fortress_linter
+
+# Bounds of the cache
+MAX_ENTRIES = 20000
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def DefaultCacheDirectory():
+  """Returns the per-user cache directory for lint results."""
+  base = os.environ.get('XDG_CACHE_HOME') \
+      or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'fortress', 'lint')
+
+
+class LintCache:
+  """Lint results stored in a directory."""
+
+  def __init__(self, directory, maxEntries=MAX_ENTRIES, maxBytes=MAX_BYTES):
+    self.directory = directory
+    self.maxEntries = maxEntries
+    self.maxBytes = maxBytes
+    self.versions = {}
+    # path -> digest of the content, of the dependencies of this run
+    self.digests = {}
+
+  def linterVersion(self, linter):
+    """Returns the first line of 'linter --version', remembered per linter."""
+    if linter not in self.versions:
+      try:
+        with open(os.devnull, 'r') as devnull:
+          output = subprocess.check_output([linter, '--version'],
+                                           stdin=devnull,
+                                           stderr=subprocess.STDOUT,
+                                           universal_newlines=True)
+        self.versions[linter] = output.split("\n", 1)[0]
+      except (OSError, subprocess.CalledProcessError):
+        self.versions[linter] = ""
+    return self.versions[linter]
+
+  def contentDigest(self, filename):
+    """Returns the digest of the content of a dependency, read once per run.
+
+    Raises:
+      IOError: raised if the file cannot be read.
+    """
+    if filename not in self.digests:
+      digest = hashlib.sha256()
+      with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 16), b''):
+          digest.update(chunk)
+      self.digests[filename] = digest.digest()
+    return self.digests[filename]
+
+  def key(self, filename, linter, flags, dependencies=()):
+    """Compute the key of the lint results of a file.
+
+    Arguments:
+      filename     : (unicode) The file to lint.
+      linter       : (unicode) The linter executable.
+      flags        : (list of unicode) All flags passed to the linter.
+      dependencies : (list of unicode) The files the results depend on as
+                     well, see the module documentation.
+
+    Returns:
+      The key as hex string.
+
+    Raises:
+      IOError: raised if a file cannot be read.
+    """
+    digest = hashlib.sha256()
+    extension = os.path.splitext(filename)[1]
+    for part in [extension, linter, self.linterVersion(linter)] + list(flags):
+      digest.update(part.encode('utf-8'))
+      digest.update(b'\0')
+    with open(filename, 'rb') as fd:
+      for chunk in iter(lambda: fd.read(1 << 16), b''):
+        digest.update(chunk)
+    for dependency in sorted(dependencies):
+      digest.update(b'\0')
+      digest.update(self.contentDigest(dependency))
+    return digest.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key + '.json')
+
+  def get(self, key, filename):
+    """Look up the lint results of a file.
+
+    Arguments:
+      key      : (unicode) The key computed by key().
+      filename : (unicode) The name of the linted file.
+
+    Returns:
+      A list of LintMessages or None if there is no entry.
+    """
+    path = self._path(key)
+    try:
+      with open(path) as fd:
+        entry = json.load(fd)
+      # mark as recently used
+      os.utime(path, None)
+    except (IOError, OSError, ValueError):
+      return None
+    return [fortress_linter.LintMessage(msgFile or filename, *fields)
+            for msgFile, fields in ((m[0], m[1:]) for m in entry['messages'])]
+
+  def put(self, key, filename, messages):
+    """Store the lint results of a file.
+
+    Messages about the linted file itself are stored without its name, so
+    they can be replayed for a copy with the same content.
+    """
+    path = self._path(key)
+    entry = dict(messages=[[None if m.filename == filename else m.filename,
+                            m.line, m.column, m.type, m.message]
+                           for m in messages])
+    try:
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      # write to a temporary file first, so readers never see partial entries
+      fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path))
+      with os.fdopen(fd, 'w') as tmpFile:
+        json.dump(entry, tmpFile)
+      os.rename(tmpPath, path)
+    except (IOError, OSError):
+      # the cache is an optimization only
+      pass
+
+  def prune(self):
+    """Evict the least recently used entries until the cache is in bounds."""
+    entries = []
+    for dirpath, _, filelist in os.walk(self.directory):
+      for f in filelist:
+        path = os.path.join(dirpath, f)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    totalBytes = sum(size for _, size, _ in entries)
+    entries.sort()
+    for count, (_, size, path) in enumerate(entries):
+      if len(entries) - count <= self.maxEntries and totalBytes <= self.maxBytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      totalBytes -= size
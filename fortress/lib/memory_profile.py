@@ -0,0 +1,164 @@
+"""Measure and bound the memory used to format files.
+
+A MemoryReport records the peak memory allocated by Python (as traced by
+tracemalloc) in every phase of formatting a file, see PHASES. Peaks are
+relative to the memory allocated before the file, i.e. what the file needs on
+top of what fortress holds anyway. Worker processes of huge files (see
+parallel_reformatter) are not traced.
+
+A budget keeps huge files from exhausting the memory of a shared machine.
+The memory needed to format a file grows linearly with its lines and bytes,
+mostly for the UnwrappedLine of every line; Estimate computes it before the
+file is tokenized. Files above the budget are reformatted in chunks with a
+single job (see parallel_reformatter), which only keeps the small BlockLines
+of all lines, or refused with a MemoryBudgetError if even that does not fit.
+"""
+
+import collections
+import contextlib
+import re
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None  # Python 2
+
+# Phases of formatting a file:
+#   read     : reading and decoding the file.
+#   tokenize : splitting the code into lines (creating the Reformatter).
+#   reformat : Reformatter.reformat().
+#   generate : joining the reformatted lines.
+#   diff     : the diff of the original and the reformatted code.
+PHASES = ('read', 'tokenize', 'reformat', 'generate', 'diff')
+
+# Modes of formatting a file
+NORMAL = 'normal'
+LOW_MEMORY = 'low-memory'
+SKIPPED = 'skipped'
+
+# Bytes of memory per line and per byte of the code, fitted with some margin
+# on generated sources (see benchmarks.corpus) of both forms and styles
+_BYTES_PER_LINE = 800
+_BYTES_PER_BYTE = 5
+
+# The same in low-memory mode, plus the chunk being reformatted
+_CHUNKED_BYTES_PER_LINE = 450
+_CHUNKED_BYTES_PER_BYTE = 2
+
+_SIZE_RE = re.compile(r'(\d+(?:\.\d*)?)\s*([kmgt]?)i?b?\Z', re.IGNORECASE)
+
+_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+class MemoryBudgetError(Exception):
+  """Formatting a file would need more memory than the budget."""
+
+
+def ParseSize(text):
+  """Parse a size like '512M', '2G' or '1048576' (bytes).
+
+  Returns:
+    The size in bytes.
+
+  Raises:
+    ValueError: text is not a size.
+  """
+  match = _SIZE_RE.match(text.strip())
+  if not match:
+    raise ValueError('invalid size: ' + text)
+  return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def FormatSize(size):
+  """Returns a size in bytes as a readable text, e.g. '1.5 GiB'."""
+  for unit in ('B', 'KiB', 'MiB', 'GiB'):
+    if size < 1024:
+      break
+    size /= 1024.0
+  else:
+    unit = 'TiB'
+  return '%.1f %s' % (size, unit) if unit != 'B' else '%d B' % size
+
+
+def Estimate(source, chunkLines=None):
+  """Estimate the memory needed to format source.
+
+  Arguments:
+    source     : (unicode) The code to format.
+    chunkLines : (int) Estimate the low-memory mode, with chunks of this many
+                 lines (see parallel_reformatter.CHUNK_LINES).
+
+  Returns:
+    The memory in bytes.
+  """
+  lines = source.count('\n') + 1
+  if chunkLines is None or lines <= chunkLines:
+    return lines * _BYTES_PER_LINE + len(source) * _BYTES_PER_BYTE
+
+  # a chunk is formatted like a file of its own
+  return lines * _CHUNKED_BYTES_PER_LINE + \
+      len(source) * _CHUNKED_BYTES_PER_BYTE + \
+      chunkLines * _BYTES_PER_LINE + \
+      len(source) * chunkLines // lines * _BYTES_PER_BYTE
+
+
+class MemoryReport:
+  """Peak memory per file and phase, see the module documentation.
+
+  Tracing starts with the report and slows formatting down, stop it with
+  close().
+  """
+
+  def __init__(self):
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+      raise RuntimeError('memory reports need Python 3.9 or later')
+    # filename -> [mode, memory before the file, {phase: peak}]
+    self.files = collections.OrderedDict()
+    tracemalloc.start()
+
+  def close(self):
+    tracemalloc.stop()
+
+  def setMode(self, filename, mode):
+    """Record the mode filename is formatted in."""
+    self._file(filename)[0] = mode
+
+  def _file(self, filename):
+    if filename not in self.files:
+      self.files[filename] = [NORMAL, tracemalloc.get_traced_memory()[0], {}]
+    return self.files[filename]
+
+  @contextlib.contextmanager
+  def phase(self, filename, name):
+    """Context of a phase of formatting filename."""
+    entry = self._file(filename)
+    tracemalloc.reset_peak()
+    try:
+      yield
+    finally:
+      peak = tracemalloc.get_traced_memory()[1] - entry[1]
+      entry[2][name] = max(peak, entry[2].get(name, 0))
+
+  def write(self, stream):
+    """Write the report as a table, in MiB."""
+    stream.write('Peak memory in MiB per file and phase:\n')
+    width = max([len(f) for f in self.files] + [len('file')])
+    stream.write('%-*s' % (width, 'file') +
+                 ''.join('%10s' % p for p in PHASES + ('peak',)) +
+                 '  mode\n')
+    for filename, (mode, _, peaks) in self.files.items():
+      cells = [('%10.1f' % (peaks[p] / 1048576.0)) if p in peaks
+               else '%10s' % '-' for p in PHASES]
+      stream.write('%-*s' % (width, filename) + ''.join(cells) +
+                   '%10.1f' % (max(peaks.values() or [0]) / 1048576.0) +
+                   '  ' + mode + '\n')
+
+
+@contextlib.contextmanager
+def Phase(report, filename, name):
+  """Record a phase of formatting filename in report, if not None."""
+  if report is None:
+    yield
+  else:
+    with report.phase(filename, name):
+      yield
@@ -0,0 +1,221 @@
+"""Module dependencies between Fortran sources.
+
+A file which USEs a module can only be compiled (or linted) after the file
+defining that module, because the compiler needs the module file. The
+sources are scanned once with a few cheap patterns for 'module', 'submodule'
+and 'use' statements, and ordered into waves:
+
+  * every file depends only on files of earlier waves,
+  * files within a wave are independent of each other.
+
+Included files (Fortran 'include' lines and '#include' directives) are found
+as well, e.g. to tell whether the lint results of a file are still valid.
+"""
+
+import logging
+import os
+import re
+
+from fortress.lib import py3compat
+
+# 'module <name>', but not 'module procedure' or 'module function' etc.
+_MODULE_RE = re.compile(
+    r"(?i)^\s*(?:\d+\s+)?module\s+(?!(?:procedure|function|subroutine|pure|"
+    r"elemental|recursive|impure)\b)(\w+)\s*(?:!.*)?$")
+
+# 'submodule (<ancestor>[:<parent>]) <name>'
+_SUBMODULE_RE = re.compile(
+    r"(?i)^\s*(?:\d+\s+)?submodule\s*\(\s*(\w+)\s*(?::\s*(\w+)\s*)?\)\s*(\w+)")
+
+# 'use [[, intrinsic|non_intrinsic] ::] <name>'
+_USE_RE = re.compile(
+    r"(?i)^\s*(?:\d+\s+)?use\b\s*(?:,\s*(intrinsic|non_intrinsic)\s*)?(?:::)?\s*(\w+)")
+
+# "include 'file'" or '#include "file"' ('<file>' is searched in the include
+# directories only)
+_INCLUDE_RE = re.compile(
+    r"""(?i)^\s*(?:(?:\d+\s+)?include\s*(['"])(.+?)\1|#\s*include\s*(?:"(.+?)"|<(.+?)>))""")
+
+# Modules provided by the compiler
+INTRINSIC_MODULES = frozenset(['iso_c_binding', 'iso_fortran_env',
+                               'ieee_arithmetic', 'ieee_exceptions',
+                               'ieee_features', 'omp_lib', 'omp_lib_kinds',
+                               'openacc'])
+
+
+def ScanSource(lines):
+  """Scan source lines for the modules they provide and require.
+
+  Submodules are named 'ancestor:name', as their descendants refer to them.
+
+  Arguments:
+    lines: (iterable of unicode) The source code, line by line.
+
+  Returns:
+    Tuple of two sets (provided, required) of lower-case module names.
+  """
+  provided = set()
+  required = set()
+  for line in lines:
+    # cheap rejection of all other statements
+    lowered = line.lstrip(" \t0123456789")[:10].lower()
+    if lowered.startswith('use'):
+      match = _USE_RE.match(line)
+      if match and (match.group(1) or '').lower() != 'intrinsic':
+        name = match.group(2).lower()
+        if match.group(1) or name not in INTRINSIC_MODULES:
+          required.add(name)
+    elif lowered.startswith('module'):
+      match = _MODULE_RE.match(line)
+      if match:
+        provided.add(match.group(1).lower())
+    elif lowered.startswith('submodule'):
+      match = _SUBMODULE_RE.match(line)
+      if match:
+        ancestor, parent, name = [g.lower() if g else g for g in match.groups()]
+        required.add(ancestor + ':' + parent if parent else ancestor)
+        provided.add(ancestor + ':' + name)
+  return provided, required - provided
+
+
+def ScanFile(filename):
+  """Scan a file for the modules it provides and requires (see ScanSource)."""
+  with py3compat.open_with_encoding(filename, mode='r',
+                                    encoding='latin-1') as fd:
+    return ScanSource(fd)
+
+
+def FindIncludes(filename, includeDirs=()):
+  """Find the files included by a file, directly or not.
+
+  Like gfortran, a quoted name is looked up in the directory of the including
+  file first, then in includeDirs. Includes which are not found are ignored,
+  it is left to the compiler to report them.
+
+  Arguments:
+    filename    : (unicode) The including file.
+    includeDirs : (list of unicode) Directories to search ('-I').
+
+  Returns:
+    A sorted list of the paths of the included files.
+  """
+  found = set()
+  pending = [filename]
+  while pending:
+    including = pending.pop()
+    try:
+      with py3compat.open_with_encoding(including, mode='r',
+                                        encoding='latin-1') as fd:
+        # cheap rejection of all other lines
+        matches = [_INCLUDE_RE.match(line) for line in fd
+                   if line.lstrip(" \t0123456789")[:7].lower() == 'include'
+                   or line.lstrip()[:1] == '#']
+    except (IOError, OSError):
+      continue
+    for match in matches:
+      if not match:
+        continue
+      name = match.group(2) or match.group(3)
+      directories = list(includeDirs)
+      if name:
+        directories.insert(0, os.path.dirname(including))
+      else:
+        name = match.group(4)
+      for directory in directories:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+          if path not in found and path != filename:
+            found.add(path)
+            pending.append(path)
+          break
+  return sorted(found)
+
+
+def BuildDependencies(filenames):
+  """Find the dependencies between files.
+
+  Modules which are not provided by any of the files are assumed to exist
+  already and are ignored. Unreadable files have no dependencies, it is
+  left to the compiler to report them.
+
+  Arguments:
+    filenames: (list of unicode) The files to consider.
+
+  Returns:
+    Dict mapping each filename to the set of filenames it depends on.
+  """
+  providers = {}
+  requirements = {}
+  for filename in filenames:
+    try:
+      provided, required = ScanFile(filename)
+    except (IOError, OSError):
+      provided, required = set(), set()
+    requirements[filename] = required
+    for name in provided:
+      providers[name] = filename
+
+  return dict((filename, set(providers[name] for name in required
+                             if name in providers) - set([filename]))
+              for filename, required in requirements.items())
+
+
+def TransitiveDependencies(dependencies):
+  """Find the files every file depends on, directly or not.
+
+  Arguments:
+    dependencies: (dict) Filename to the set of filenames it depends on, as
+      returned by BuildDependencies.
+
+  Returns:
+    Dict mapping each filename to the set of filenames it depends on.
+  """
+  closure = {}
+  for filename in dependencies:
+    reached = set()
+    pending = list(dependencies[filename])
+    while pending:
+      dep = pending.pop()
+      if dep not in reached and dep != filename:
+        reached.add(dep)
+        pending.extend(dependencies.get(dep, ()))
+    closure[filename] = reached
+  return closure
+
+
+def TopologicalWaves(dependencies):
+  """Order files into waves of independent files.
+
+  Files which are part of a dependency cycle are put into a last wave.
+
+  Arguments:
+    dependencies: (dict) Filename to the set of filenames it depends on, as
+      returned by BuildDependencies.
+
+  Returns:
+    List of waves, each a sorted list of filenames.
+  """
+  remaining = dict((f, set(deps)) for f, deps in dependencies.items())
+  dependents = dict((f, []) for f in dependencies)
+  for filename, deps in dependencies.items():
+    for dep in deps:
+      dependents[dep].append(filename)
+
+  waves = []
+  wave = sorted(f for f, deps in remaining.items() if not deps)
+  while wave:
+    waves.append(wave)
+    nextWave = []
+    for filename in wave:
+      del remaining[filename]
+      for dependent in dependents[filename]:
+        remaining[dependent].discard(filename)
+        if not remaining[dependent]:
+          nextWave.append(dependent)
+    wave = sorted(nextWave)
+
+  if remaining:
+    logging.warning('Cyclic module dependencies between %s',
+                    ', '.join(sorted(remaining)))
+    waves.append(sorted(remaining))
+  return waves
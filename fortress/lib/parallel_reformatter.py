@@ -0,0 +1,146 @@
+"""Reformat a huge file in several processes.
+
+Most of the work on a file is done line by line: tokenizing, linking the
+continuation lines and the rewrites of the code. Only the indentation depends
+on all lines before, through the blocks they open and close.
+
+The lines are therefore split into chunks, each beginning with a statement
+which is certainly not part of a continued statement before it. Every chunk
+is reformatted by a Reformatter of its own in a worker process, up to the
+indentation. With a single job, the chunks are reformatted one after another
+in this process instead; only one chunk is tokenized at a time, so this
+bounds the memory needed for a huge file (see memory_profile).
+
+The parent keeps a BlockLine per line: its text around the indentation and
+the blocks it closes and opens. Continuations never cross the edge of a
+chunk, so the parent only walks the blocks of all lines to reindent them
+(Reformatter.fixIndentation) and puts the text together.
+"""
+
+import multiprocessing
+
+from fortress.lib import fortress_style
+from fortress.lib import reformatter
+from fortress.lib import unwrapped_line
+
+# Files with fewer lines are reformatted in a single process
+MIN_LINES = 200000
+
+# Lines per chunk, chunks end at the next statement
+CHUNK_LINES = 50000
+
+
+def _StartsStatement(sourceLines, i, isFreeForm):
+  """Whether no continued statement goes on in sourceLines[i].
+
+  The check is done on the raw lines and is conservative: a line which may
+  continue a statement, e.g. after a comment or preprocessor line, is never
+  taken.
+  """
+  if isFreeForm:
+    # the line before is code, without comment and not continued
+    previous = sourceLines[i - 1].rstrip()
+    return bool(previous) and previous[-1] != "&" and previous[0] != "#" \
+        and "!" not in previous
+  # the line is code, without label and not a continuation
+  line = sourceLines[i]
+  return len(line) > 6 and not line[:6].strip() \
+      and line[6:].lstrip()[:1] not in ("", "!")
+
+
+def SplitChunks(sourceLines, isFreeForm, size=CHUNK_LINES):
+  """Split lines into chunks of whole statements.
+
+  Returns:
+    A list of (start, end) indices of sourceLines, each chunk has at least
+    size lines except for the last one.
+  """
+  chunks = []
+  start = 0
+  end = size
+  while end < len(sourceLines):
+    if _StartsStatement(sourceLines, end, isFreeForm):
+      chunks.append((start, end))
+      start = end
+      end += size
+    else:
+      end += 1
+  chunks.append((start, len(sourceLines)))
+  return chunks
+
+
+def _Tasks(sourceLines, lines, isFreeForm, style):
+  """Yields the arguments of _ReformatChunk for every chunk."""
+  for start, end in SplitChunks(sourceLines, isFreeForm, CHUNK_LINES):
+    # line numbers within the chunk
+    chunkLines = [(first - start, last - start) for first, last in lines] \
+        if lines else None
+    yield ("\n".join(sourceLines[start:end]), start, chunkLines, isFreeForm,
+           style)
+
+
+def _ReformatChunk(task):
+  """Reformat a chunk up to its indentation, in a worker process.
+
+  Returns:
+    The states of the BlockLines of the chunk.
+  """
+  source, offset, lines, isFreeForm, style = task
+  Reform = reformatter.Reformatter(source, lines, isFreeForm=isFreeForm,
+                                   style=style)
+  Reform.reformatLines()
+  reindent = Reform.reindents()
+  return [codeLine.blockState(offset, reindent)
+          for codeLine in Reform.codeLines]
+
+
+class ParallelReformatter(reformatter.Reformatter):
+  """Reformatter of a huge file, see the module documentation.
+
+  Lint checks are not supported.
+  """
+
+  def __init__(self, unwrapped_source, lines=None, filename='<unknown>',
+               jobs=None, style=None):
+    """
+    Arguments:
+      unwrapped_source : (unicode) The code to reformat.
+      lines            : (list of tuples) Lines to reformat, see Reformatter.
+      filename         : (unicode) Name of the file, used to detect its form.
+      jobs             : (int) Number of worker processes, defaults to the
+                         number of CPUs. If 1, the chunks are reformatted in
+                         this process.
+      style            : (fortress_style.Style) Style to format with, the
+                         global style if None.
+    """
+    self.style = fortress_style.GetStyle(style)
+    self.codeLines = []
+    self.filename = filename
+    self.lint = False
+    self.diagnostics = []
+    self.units = []
+
+    sourceLines = unwrapped_source.split("\n")
+    self.isFreeForm = reformatter.IsFreeForm(sourceLines, filename,
+                                             self.style)
+
+    tasks = _Tasks(sourceLines, lines, self.isFreeForm, self.style)
+    if jobs == 1:
+      self.addChunks(_ReformatChunk(task) for task in tasks)
+      return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+      self.addChunks(pool.imap(_ReformatChunk, tasks))
+    finally:
+      pool.terminate()
+
+  def addChunks(self, chunks):
+    """Add the BlockLines of the reformatted chunks, in order."""
+    for states in chunks:
+      self.codeLines.extend(unwrapped_line.BlockLine(state)
+                            for state in states)
+
+  def reformatLines(self):
+    # done by the workers
+    pass
@@ -0,0 +1,137 @@
+"""Profile where the time of a run goes.
+
+A Profiler records a run with cProfile, for the usual tools reading pstats
+files (e.g. 'python -m pstats' or snakeviz). cProfile only knows the callers
+of every function, not whole stacks, so the stacks of the run are sampled as
+well, every SAMPLE_INTERVAL seconds of CPU time or the tick of the system
+timer if that is longer (often 4 ms on Linux). They are written as
+collapsed stacks, one line of 'frame;frame;... count' per stack, which
+flamegraph.pl, speedscope and similar tools read.
+
+The frames of collapsed stacks are labeled by the method, e.g.
+'UnwrappedLine.addSpacesInCode', or the module and function, e.g.
+'lexer.Lex'. Every stack starts with the phase of formatting a file it
+belongs to (see memory_profile.PHASES), e.g. 'phase:reformat', or
+'phase:other' for the time outside of formatting files, e.g. for finding the
+files. The samples include the overhead of cProfile, which inflates the
+share of small functions called many times. Worker processes of huge files
+(see parallel_reformatter) are not profiled.
+"""
+
+import cProfile
+import collections
+import inspect
+import os
+import signal
+import sys
+
+# Seconds of CPU time between samples of the stack
+SAMPLE_INTERVAL = 0.001
+
+# Suffix of the file the collapsed stacks are written to
+FOLDED_SUFFIX = '.folded'
+
+# Functions doing the phases of formatting a file, by their labels
+_PHASE_FUNCTIONS = {
+    'fortress_api.ReadFile': 'read',
+    'file_resources.DecodeContent': 'read',
+    'Reformatter.__init__': 'tokenize',
+    'ParallelReformatter.__init__': 'tokenize',
+    'Reformatter.reformat': 'reformat',
+    'Reformatter.generateCodeLines': 'generate',
+    'Reformatter.generateLines': 'generate',
+    'fortress_api._GetUnifiedDiff': 'diff',
+    'text_edits.LineEdits': 'diff',
+}
+
+
+def _ModuleName(code):
+  """Returns the name of the module of a code object, without package."""
+  path, name = os.path.split(os.path.splitext(code.co_filename)[0])
+  return os.path.basename(path) if name == '__init__' else name
+
+
+def _MethodLabels():
+  """Returns the labels of the methods of all classes of fortress.
+
+  Returns:
+    A dict from code objects to labels like 'UnwrappedLine.tokenize'.
+  """
+  labels = {}
+  for moduleName, module in list(sys.modules.items()):
+    if module is None or moduleName.split('.')[0] != 'fortress':
+      continue
+    for cls in vars(module).values():
+      if not inspect.isclass(cls) or cls.__module__ != moduleName:
+        continue
+      # only methods defined in the module (__file__ may be the '.pyc')
+      source = os.path.splitext(module.__file__)[0]
+      for name, function in vars(cls).items():
+        # decorated functions (e.g. by contextlib.contextmanager) share the
+        # code of their wrapper
+        function = inspect.unwrap(function) \
+            if hasattr(inspect, 'unwrap') else function
+        code = getattr(function, '__code__', None)
+        if code is not None \
+            and os.path.splitext(code.co_filename)[0] == source:
+          labels[code] = cls.__name__ + '.' + name
+  return labels
+
+
+class Profiler:
+  """Profile of a run, see the module documentation."""
+
+  def __init__(self, interval=SAMPLE_INTERVAL):
+    self.profile = cProfile.Profile()
+    self.interval = interval
+    # collapsed stack -> number of samples
+    self.stacks = collections.Counter()
+    # code object -> label of its frames
+    self.labels = {}
+    # stacks are sampled with a timer signal, which Windows lacks
+    self.sampling = hasattr(signal, 'setitimer')
+
+  def start(self):
+    """Start profiling, in the main thread."""
+    if self.sampling:
+      self.labels = _MethodLabels()
+      signal.signal(signal.SIGPROF, self._sample)
+      signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    self.profile.enable()
+
+  def stop(self):
+    self.profile.disable()
+    if self.sampling:
+      signal.setitimer(signal.ITIMER_PROF, 0)
+      signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+  def _label(self, code):
+    label = self.labels.get(code)
+    if label is None:
+      label = self.labels[code] = _ModuleName(code) + '.' + code.co_name
+    return label
+
+  def _sample(self, signum, frame):
+    """Handler of the timer signal, records the stack of frame."""
+    labels = []
+    phase = 'other'
+    while frame is not None:
+      label = self._label(frame.f_code)
+      labels.append(label)
+      # the outermost phase, e.g. not the one of a chunk of a huge file
+      phase = _PHASE_FUNCTIONS.get(label, phase)
+      frame = frame.f_back
+    labels.append('phase:' + phase)
+    labels.reverse()
+    self.stacks[';'.join(labels)] += 1
+
+  def write(self, filename):
+    """Write the pstats file filename, and the collapsed stacks next to it.
+
+    Raises:
+      IOError: a file cannot be written.
+    """
+    self.profile.dump_stats(filename)
+    with open(filename + FOLDED_SUFFIX, 'w') as fd:
+      for stack, count in sorted(self.stacks.items()):
+        fd.write('%s %d\n' % (stack, count))
@@ -28,6 +28,7 @@ if PY3:
   range = range
   ifilter = filter
   raw_input = input
+  intern = sys.intern
 
   import configparser
 
@@ -45,6 +46,9 @@ else:
 
   from itertools import ifilter
   raw_input = raw_input
+  # intern() does not take unicode strings
+  def intern(s):
+    return s
 
   import ConfigParser as configparser
   CONFIGPARSER_BOOLEAN_STATES = configparser.ConfigParser._boolean_states  # pylint: disable=protected-access
@@ -17,29 +17,122 @@ import re
 
 from fortress.lib import unwrapped_line
 from fortress.lib import fortress_style
+from fortress.lib import fortress_linter
+from fortress.lib import source_form
+
+# Maximal line lengths checked when linting
+MAX_FREE_LINE_LENGTH = 132
+MAX_FIXED_LINE_LENGTH = 72
+
+# Number of lines joined at once when generating the code
+_JOIN_LINES = 1024
+
+# Kinds of blocks (as identified by UnwrappedLine.identifyIndentation)
+# which end with a program unit.
+_UNIT_KINDS = ["program", "module", "subroutine", "function", "blockdata"]
+
+# Kinds of blocks closed by the 'end' of a program unit
+_UNIT_END_KINDS = _UNIT_KINDS + ["contains"]
+
+# Kinds of blocks which may precede 'contains'
+_CONTAINS_KINDS = ["program", "module", "subroutine", "function", "type"]
+
+# Kinds of blocks which are checked against their 'end' statement
+_END_KINDS = _UNIT_KINDS + ["do", "if", "where", "select", "type", "interface"]
+
+# Kinds of blocks which are recorded as ProgramUnits
+_SCOPE_KINDS = _UNIT_KINDS + ["type", "interface"]
+
+# Name following the keyword of a program unit, type or interface
+_UNIT_NAME_RE = re.compile(r"(?i)\b(?:program|module|subroutine|function|"
+                           r"interface|block\s*data|type(?:\s*,[^:]*)?\s*(?:::)?)"
+                           r"\s*(\w*)")
+
+# Statement closing a block: 'end <kind>', 'else', 'else where', 'case' or
+# 'contains'
+_CLOSING_RE = re.compile(r"(?i)(?:end\s*(block\s*data|\w*)|(else\s*where|else|case|contains))")
+
+
+def _EndsUnit(code):
+    """Returns whether code is the 'end' statement of a program unit."""
+    match = _CLOSING_RE.match(code)
+    return bool(match) and not match.group(2) \
+        and re.sub(r"\s", "", match.group(1).lower()) in [""] + _UNIT_KINDS
+
+
+def IsFreeForm(sourceLines, filename='<unknown>', style=None):
+    """Returns whether sourceLines are formatted as free-form code.
+
+    Without CONVERT_FIXED_TO_FREE, code is taken as free-form unless the form
+    is detected from the leading lines (DETECT_SOURCE_FORM). style defaults
+    to the global style.
+    """
+    style = fortress_style.GetStyle(style)
+    isFreeForm = not style['CONVERT_FIXED_TO_FREE']
+    if style['DETECT_SOURCE_FORM']:
+        form = source_form.DetectForm(filename, sourceLines)
+        if form is not None:
+            isFreeForm = (form == source_form.FREE)
+    return isFreeForm
+
+
+class ProgramUnit:
+    """A program unit, type or interface block found by walkBlocks."""
+
+    def __init__(self, kind, name, start, parent):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = start
+        self.parent = parent
 
 
 class Reformatter:
     """Class that represents a Fortran source code reformatting"""
 
-    def __init__(self, unwrapped_source=None, lines=None):
-        """Function to read the source code from a file."""
+    def __init__(self, unwrapped_source=None, lines=None, filename='<unknown>',
+                 lint=False, isFreeForm=None, style=None):
+        """Function to read the source code from a file.
+
+    Args:
+      filename (str): name of the file, used in diagnostics
+      lint (bool): collect diagnostics in self.diagnostics while formatting
+      isFreeForm (bool): form of the code, see IsFreeForm if None
+      style (fortress_style.Style): style to format with, the global style
+        if None
+
+    """
 
         # do initializations
+        self.style = fortress_style.GetStyle(style)
         self.codeLines = []
-        self.isFreeForm = not fortress_style.Get('CONVERT_FIXED_TO_FREE')
+        self.filename = filename
+        self.lint = lint
+        self.diagnostics = []
+        self.units = []
 
-        if fortress_style.Get('FIX_LINE_ENDINGS'):
+        if self.style['FIX_LINE_ENDINGS']:
             unwrapped_source.replace(r"\r\n", r"\n") # Windows
             unwrapped_source.replace(r"\r", r"\n")   # Mac OS
 
+        sourceLines = unwrapped_source.split("\n")
+
+        # Per file form, guessed from the leading lines
+        if isFreeForm is None:
+            isFreeForm = IsFreeForm(sourceLines, filename, self.style)
+        self.isFreeForm = isFreeForm
+
         lineno = 0
         # tokenize and clean up already
-        for line in unwrapped_source.split("\n"):
+        for line in sourceLines:
             lineno += 1
 
-            # Collect lines in containers
-            cLine = unwrapped_line.UnwrappedLine(line, self.isFreeForm)
+            # Collect lines in containers, lines without code to
+            # reformat are not tokenized
+            cLine = self.cleanLine(line)
+            clean = cLine is not None
+            if not clean:
+                cLine = unwrapped_line.UnwrappedLine(line, self.isFreeForm)
 
             # Handle line numbers
             cLine.lineNo = lineno
@@ -47,33 +140,84 @@ class Reformatter:
                 if (lineno < lines[0][0]) or (lines[0][1] < lineno):
                     cLine.enabled = False
 
-            # Replace tabs with spaces (args: amount of spaces)
-            if fortress_style.Get('REPLACE_TABS_BY_SPACES'):
-                cLine.replaceTabsBySpaces(fortress_style.Get('INDENT_WIDTH'))
-            cLine.tokenize()
+            if not clean:
+                # Replace tabs with spaces (args: amount of spaces)
+                if self.style['REPLACE_TABS_BY_SPACES']:
+                    cLine.replaceTabsBySpaces(self.style['INDENT_WIDTH'])
+                length = len(cLine.line.rstrip())
+                cLine.tokenize()
+
+                if lint:
+                    self.checkLine(cLine, length)
 
-            # Unindent #PREPROC
-            if fortress_style.Get('UNINDENT_PREPROCESSOR_DIRECTIVES'):
-                cLine.unindentPreProc()
+                # Unindent #PREPROC
+                if self.style['UNINDENT_PREPROCESSOR_DIRECTIVES']:
+                    cLine.unindentPreProc()
 
             self.codeLines.append(cLine)
 
         self.identifyContinuations()
 
+    def cleanLine(self, line):
+        """Returns a CleanLine for line if it has no code to reformat.
+
+    Blank lines, preprocessor directives and comment lines are left as they
+    are, except for tabs, for the indentation behind the '#' of directives,
+    the indentation of free-form comments (which the CleanLine does) and
+    the conversion of fixed-form comments. All lines are tokenized when
+    linting, to check them.
+
+    Returns:
+      The CleanLine, or None if line has to be tokenized.
+
+    """
+        if self.lint:
+            return None
+        text = line.rstrip()
+        if not text:
+            return unwrapped_line.CleanLine(line)
+        if "\t" in text:
+            return None
+        if text[0] == "#":
+            if text[1:2].isspace():
+                return None
+            return unwrapped_line.CleanLine(line)
+        if not self.isFreeForm:
+            if text[0] in "cC*!" and \
+                    not self.style['CONVERT_FIXED_TO_FREE']:
+                return unwrapped_line.CleanLine(line)
+            return None
+        if line.lstrip(" ")[:1] != "!":
+            return None
+        return unwrapped_line.CleanLine(line, self.reindents())
+
     def reformat(self):
+        self.reformatLines()
+
+        # Reindents the code(block), which is possible in free form only:
+        if self.reindents():
+            self.fixIndentation(self.style['INDENT_WIDTH'], self.style['CONTI_INDENT_WIDTH'])
+        elif self.lint:
+            # only check the block structure
+            for _ in self.walkBlocks():
+                pass
+        if self.style['ADD_REMARKS']:
+            self.markLongLines(100)
+
+
+    def reformatLines(self):
+        """Apply the changes which depend on a single line only."""
         for codeLine in self.codeLines:
-            if fortress_style.Get('CONVERT_FIXED_TO_FREE'):
+            if self.style['CONVERT_FIXED_TO_FREE']:
                 codeLine.convertFixedToFree()
-            if fortress_style.Get('ADD_SPACES_AROUND_OPERATORS'):
+            if self.style['ADD_SPACES_AROUND_OPERATORS']:
                 codeLine.addSpacesInCode()
             codeLine.addOptAmpersandToCont()
 
-        # Reindents the code(block):
-        if fortress_style.Get('REINDENT'):
-            self.fixIndentation(fortress_style.Get('INDENT_WIDTH'), fortress_style.Get('CONTI_INDENT_WIDTH'))
-        if fortress_style.Get('ADD_REMARKS'):
-            self.markLongLines(100)
-
+    def reindents(self):
+        """Returns whether reformat() changes the indentation."""
+        return self.style['REINDENT'] and (self.isFreeForm
+                or self.style['CONVERT_FIXED_TO_FREE'])
 
     def fixIndentation(self, indent, contiIndent):
         """Change the indentation of a codeLine.
@@ -84,31 +228,194 @@ class Reformatter:
     Args:
       indent (int): new indent length
 
+    """
+        for codeLine, curIndent in self.walkBlocks(addRemarks=True):
+            codeLine.setIndentation(curIndent, indent*" ")
+            codeLine.leftSpace += (contiIndent*" " if codeLine.isContinuation else "")
+
+            codeLine.preserveCommentPosition()
+
+    def walkBlocks(self, addRemarks=False):
+        """Walk through the codeLines while tracking the block structure.
+
+    Yields:
+      (codeLine, level) for every codeLine: level is the number of blocks
+      the line is nested in. Blocks opened by the line itself are
+      identified after resuming, as well as labeled DO loops ended by it.
+      Blocks still open at the 'end' of a program unit end with it.
+
+    Args:
+      addRemarks (bool): add remarks to lines with indentation problems
+
     """
         curIndent = 0
         indents = []
+        openedBy = []
+        scopes = []
+        # label of the statement ending a DO loop, None for other blocks
+        doLabels = []
+        self.units = []
         for codeLine in self.codeLines:
+            closedScope = None
             if codeLine.decreasesIndentBefore():
+                if _EndsUnit(codeLine.code):
+                    while len(indents) > 0 \
+                            and indents[-1] not in _UNIT_END_KINDS \
+                            and set(indents) & set(_UNIT_END_KINDS):
+                        curIndent -= 1
+                        doLabels.pop()
+                        scope = scopes.pop()
+                        if scope is not None:
+                            scope.end = codeLine.lineNo
+                        self.report(openedBy.pop(), "Error", "Block '"
+                                    + indents.pop() + "' is never closed.")
                 curIndent -= 1
                 if len(indents) > 0:
-                    indents.pop()
+                    kind = indents.pop()
+                    opening = openedBy.pop()
+                    closedScope = scopes.pop()
+                    doLabels.pop()
+                    if closedScope is not None:
+                        closedScope.end = codeLine.lineNo
+                    if self.lint:
+                        self.checkBlockEnd(codeLine, kind, opening)
             if curIndent < 0:
-                codeLine.remarks.append("Negative indentation level reached.")
+                if addRemarks:
+                    codeLine.remarks.append("Negative indentation level reached.")
+                self.report(codeLine, "Error",
+                            "Statement closes a block which was never opened.")
                 curIndent = 0
 
-            codeLine.setIndentation(curIndent, indent*" ")
-            codeLine.leftSpace += (contiIndent*" " if codeLine.isContinuation else "")
+            yield codeLine, curIndent
+
+            # the labeled statement belongs to the loops it ends
+            label = codeLine.statementLabel()
+            while label is not None and len(doLabels) > 0 \
+                    and doLabels[-1] == label:
+                curIndent -= 1
+                indents.pop()
+                openedBy.pop()
+                scopes.pop()
+                doLabels.pop()
 
             lineIndent = codeLine.identifyIndentation(indents)
             if lineIndent != False:
                 curIndent += 1
                 indents += [lineIndent]
-
-            codeLine.preserveCommentPosition()
+                openedBy += [codeLine]
+                scopes += [self.openScope(codeLine, lineIndent, closedScope,
+                                          scopes)]
+                doLabels += [codeLine.doLabel() if lineIndent == "do"
+                             else None]
 
         # back at zero indentation?
         if curIndent > 0:
-            self.codeLines[-1].remarks.append("Positive indentation level remaining.")
+            if addRemarks:
+                self.codeLines[-1].remarks.append("Positive indentation level remaining.")
+            for kind, opening in zip(indents, openedBy):
+                self.report(opening, "Error",
+                            "Block '" + kind + "' is never closed.")
+            # units still open end with the last line which is not blank
+            lastLine = self.codeLines[-1]
+            for codeLine in reversed(self.codeLines):
+                if codeLine.buildFullLine().strip():
+                    lastLine = codeLine
+                    break
+            for scope in scopes:
+                if scope is not None:
+                    scope.end = lastLine.lineNo
+
+    def openScope(self, codeLine, kind, closedScope, scopes):
+        """Record a program unit, type or interface opened by codeLine.
+
+    Args:
+      kind (str): kind of the block opened by codeLine
+      closedScope (ProgramUnit): unit closed by codeLine, if any
+      scopes (list): units (or None) of the enclosing blocks
+
+    Returns:
+      The ProgramUnit continued or opened by codeLine, None otherwise.
+
+    """
+        # the part after 'contains' still belongs to the unit
+        if kind == "contains":
+            return closedScope
+        if kind not in _SCOPE_KINDS:
+            return None
+
+        match = _UNIT_NAME_RE.search(codeLine.code)
+        parents = [scope for scope in scopes if scope is not None]
+        unit = ProgramUnit(kind, match.group(1) if match else "",
+                           codeLine.lineNo, parents[-1] if parents else None)
+        self.units.append(unit)
+        return unit
+
+    def report(self, codeLine, kind, message, column=1):
+        """Record a diagnostic for codeLine if linting."""
+        if self.lint:
+            self.diagnostics.append(fortress_linter.LintMessage(
+                self.filename, codeLine.lineNo, column, kind, message))
+
+    def checkLine(self, codeLine, length):
+        """Lint a single tokenized codeLine.
+
+    Args:
+      length (int): length of the line after replacing tabs, without
+        trailing whitespace
+
+    """
+        tabPos = codeLine.origLine.find("\t")
+        if tabPos != -1:
+            self.report(codeLine, "Warning", "Tab character.", tabPos + 1)
+
+        if len(codeLine.rightSpace):
+            self.report(codeLine, "Warning", "Trailing whitespace.",
+                        len(codeLine.origLine.rstrip()) + 1)
+
+        if self.isFreeForm:
+            if length > MAX_FREE_LINE_LENGTH:
+                self.report(codeLine, "Warning", "Line is longer than "
+                            + str(MAX_FREE_LINE_LENGTH) + " characters.",
+                            MAX_FREE_LINE_LENGTH + 1)
+        elif length > MAX_FIXED_LINE_LENGTH and not len(codeLine.fixedComment):
+            self.report(codeLine, "Warning", "Code beyond column "
+                        + str(MAX_FIXED_LINE_LENGTH) + " is ignored in fixed form.",
+                        MAX_FIXED_LINE_LENGTH + 1)
+
+    def checkBlockEnd(self, codeLine, kind, opening):
+        """Check that a statement closing a block matches its kind.
+
+    Args:
+      kind (str): kind of the closed block
+      opening (UnwrappedLine): line which opened the block
+
+    """
+        match = _CLOSING_RE.match(codeLine.code)
+        if not match:
+            return
+        if match.group(2):
+            closing = re.sub(r"\s", "", match.group(2).lower())
+            expected = {"elsewhere": ["where"],
+                        "else": ["if"],
+                        "case": ["select"],
+                        "contains": _CONTAINS_KINDS}[closing]
+        else:
+            closing = ("end " + match.group(1).lower()).rstrip()
+            endKind = re.sub(r"\s", "", match.group(1).lower())
+            if not endKind:
+                # plain 'end' closes any program unit
+                expected = _UNIT_END_KINDS
+            elif endKind not in _END_KINDS:
+                # block is not tracked
+                return
+            elif endKind in _UNIT_KINDS:
+                expected = [endKind, "contains"]
+            else:
+                expected = [endKind]
+
+        if kind not in expected:
+            self.report(codeLine, "Error", "'" + closing + "' closes block '"
+                        + kind + "' opened in line " + str(opening.lineNo) + ".")
 
     def markLongLines(self, allowedLength):
         """Mark lines above allowedLength.
@@ -143,8 +450,15 @@ class Reformatter:
         if self.isFreeForm:
             inConti = False
             inTightConti = False
-            inStringConti = False
+            # quote of a string continued in the next line
+            stringQuote = None
             for codeLine in self.codeLines:
+                # continuation without continued line?
+                if codeLine.hasCode() and len(codeLine.freeContBeg) \
+                        and not inConti:
+                    self.report(codeLine, "Error", "Continuation line does "
+                                "not follow a continued line.")
+
                 # is it a code line and is it after a continued line?
                 if codeLine.hasCode() and inConti:
                     codeLine.isContinuation = True
@@ -152,11 +466,11 @@ class Reformatter:
                     if inTightConti:
                         codeLine.isTightContinuation = True
                     # is continuation of string?
-                    if inStringConti:
-                        codeLine.isStringContinuation = True
+                    if stringQuote:
+                        codeLine.continueString(stringQuote)
                     inConti = False
                     inTightConti = False
-                    inStringConti = False
+                    stringQuote = None
 
                 # check if line is continued
                 if codeLine.isContinued:
@@ -166,7 +480,12 @@ class Reformatter:
                         inTightConti = True
                     # continued in string?
                     if codeLine.isStringContinued:
-                        inStringConti = True
+                        stringQuote = codeLine.tokens()[-1][0]
+                    contiLine = codeLine
+
+            if inConti:
+                self.report(contiLine, "Error", "Continued line is not "
+                            "followed by a continuation line.")
 
         else: # fixed form
           inConti = False
@@ -189,14 +508,40 @@ class Reformatter:
                   if not codeLine.isFreeForm and not len(codeLine.leftSpace):
                       codeLine.isTightContinuation = True
                       inTightConti = True
+                  contiLine = codeLine
 
+          if inConti:
+              self.report(contiLine, "Error", "Continuation line does not "
+                          "follow a statement.")
 
-    def generateCodeLines(self):
-        """Generate a string from the codelines"""
-        output = ""
+
+    def generateLines(self):
+        """Generate the codelines as strings, without line breaks.
+
+        The code is the lines joined by line breaks. It ends with a line
+        break, so the last line is empty.
+        """
+        line = ""
         for cLine in self.codeLines:
             if cLine.enabled:
-                output += cLine.rebuild().rstrip() + "\n"
+                line = cLine.rebuild().rstrip()
             else:
-                output += cLine.origLine.rstrip() +"\n"
-        return output
+                line = cLine.origLine.rstrip()
+            yield line
+        if line:
+            yield ""
+
+    def generateCodeLines(self):
+        """Generate a string from the codelines"""
+        # Joining all lines at once needs several times the memory of the
+        # output, appending them one by one is quadratic when profiled
+        # (the in-place concatenation of CPython is disabled then).
+        output = ""
+        lines = []
+        for line in self.generateLines():
+            if len(lines) == _JOIN_LINES:
+                lines.append("")
+                output += "\n".join(lines)
+                lines = []
+            lines.append(line)
+        return output + "\n".join(lines)
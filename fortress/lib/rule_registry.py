@@ -0,0 +1,129 @@
+"""Registry of rules which only run on lines they may apply to.
+
+Every rule declares its triggers: the keywords (lower-case names) or
+operators a line must contain for the rule to possibly match. The triggers
+of a line are taken from its tokens (see lexer and Triggers), and each
+registry looks up the rules registered for them, so the cost for a line
+depends on its length and the rules it triggers, but not on the number of
+rules registered.
+
+Triggers are compared with whole tokens: a rule triggered by 'end' is not a
+candidate for 'endif', which has to be listed as a trigger of its own. Rules
+without triggers are candidates for every line.
+"""
+
+from fortress.lib import lexer
+
+# Triggers of all registries
+_REGISTERED = set()
+
+# Shared result for lines without any triggers
+_NO_TRIGGERS = frozenset()
+
+
+def Triggers(tokens):
+  """Returns the triggers among the tokens of a line.
+
+  Only tokens registered as a trigger of any rule are returned, as lines keep
+  their triggers for several passes.
+  """
+  found = _REGISTERED.intersection(tokens)
+  return frozenset(found) if found else _NO_TRIGGERS
+
+
+class RuleRegistry:
+  """Rules indexed by their triggers, kept in the order of registration."""
+
+  def __init__(self):
+    self.rules = []
+    # trigger -> indices of the rules
+    self.index = {}
+    # indices of the rules without triggers
+    self.unconditional = []
+    # triggers of a line -> candidates
+    self.cache = {}
+
+  def register(self, rule, triggers=()):
+    """Add a rule.
+
+    Arguments:
+      rule     : Any object, returned by candidates().
+      triggers : (list of str) Lower-case keywords or operators. The rule is
+                 a candidate for every line if empty.
+    """
+    position = len(self.rules)
+    self.rules.append(rule)
+    self.cache.clear()
+    if not triggers:
+      self.unconditional.append(position)
+    _REGISTERED.update(triggers)
+    for trigger in triggers:
+      self.index.setdefault(trigger, []).append(position)
+
+  def candidates(self, triggers):
+    """Returns the rules which may apply to a line, in registration order.
+
+    Arguments:
+      triggers : (frozenset of str) Triggers of the line, see Triggers().
+    """
+    rules = self.cache.get(triggers)
+    if rules is None:
+      found = set(self.unconditional)
+      for trigger in triggers:
+        found.update(self.index.get(trigger, ()))
+      rules = tuple(self.rules[position] for position in sorted(found))
+      self.cache[triggers] = rules
+    return rules
+
+
+class RewriteRegistry(RuleRegistry):
+  """Rewrites of the tokens of a line.
+
+  A rewrite is a function rule(code, tokens, spans, i) which returns None if
+  it does not apply to tokens[i], or a tuple (text, n) to replace
+  tokens[i:i+n], including the code between them, by text. spans are the
+  positions of the tokens in code (see lexer.Spans). A rewrite is only tried
+  on tokens which are one of its triggers (on all tokens if it has none). The
+  code is rewritten in a single pass, rewritten tokens are not looked at
+  again.
+  """
+
+  def rewrite(self, code, tokens, triggers, quote=None):
+    """Returns code with all rewrites applied.
+
+    Arguments:
+      code     : (unicode) The code of a line.
+      tokens   : (tuple of str) The tokens of code, see lexer.Lex.
+      triggers : (frozenset of str) Triggers of the line, see Triggers().
+      quote    : (unicode) Quote of a character literal code begins in, see
+                 lexer.Lex.
+    """
+    # most statements contain none of the triggers
+    if not self.candidates(triggers):
+      return code
+
+    spans = lexer.Spans(code, quote)
+    unconditional = [self.rules[position] for position in self.unconditional]
+    parts = []
+    last = 0
+    i = 0
+    while i < len(tokens):
+      positions = self.index.get(tokens[i])
+      rules = [self.rules[position] for position in positions] \
+          if positions else []
+      for rule in rules + unconditional:
+        result = rule(code, tokens, spans, i)
+        if result:
+          text, n = result
+          parts.append(code[last:spans[i][0]])
+          parts.append(text)
+          last = spans[i + n - 1][1]
+          i += n
+          break
+      else:
+        i += 1
+
+    if not parts:
+      return code
+    parts.append(code[last:])
+    return "".join(parts)
@@ -0,0 +1,108 @@
+"""Detection of the source form (fixed or free) of a Fortran file.
+
+The form is guessed from the file extension and a bounded sample of the
+leading lines, so it costs next to nothing compared to formatting:
+
+  * comment markers 'c', 'C' and '*' in column 1 and continuation marks in
+    column 6 only exist in fixed form,
+  * statements starting in columns 1 to 5, lines ending with '&' and code
+    beyond column 72 only exist in free form.
+
+The extension decides unless the evidence against it is overwhelming, i.e.
+from more than half of the sampled lines: a few odd lines must not turn a
+valid file into an invalid one. In files with a fixed-form extension,
+columns 73 and beyond (e.g. sequence numbers) are ignored, and lines with
+'c', 'C' or '*' in column 1 are comments.
+"""
+
+import os
+
+FIXED = 'fixed'
+FREE = 'free'
+
+# Extensions which (usually) imply a form
+FIXED_EXTENSIONS = frozenset(['.f', '.for', '.ftn', '.f77', '.fpp'])
+FREE_EXTENSIONS = frozenset(['.f90', '.f95', '.f03', '.f08', '.f18'])
+
+# Number of non-blank lines looked at
+SAMPLE_SIZE = 200
+
+# Share of the sampled lines whose evidence overrides the extension
+_OVERRIDE_SHARE = 0.5
+
+
+def _LineEvidence(line, fixedExtension=False):
+  """Returns +1 if line indicates free form, -1 for fixed form, 0 otherwise.
+
+  Arguments:
+    line           : (unicode) A non-blank line.
+    fixedExtension : (bool) Whether the file has a fixed-form extension.
+  """
+  first = line[0]
+  if first in '#!':
+    # preprocessor and '!' comments exist in both forms
+    return 0
+  if fixedExtension:
+    if first in 'cC*':
+      return -1
+    # columns 73 and beyond hold sequence numbers or are ignored
+    line = line[:72]
+  if first in 'cC*':
+    # fixed-form comment unless it is a statement like 'call' or 'contains'
+    if first == '*' or len(line) == 1 or not line[1].isalnum():
+      # ... or an assignment to a variable named 'c'
+      return 1 if line[1:].lstrip().startswith('=') else -1
+    return 1
+  if first == '\t':
+    return 0
+
+  stripped = line.rstrip()
+  if len(stripped) > 5 and stripped[5] not in ' 0\t' \
+      and (stripped[:5].isspace() or not stripped[:5]):
+    # continuation mark in column 6
+    return -1
+  if stripped.endswith('&'):
+    return 1
+  label = stripped[:5].strip()
+  if label and not label.isdigit():
+    # statement in the label field
+    return 1
+  if len(stripped) > 72 and '!' not in stripped:
+    return 1
+  return 0
+
+
+def DetectForm(filename, lines, sampleSize=SAMPLE_SIZE):
+  """Guess the source form of a file.
+
+  Arguments:
+    filename   : (unicode) Name of the file, only the extension is used.
+    lines      : (list of unicode) Lines of the file.
+    sampleSize : (int) Maximal number of non-blank lines to look at.
+
+  Returns:
+    FIXED, FREE or None if there is no evidence either way.
+  """
+  extension = os.path.splitext(filename)[1].lower()
+  fixedExtension = extension in FIXED_EXTENSIONS
+
+  score = 0
+  sampled = 0
+  for line in lines:
+    if sampled >= sampleSize:
+      break
+    if not line.strip():
+      continue
+    sampled += 1
+    score += _LineEvidence(line, fixedExtension)
+
+  overwhelming = abs(score) > sampled * _OVERRIDE_SHARE
+  if extension in FREE_EXTENSIONS and not (score < 0 and overwhelming):
+    return FREE
+  if fixedExtension and not (score > 0 and overwhelming):
+    return FIXED
+  if score > 0:
+    return FREE
+  if score < 0:
+    return FIXED
+  return None
@@ -0,0 +1,175 @@
+"""Persistent index of the program units of a source tree.
+
+The formatter recognizes the beginning and end of every program, module,
+subroutine, function, type, interface and block data while indenting (see
+Reformatter.walkBlocks). This module stores those units together with their
+line span and enclosing unit in an SQLite database, so they can be looked up
+by name without scanning the sources again.
+
+The index is updated incrementally: files whose modification time and size
+did not change are skipped, files whose content did not change are not parsed
+again, and files which vanished are removed.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+from fortress.lib import file_resources
+from fortress.lib import fortress_style
+from fortress.lib import reformatter
+
+# Index file used if none is given
+DEFAULT_INDEX = '.fortress-index.sqlite'
+
+# Style the units are scanned with, only its form settings matter
+_STYLE = fortress_style.Style(fortress_style.CreateFortran2003Style())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  path  TEXT PRIMARY KEY,
+  mtime REAL NOT NULL,
+  size  INTEGER NOT NULL,
+  hash  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+  id     INTEGER PRIMARY KEY,
+  path   TEXT NOT NULL,
+  kind   TEXT NOT NULL,
+  name   TEXT NOT NULL,
+  key    TEXT NOT NULL,
+  start  INTEGER NOT NULL,
+  end    INTEGER NOT NULL,
+  parent INTEGER
+);
+CREATE INDEX IF NOT EXISTS units_key ON units (key);
+CREATE INDEX IF NOT EXISTS units_path ON units (path);
+"""
+
+
+def ScanUnits(source, filename='<unknown>'):
+  """Find the program units of a string of Fortran code.
+
+  Arguments:
+    source   : (unicode) The code to scan.
+    filename : (unicode) Name of the file, used to detect its source form.
+
+  Returns:
+    A list of reformatter.ProgramUnits in the order they are opened.
+  """
+  # units are recognized with the indentation rules, whatever the style
+  Reform = reformatter.Reformatter(source, filename=filename, style=_STYLE)
+  for _ in Reform.walkBlocks():
+    pass
+  return Reform.units
+
+
+class SymbolIndex:
+  """Program units of many files, stored in an SQLite database."""
+
+  def __init__(self, path=DEFAULT_INDEX):
+    self.path = path
+    self.connection = sqlite3.connect(path)
+    self.connection.executescript(_SCHEMA)
+
+  def close(self):
+    self.connection.close()
+
+  def update(self, filenames, logger=None):
+    """Bring the index up to date with the given files.
+
+    Files which are indexed but not given any more are removed.
+
+    Arguments:
+      filenames : (list of unicode) All files which should be indexed.
+      logger    : (function) Called with a message for unreadable or
+                  undecodable files.
+
+    Returns:
+      The number of files which were parsed again.
+    """
+    db = self.connection
+    known = dict((row[0], row[1:])
+                 for row in db.execute('SELECT path, mtime, size, hash '
+                                       'FROM files'))
+    paths = set(os.path.abspath(filename) for filename in filenames)
+    parsed = 0
+
+    with db:
+      for path in set(known) - paths:
+        self._remove(path)
+
+      for path in sorted(paths):
+        try:
+          stat = os.stat(path)
+          if path in known and known[path][:2] == (stat.st_mtime,
+                                                   stat.st_size):
+            continue
+          with open(path, 'rb') as fd:
+            content = fd.read()
+        except (IOError, OSError) as err:
+          if logger:
+            logger(err)
+          if path in known:
+            self._remove(path)
+          continue
+
+        digest = hashlib.sha1(content).hexdigest()
+        if path in known and known[path][2] == digest:
+          # touched only
+          db.execute('UPDATE files SET mtime = ?, size = ? WHERE path = ?',
+                     (stat.st_mtime, stat.st_size, path))
+          continue
+
+        try:
+          source, _ = file_resources.DecodeContent(content)
+        except (UnicodeDecodeError, SyntaxError) as err:
+          if logger:
+            logger('{}: {}'.format(path, err))
+          if path in known:
+            self._remove(path)
+          continue
+
+        self._remove(path)
+        db.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                   (path, stat.st_mtime, stat.st_size, digest))
+        self._insertUnits(path, ScanUnits(source, path))
+        parsed += 1
+
+    return parsed
+
+  def _remove(self, path):
+    self.connection.execute('DELETE FROM units WHERE path = ?', (path,))
+    self.connection.execute('DELETE FROM files WHERE path = ?', (path,))
+
+  def _insertUnits(self, path, units):
+    ids = {}
+    for unit in units:
+      cursor = self.connection.execute(
+          'INSERT INTO units (path, kind, name, key, start, end, parent) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (path, unit.kind, unit.name, unit.name.lower(), unit.start,
+           unit.end, ids.get(id(unit.parent))))
+      ids[id(unit)] = cursor.lastrowid
+
+  def find(self, name, kind=None):
+    """Look up program units by name, ignoring case as Fortran does.
+
+    Arguments:
+      name : (unicode) Name of the unit.
+      kind : (unicode) If given, only units of this kind are returned, e.g.
+             'subroutine'.
+
+    Returns:
+      A list of tuples (path, start, end, kind, name, parent name), the parent
+      name is None for top-level units.
+    """
+    query = ('SELECT u.path, u.start, u.end, u.kind, u.name, p.name '
+             'FROM units u LEFT JOIN units p ON u.parent = p.id '
+             'WHERE u.key = ?')
+    parameters = [name.lower()]
+    if kind:
+      query += ' AND u.kind = ?'
+      parameters.append(kind.lower().replace(' ', ''))
+    query += ' ORDER BY u.path, u.start'
+    return self.connection.execute(query, parameters).fetchall()
@@ -0,0 +1,84 @@
+"""Minimal edits turning code into its reformatted version.
+
+Editors and other tools apply the edits to their buffer instead of replacing
+all of it or parsing a diff. The formatter keeps every line (see
+Reformatter.generateLines), so the edits are computed line by line: a changed
+line gives a single edit of the characters between the common prefix and the
+common suffix of the line and its reformatted version.
+
+The compact JSON form of edits is a list of [line, column, endLine,
+endColumn, text] lists.
+"""
+
+import collections
+import json
+
+
+class TextEdit(collections.namedtuple('TextEdit',
+                                      'line column endLine endColumn text')):
+  """Replace the text from line:column up to endLine:endColumn by text.
+
+  Lines and columns are 1-based and count characters, the end is exclusive.
+  """
+  __slots__ = ()
+
+
+def LineEdits(before, after):
+  """Compute the edits turning lines into their reformatted version.
+
+  Arguments:
+    before : (list of unicode) The lines of the code, without line breaks.
+    after  : (iterable of unicode) The reformatted lines, without line breaks.
+             Lines beyond the end of before are ignored.
+
+  Returns:
+    A list of TextEdits, one per changed line, in the order of the lines.
+  """
+  edits = []
+  for lineNo, (old, new) in enumerate(zip(before, after), 1):
+    if old == new:
+      continue
+    shorter = min(len(old), len(new))
+    start = 0
+    while start < shorter and old[start] == new[start]:
+      start += 1
+    suffix = 0
+    while suffix < shorter - start and old[-1 - suffix] == new[-1 - suffix]:
+      suffix += 1
+    edits.append(TextEdit(lineNo, start + 1, lineNo, len(old) - suffix + 1,
+                          new[start:len(new) - suffix]))
+  return edits
+
+
+def ApplyEdits(source, edits):
+  """Returns source with edits applied.
+
+  Arguments:
+    source : (unicode) The code the edits were computed for.
+    edits  : (list of TextEdits) Edits which do not overlap. Insertions at
+             the same position are applied in the order of the list.
+  """
+  # offset of the beginning of every line
+  starts = [0]
+  for line in source.split('\n'):
+    starts.append(starts[-1] + len(line) + 1)
+
+  pieces = []
+  pos = 0
+  for edit in sorted(edits, key=lambda edit: (edit.line, edit.column)):
+    start = starts[edit.line - 1] + edit.column - 1
+    pieces.append(source[pos:start])
+    pieces.append(edit.text)
+    pos = starts[edit.endLine - 1] + edit.endColumn - 1
+  pieces.append(source[pos:])
+  return ''.join(pieces)
+
+
+def ToJson(edits):
+  """Returns the compact JSON form of edits."""
+  return json.dumps([list(edit) for edit in edits], separators=(',', ':'))
+
+
+def FromJson(text):
+  """Returns the edits of their JSON form, see ToJson."""
+  return [TextEdit(*edit) for edit in json.loads(text)]
@@ -7,6 +7,285 @@ __authors__ = [
 
 import re
 
+from fortress.lib import lexer
+from fortress.lib import py3compat
+from fortress.lib import rule_registry
+
+# Runs of decimal digits, e.g. labels.
+_DIGITS = re.compile(r"\d+")
+
+# Label of the statement terminating a DO loop, e.g. 'do 10 i = 1, n' or
+# 'outer: do 10, i = 1, n'
+_DO_LABEL = re.compile(r"(?i)(?:\w+\s*:\s*)?do\s*(\d+)")
+
+# UnwrappedLine.lexed before the code is lexed
+_NOT_LEXED = (None, None, None)
+
+
+def _spaceBeforeBracket(code, tokens, spans, i):
+  """'if(' -> 'if (', also after 'where'"""
+  if i + 1 < len(tokens) and tokens[i + 1] == "(" \
+      and spans[i + 1][0] == spans[i][1]:
+    return code[spans[i][0]:spans[i][1]] + " ", 1
+  return None
+
+
+def _spaceBeforeThen(code, tokens, spans, i):
+  """')then' -> ') then'"""
+  if i and tokens[i - 1] == ")" and spans[i - 1][1] == spans[i][0]:
+    return " then", 1
+  return None
+
+
+def _splitEnd(code, tokens, spans, i):
+  """'endif', 'enddo', 'endwhile' -> 'end if', ..."""
+  return "end " + code[spans[i][0] + 3:spans[i][1]], 1
+
+
+def _replaceBy(text):
+  """Rewrite replacing a token by text."""
+  def rewrite(code, tokens, spans, i):
+    return text, 1
+  return rewrite
+
+
+# Rewrites applied to the code by addSpacesInCode, each with the tokens it is
+# tried on (see rule_registry.RewriteRegistry).
+#
+# TODO: spaces around/behind operators (',', '/' unless in 'common', '*',
+# '-', '+', '=', '.eq.', ...). Signs of exponents (1e-5) are part of the
+# literal token.
+# TODO: Replace with 'modern' rel. op.
+_CODE_REWRITE_RULES = rule_registry.RewriteRegistry()
+for _triggers, _rewrite in [
+    (["if", "where"], _spaceBeforeBracket),
+    (["then"], _spaceBeforeThen),
+    (["endif", "enddo", "endwhile"], _splitEnd),
+    (["elseif"], _replaceBy("else if")),
+    (["inout"], _replaceBy("in out")),
+    ]:
+  _CODE_REWRITE_RULES.register(_rewrite, _triggers)
+
+
+def _realKind(code, tokens, spans, i):
+  """'real*8' -> 'real(8)' at the beginning of a statement"""
+  if i == 0 and len(tokens) >= 3 and tokens[1] == "*" \
+      and tokens[2].isdigit() \
+      and spans[1][0] - spans[0][1] <= 1 \
+      and spans[2][0] - spans[1][1] <= 1:
+    return "real(" + tokens[2] + ")", 3
+  #return "real(RK)", 3
+  return None
+
+
+# Rewrites applied by fixDeclarationsInCode
+_DECLARATION_REWRITE_RULES = rule_registry.RewriteRegistry()
+_DECLARATION_REWRITE_RULES.register(_realKind, ["real"])
+
+
+def _opens(kind, *keywords):
+  """Rule returning kind for statements beginning with keywords."""
+  def rule(line, tokens, indents):
+    if tokens[:len(keywords)] == keywords:
+      return kind
+    return None
+  return rule
+
+
+def _consistsOf(kind, keyword):
+  """Rule returning kind for statements consisting of keyword only."""
+  def rule(line, tokens, indents):
+    if tokens == (keyword,):
+      return kind
+    return None
+  return rule
+
+
+def _doLabel(code):
+  """Returns the label of the statement ending the DO loop opened by code.
+
+  None for loops ending with 'end do'.
+  """
+  match = _DO_LABEL.match(code)
+  return int(match.group(1)) if match else None
+
+
+def _inFunctionHost(indents):
+  """Whether 'function' only declares or calls one within indents."""
+  return "subroutine" in indents or "function" in indents \
+      or "program" in indents
+
+
+def _opensDo(line, tokens, indents):
+  # 'do' or 'name: do'
+  if tokens[0] == "do" \
+      or (len(tokens) >= 3 and tokens[1] == ":" and tokens[2] == "do"
+          and lexer.Kind(tokens[0]) in (lexer.NAME, lexer.LITERAL)):
+    return "do"
+  return None
+
+
+def _opensIf(line, tokens, indents):
+  #or re.match(r"(?i)(\w+:\s*)?if\b.*?\bthen\b", self.code) \
+  if tokens[-1] == "then":
+    return "if"
+  return None
+
+
+def _opensModule(line, tokens, indents):
+  if tokens[0] == "module" and tokens[1:2] != ("procedure",):
+    return "module"
+  return None
+
+
+def _opensType(line, tokens, indents):
+  # not a declaration 'type(name)'
+  if tokens[0] == "type" and len(tokens) > 1 and tokens[1] != "(":
+    return "type"
+  return None
+
+
+def _opensWhere(line, tokens, indents):
+  if tokens[0] != "where":
+    return None
+  # if just one bracket term remains after reducing all
+  # nested brackets and nothing follows it, the statement
+  # opens a block
+  brackets = "".join("str" if token[0] in "\"'" else token
+                     for token in tokens)
+  if _countBracketTerms(brackets) == 1 and tokens[-1] == ")":
+    return "where"
+  return False
+
+
+def _opensFunction(line, tokens, indents):
+  # (ignore in continuation lines, it will probably
+  # always appear in the first line)
+  if not _inFunctionHost(indents) \
+    and "function" in tokens \
+    and tokens[0] != "end" \
+    and not line.isContinuation:
+    return "function"
+  return None
+
+
+# Rules of identifyIndentation, tried in this order on the tokens of a line.
+# A rule returns the kind of block opened by the statement, False if it opens
+# none, or None if the rule does not decide.
+_BLOCK_OPENERS = rule_registry.RuleRegistry()
+for _triggers, _rule in [
+    (["do"], _opensDo),
+    (["then"], _opensIf),
+    (["program"], _opens("program", "program")),
+    (["subroutine"], _opens("subroutine", "subroutine")),
+    (["subroutine"], _opens("subroutine", "pure", "subroutine")),
+    (["module"], _opensModule),
+    (["type"], _opensType),
+    (["interface"], _opens("interface", "interface")),
+    (["blockdata"], _opens("blockdata", "blockdata")),
+    (["block"], _opens("blockdata", "block", "data")),
+    (["select"], _opens("select", "select")),
+    (["case"], _opens("select", "case")),
+    (["else"], _consistsOf("if", "else")),
+    #or re.match(r"(?i)else(if)?\b", self.code):
+    (["elsewhere"], _opens("where", "elsewhere")),
+    (["else"], _opens("where", "else", "where")),
+    (["where"], _opensWhere),
+    (["contains"], _consistsOf("contains", "contains")),
+    # also check for function statement
+    (["function"], _opensFunction),
+    ]:
+  _BLOCK_OPENERS.register(_rule, _triggers)
+
+# Statements closing a block before they are indented, see
+# decreasesIndentBefore
+_BLOCK_CLOSERS = rule_registry.RuleRegistry()
+for _keyword in ["end", "endif", "enddo", "endwhere",
+                 "else", "elseif", "elsewhere", "case"]:
+  _BLOCK_CLOSERS.register(_opens(True, _keyword), [_keyword])
+_BLOCK_CLOSERS.register(_consistsOf(True, "contains"), ["contains"])
+
+
+def _skipSpaces(line, pos, end):
+  """Returns the index of the first non-whitespace character in line[pos:end]."""
+  while pos < end and line[pos].isspace():
+    pos += 1
+  return pos
+
+
+def _skipString(line, pos, end):
+  """Returns the index behind the string literal starting at line[pos].
+
+  A backslash escapes the character following it. If the string is not
+  terminated before end, -1 is returned.
+  """
+  quote = line[pos]
+  pos += 1
+  while pos < end:
+    c = line[pos]
+    if c == quote:
+      return pos + 1
+    pos += 2 if c == "\\" else 1
+  return -1
+
+
+def _countBracketTerms(string):
+  """Counts the top-level bracket terms of string.
+
+  This is the number of '!' that remain after replacing innermost non-empty
+  bracket terms by '!' until none is left ('!' cannot occur outside of
+  strings). Instead of rescanning the string for each nesting level, all
+  levels are reduced in a single scan using a stack.
+
+  Returns:
+    The number of remaining '!'.
+  """
+  # every open bracket gets a frame [number of '!', not empty, reducible]
+  stack = [[0, False, True]]
+  for c in string:
+    if c == "(":
+      stack.append([0, False, True])
+    elif c == ")" and len(stack) > 1:
+      count, notEmpty, reducible = stack.pop()
+      frame = stack[-1]
+      frame[1] = True
+      if notEmpty and reducible:
+        frame[0] += 1
+      else:
+        # the brackets stay, so neither can the enclosing term be reduced
+        frame[0] += count
+        frame[2] = False
+    else:
+      frame = stack[-1]
+      frame[1] = True
+      if c == "!":
+        frame[0] += 1
+      elif c == ")":
+        frame[2] = False
+
+  # terms of unclosed brackets remain as well
+  return sum(frame[0] for frame in stack)
+
+
+def _replaceQuoted(string, quote):
+  """Replaces all terminated string literals delimited by quote with 'str'."""
+  parts = []
+  last = 0
+  end = len(string)
+  pos = string.find(quote)
+  while pos != -1:
+    close = _skipString(string, pos, end)
+    # once a string is unterminated, all following ones are as well
+    if close < 0:
+      break
+    parts.append(string[last:pos])
+    parts.append("str")
+    last = close
+    pos = string.find(quote, close)
+  parts.append(string[last:])
+  return "".join(parts)
+
+
 class UnwrappedLine:
   """Class that represents a Fortran source code line"""
 
@@ -47,6 +326,13 @@ class UnwrappedLine:
     self.isStringContinued = False
     self.isStringContinuation = False
 
+    # quote of a character literal continued from the previous line
+    self.continuedQuote = None
+
+    # (code, its tokens, their rule triggers) as of the last lexing, in a
+    # single attribute to keep the instances small (see tokens, triggers)
+    self.lexed = _NOT_LEXED
+
   def replaceTabsBySpaces(self, tabLength):
     """Remove all tabs from line and replace by right amount of spaces.
 
@@ -54,113 +340,187 @@ class UnwrappedLine:
       Call BEFORE parsing.
 
     """
-    # As long as the line contains tabs, find the first one ...
-    tabPos = self.line.find("\t")
-    while tabPos != -1:
-      # ... and replace it with spaces.
-      spaces = " " * (tabLength - tabPos % tabLength)
-      self.line = self.line[:tabPos] + spaces + self.line[tabPos+1:]
+    # Cut the line at the tabs ...
+    pieces = self.line.split("\t")
+    if len(pieces) == 1:
+      return
 
-      # Then find next one.
-      tabPos = self.line.find("\t")
+    # ... and fill each gap with spaces up to the next tab stop.
+    parts = []
+    column = 0
+    for piece in pieces[:-1]:
+      column += len(piece)
+      spaces = tabLength - column % tabLength
+      parts.append(piece)
+      parts.append(" " * spaces)
+      column += spaces
+    parts.append(pieces[-1])
+
+    self.line = "".join(parts)
 
   def tokenize(self):
     """Tokenizes a line and performs various checks.
 
+    The line is split into its parts in a single left-to-right scan, so the
+    runtime is linear in the length of the line.
+
     Note:
       The line is modified already by stripping away leading and trailing spaces.
 
     """
+    line = self.line
+    pos = 0
+    end = len(line)
+
     # first strip away any trailing whitespace
-    match = re.match(r"(.*?)(\s+)$", self.line)
-    if match:
-      self.rightSpace = match.group(2)
-      self.line = match.group(1)
+    while end and line[end-1].isspace():
+      end -= 1
+    if end < len(line):
+      self.rightSpace = line[end:]
+      self.line = line[:end]
 
     # ignore empty lines
-    if not len(self.line):
+    if not end:
       return
 
     # check for preprocessor lines
-    if self.line[0] == '#':
+    if line[0] == '#':
       self.preProc = self.line
       return
 
     # some fixed-form checks
     if not self.isFreeForm:
       # check for comment symbol in first column
-      if self.line[0] in ['c', 'C', '*', '!']:
+      if line[0] in ['c', 'C', '*', '!']:
         self.fixedComment = self.line
         return
 
-      # check for label
-      match = re.match(r"\s{0,4}(\d+)(.*?)$", self.line)
+      # check for label (preceded by at most four spaces)
+      labelPos = _skipSpaces(line, 0, min(4, end))
+      match = _DIGITS.match(line, labelPos, end)
       if match:
-        self.fixedLabel = match.group(1)
-        self.line = match.group(2)
+        self.fixedLabel = line[:match.end()]
+        pos = match.end()
       # otherwise check for continuation
-      #elif len(self.line) > 5 and self.line[0] != "\t" and self.line[5] not in [' ', '0']:
-      elif len(self.line) > 5 and self.line[5] not in [' ', '0']:
-        self.fixedCont = self.line[:6]
+      elif end > 5 and line[5] not in [' ', '0']:
+        self.fixedCont = line[:6]
         self.isContinuation = True
-        self.line = self.line[6:]
+        pos = 6
 
     # strip away left whitespace
-    match = re.match(r"(\s+)(.*?)$", self.line)
-    if match:
-      self.leftSpace = match.group(1)
-      self.line = match.group(2)
-
-    # check for free comments
-    match = re.match(r"((?:[^!'\"]|\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')*?)(\s*)(!.*?)$", \
-        self.line)
-    if match:
-      self.commentSpace = match.group(2)
-      self.comment = match.group(3)
-      self.line = match.group(1)
+    codeStart = _skipSpaces(line, pos, end)
+    self.leftSpace = line[pos:codeStart]
+    pos = codeStart
 
     # free-form checks
     if self.isFreeForm:
-      # check for free label
-      match = re.match(r"(\d+\s+)(.*?)$", self.line)
-      if match:
-        self.freeLabel = match.group(1)
-        self.line = match.group(2)
+      # check for free label (followed by code, not just a comment)
+      match = _DIGITS.match(line, pos, end)
+      if match and match.end() < end and line[match.end()].isspace():
+        labelEnd = _skipSpaces(line, match.end(), end)
+        if labelEnd < end and line[labelEnd] != '!':
+          self.freeLabel = line[pos:labelEnd]
+          pos = labelEnd
 
       # Check for continuations
       #
       # TODO: tight (no spaces) freeContXXX > 1
       # check for continuation start
-      match = re.match(r"(&\s*)(.*?)$", self.line)
-      if match:
-        self.freeContBeg = match.group(1)
+      if pos < end and line[pos] == '&':
+        contEnd = _skipSpaces(line, pos+1, end)
+        self.freeContBeg = line[pos:contEnd]
         self.isContinuation = True
-        self.line = match.group(2)
+        pos = contEnd
         # tight?
         if len(self.freeContBeg) == 1:
           self.isTightContinuation = True
 
-      # check for continuation end
-      match = re.match(r"(.*?)(\s*&)$", self.line)
-      if match:
-        self.freeContEnd = match.group(2)
-        self.isContinued = True
-        self.line = match.group(1)
-        # tight?
-        if len(self.freeContEnd) == 1:
-          self.isTightContinued = True
-        # break within character string?
-        trans = self.replaceStrings(match.group(1))
-        if re.search(r"[\"']", trans):
-          self.isStringContinued = True
+    # lex the code once, the comment is found outside of character strings
+    tokens = lexer.Lex(line[pos:end])
+
+    # check for free comments
+    if "!" in tokens:
+      i = tokens.index("!")
+      if i:
+        spans = lexer.Spans(line[pos:end])
+        codeEnd = pos + spans[i - 1][1]
+        commentStart = pos + spans[i][0]
+      else:
+        codeEnd = commentStart = pos
+        if self.freeContBeg:
+          # the spaces after '&' separate the comment
+          codeEnd = pos - len(self.freeContBeg) + 1
+          self.freeContBeg = "&"
+          self.isTightContinuation = True
+      self.commentSpace = line[codeEnd:commentStart]
+      self.comment = line[commentStart:end]
+      end = codeEnd
+      tokens = tokens[:i]
+
+    # check for continuation end
+    if self.isFreeForm and pos < end and line[end-1] == '&':
+      contStart = end - 1
+      while contStart > pos and line[contStart-1].isspace():
+        contStart -= 1
+      self.freeContEnd = line[contStart:end]
+      self.isContinued = True
+      # tight?
+      if len(self.freeContEnd) == 1:
+        self.isTightContinued = True
+      if tokens[-1] == "&":
+        tokens = tokens[:-1]
+      else:
+        # break within character string
+        self.isStringContinued = True
+        last = tokens[-1][:contStart - end]
+        tokens = tokens[:-1] + (py3compat.intern(last),)
+      end = contStart
 
     # finished
-    self.code = self.line
+    self.code = line[pos:end]
     self.line = ""
 
+    self.lexed = (self.code, tokens, None)
+
     # record length of code in this line
     self.origCodeLength = len(self.code)
 
+  def tokens(self):
+    """Returns the tokens of the code (see lexer).
+
+    The code is lexed once, the tokens are kept until it changes.
+    """
+    if self.lexed[0] is not self.code:
+      self.lexed = (self.code, lexer.Lex(self.code, self.continuedQuote), None)
+    return self.lexed[1]
+
+  def triggers(self):
+    """Returns the keywords and operators of the code which select rules.
+
+    See rule_registry.Triggers.
+    """
+    tokens = self.tokens()
+    if self.lexed[2] is None:
+      self.lexed = (self.code, tokens, rule_registry.Triggers(tokens))
+    return self.lexed[2]
+
+  def continueString(self, quote):
+    """Mark the code as beginning inside a character literal.
+
+    Args:
+      quote (str): the quote delimiting the literal begun in the continued
+        line
+
+    """
+    self.isStringContinuation = True
+    self.continuedQuote = quote
+    self.lexed = _NOT_LEXED
+    # the literal may go on in the next line
+    if self.isContinued:
+      tokens = self.tokens()
+      self.isStringContinued = bool(tokens) \
+          and lexer.Kind(tokens[-1]) == lexer.OPEN_STRING
+
   def hasCode(self):
     """Returns true if line has code."""
     if len(self.code):
@@ -188,7 +548,7 @@ class UnwrappedLine:
 
     # label
     if len(self.fixedLabel):
-      self.freeLabel = self.fixedLabel + " "
+      self.freeLabel = self.fixedLabel.lstrip() + " "
       self.fixedLabel = ""
 
     # continuation
@@ -211,13 +571,16 @@ class UnwrappedLine:
 
   def fixDeclarationsInCode(self):
     """Replaces real*8 with real(RK)"""
-    # 'real*8' to 'real(RK)'
-    self.code = re.sub(r"(?i)^\breal\b\s?\*\s?(\d+)\b", r"real(\1)", self.code)
-    #self.code = re.sub(r"(?i)^\breal\b\s?\*\s?8\b", r"real(RK)", self.code)
+    self.code = _DECLARATION_REWRITE_RULES.rewrite(
+        self.code, self.tokens(), self.triggers(), self.continuedQuote)
 
   def addOptAmpersandToCont(self):
     """Add ampersands at beginnings of continued lines"""
 
+    # fixed form marks continuations in column 6 instead
+    if not self.isFreeForm:
+      return
+
     if self.isContinuation and len(self.freeContBeg) == 0:
       if self.isStringContinuation:
         self.freeContBeg = "&" + self.leftSpace
@@ -230,171 +593,46 @@ class UnwrappedLine:
       self.freeContEnd = " &"
 
 
-  def separateStrings(self):
-    """Separate code into statement and string parts."""
-
-    parts = []
-    curPart = ""
-    curQuotes = ""
-    escaped = False
-    for c in self.code:
-      # search for beginning of string
-      if len(curQuotes) == 0 and c in ["\"", "'"]:
-        curQuotes = c
-        parts += [curPart]
-        curPart = c
-      # search for string ending
-      elif len(curQuotes) > 0 and not escaped and c == curQuotes:
-        curQuotes = ""
-        curPart += c
-        parts += [curPart]
-        curPart = ""
-      else:
-        curPart += c
-      
-      escaped = (c == "\\")
-
-    parts += [curPart]
-
-    return parts
-
-
   def addSpacesInCode(self):
     """Enhances readability by adding spaces between various operators."""
-
-    parts = self.separateStrings()
-
-    # now you can go through all even-numbered parts
-    for i in range(0, len(parts), 2):
-      part = parts[i]
-
-      ### commas
-      #part = re.sub(r",(\S)", r", \1", part)
-
-      ### operator /
-      #if part.find("common") == -1:
-      #  part = re.sub(r"(/)(\S)", r"\1 \2", part)
-      #  part = re.sub(r"(\S)(/)", r"\1 \2", part)
-
-      ### operator * (only if it's not **)
-      #part = re.sub(r"((?:[^\*]|^)\*)([^\s\*])", r"\1 \2", part)
-      #part = re.sub(r"([^\s\*])(\*(?:[^\*]|$))", r"\1 \2", part)
-
-      ### operator -
-      ### (need to preserve scientific numbers, e-5 or E-4)
-      #part = re.sub(r"((?:^|[^eE])-)(\S)", r"\1 \2", part)
-      #part = re.sub(r"([^\seE])(-)", r"\1 \2", part)
-
-      ### operator +
-      ### (need to preserve scientific numbers, e+5 or E+4)
-      #part = re.sub(r"((?:^|[^eE])\+)(\S)", r"\1 \2", part)
-      #part = re.sub(r"([^\seE])(\+)", r"\1 \2", part)
-
-      ### operator =
-      #part = re.sub(r"(=)(\S)", r"\1 \2", part)
-      #part = re.sub(r"(\S)(=)", r"\1 \2", part)
-
-      # after 'if', 'where'
-      part = re.sub(r"(?i)\b(if|where)\(", r"\1 (", part)
-      # before 'then'
-      part = re.sub(r"(?i)\)then\b", r") then", part)
-
-      # 'endif', 'enddo', 'endwhile' -> 'end if', ...
-      part = re.sub(r"(?i)\bend(if|do|while)\b", r"end \1", part)
-      # 'elseif' -> 'else if'
-      part = re.sub(r"(?i)\belseif\b", r"else if", part)
-      # 'inout' -> 'in out'
-      part = re.sub(r"(?i)\binout\b", r"in out", part)
-
-      # '.eq.', ...
-      #part = re.sub(r"(?i)(\S)(\.(?:eq|ne|lt|gt|le|ge|and|or)\.)", r"\1 \2", part)
-      #part = re.sub(r"(?i)(\.(?:eq|ne|lt|gt|le|ge|and|or)\.)(\S)", r"\1 \2", part)
-# TODO: Replace with 'modern' rel. op.
-
-      parts[i] = part
-
-    # put parts back together
-    self.code = "".join(parts)
+    self.code = _CODE_REWRITE_RULES.rewrite(
+        self.code, self.tokens(), self.triggers(), self.continuedQuote)
 
   def replaceStrings(self, string):
     """Replace strings by a fictitious variable name"""
 
     # remove double quoted strings
-    string = re.sub(r"\"([^\"\\]|\\.)*\"", r"str", string)
+    string = _replaceQuoted(string, "\"")
     # remove single quoted strings
-    string = re.sub(r"'([^'\\]|\\.)*'", r"str", string)
+    string = _replaceQuoted(string, "'")
 
     return string
 
   def identifyIndentation(self, indents):
     """Identify level increasing indentation manipulators."""
-    trans = self.code
-
-    trans = self.replaceStrings(trans)
-
-    # remove string beginnings in continued lines
-    if self.isContinued:
-      trans = re.sub(r"\"([^\"\\]|\\.)*$", r"str", trans)
-      trans = re.sub(r"'([^'\\]|\\.)*$", r"str", trans)
-
-        #or re.match(r"(?i)(\w+:\s*)?if\b.*?\bthen\b", self.code) \
-    if re.match(r"(?i)(\w+:\s*)?do\b", trans):
-      return "do"
-    elif re.search(r"(?i)\bthen$", trans):
-      return "if"
-    elif re.match(r"(?i)program\b", trans):
-      return "program"
-    elif re.match(r"(?i)subroutine\b", trans) \
-      or re.match(r"(?i)pure\s+subroutine\b", trans):
-      return "subroutine"
-    elif re.match(r"(?i)module\b", trans) \
-      and not re.match(r"(?i)module\s+procedure\b", trans):
-      return "module"
-    elif re.match(r"(?i)type\s*[^\s\(]", trans):
-      return "type"
-    elif re.match(r"(?i)interface\b", trans):
-      return "interface"
-    elif re.match(r"(?i)block\s?data\b", trans):
-      return "blockdata"
-    elif re.match(r"(?i)select\b", trans):
-      return "select"
-    elif re.match(r"(?i)case\b", trans):
-      return "select"
-    elif re.match(r"(?i)else$", trans):
-      return "if"
-        #or re.match(r"(?i)else(if)?\b", self.code):
-    elif re.match(r"(?i)where\b", trans):
-      # now keep replacing innermost brackets using '!'
-      # (! cannot occur outside of strings)
-      while re.search(r"\([^\(\)]+\)", trans):
-        trans = re.sub(r"\([^\(\)]+\)", "!", trans)
-
-      # now if just one '!' remains, there was only one
-      # bracket term
-      if trans.count("!") == 1:
-        return "where"
-    # also check for function statement
-    # (ignore in continuation lines, it will probably
-    # always appear in the first line)
-    elif re.match(r"(?i)contains$", trans):
-      return "contains"
-    elif not "subroutine" in indents and not "function" in indents \
-      and not "program" in indents \
-      and re.search(r"(?i)\bfunction\b", trans) \
-      and not re.match(r"(?i)end\b", trans) \
-      and not self.isContinuation:
-      return "function"
-    else:
-      return False
+    tokens = self.tokens()
+    for rule in _BLOCK_OPENERS.candidates(self.triggers()):
+      kind = rule(self, tokens, indents)
+      if kind is not None:
+        return kind
+    return False
 
   def decreasesIndentBefore(self):
     """Identify level decreasing indentation manipulators."""
-    if re.match(r"(?i)(end(if|do|where)?|else(if)?)\b", self.code) \
-        or re.match(r"(?i)case\b", self.code) \
-        or re.match(r"(?i)contains$", self.code):
-      return True
-    else:
-      return False
+    tokens = self.tokens()
+    for rule in _BLOCK_CLOSERS.candidates(self.triggers()):
+      if rule(self, tokens, None):
+        return True
+    return False
+
+  def statementLabel(self):
+    """Returns the label of the statement as an int, None without label."""
+    label = (self.fixedLabel or self.freeLabel).strip()
+    return int(label) if label else None
+
+  def doLabel(self):
+    """Returns the label terminating the DO loop opened by the line."""
+    return _doLabel(self.code)
 
   def unindentPreProc(self):
     """Unindent preprocessor commands."""
@@ -435,3 +673,127 @@ class UnwrappedLine:
     for remark in self.remarks:
       output += "! REMARK: " + remark + "\n"
     return output
+
+  def blockState(self, offset, reindent):
+    """Returns the state of a BlockLine standing in for this line.
+
+    Args:
+      offset (int): added to the line number
+      reindent (bool): whether the line is going to be reindented
+
+    """
+    if reindent:
+      # depends on the code only, so it may precede the new indentation
+      self.preserveCommentPosition()
+      closes = self.decreasesIndentBefore()
+      opens = self.identifyIndentation(())
+    else:
+      closes = opens = False
+    return (self.lineNo + offset, self.enabled,
+            "" if self.enabled else self.origLine,
+            self.code if opens or closes else "",
+            self.preProc + self.fixedComment + self.fixedLabel + self.fixedCont,
+            self.leftSpace,
+            self.freeLabel + self.freeContBeg + self.code + self.freeContEnd
+            + self.commentSpace + self.comment + self.rightSpace,
+            self.hasCode() or len(self.comment) > 0,
+            self.isContinuation, closes, opens, self.statementLabel())
+
+
+class BlockLine:
+  """Stand-in for an UnwrappedLine reformatted in another process.
+
+  Keeps what Reformatter needs to reindent and output the line: the text in
+  front of and behind its indentation, and the blocks it closes and opens (see
+  UnwrappedLine.blockState).
+  """
+  __slots__ = ("lineNo", "enabled", "origLine", "code", "head", "leftSpace",
+               "tail", "hasText", "isContinuation", "closes", "opens",
+               "label", "remarks")
+
+  def __init__(self, state):
+    (self.lineNo, self.enabled, self.origLine, self.code, self.head,
+     self.leftSpace, self.tail, self.hasText, self.isContinuation,
+     self.closes, self.opens, self.label) = state
+    self.remarks = []
+
+  def decreasesIndentBefore(self):
+    """See UnwrappedLine."""
+    return self.closes
+
+  def statementLabel(self):
+    """See UnwrappedLine."""
+    return self.label
+
+  def doLabel(self):
+    """See UnwrappedLine."""
+    return _doLabel(self.code)
+
+  def identifyIndentation(self, indents):
+    """See UnwrappedLine."""
+    if self.opens == "function" and _inFunctionHost(indents):
+      return False
+    return self.opens
+
+  def setIndentation(self, level, indent):
+    """See UnwrappedLine."""
+    self.leftSpace = indent * level if self.hasText else ""
+
+  def preserveCommentPosition(self):
+    """Done by UnwrappedLine.blockState already."""
+
+  def buildFullLine(self):
+    """See UnwrappedLine."""
+    return self.head + self.leftSpace + self.tail
+
+  def getLength(self):
+    """See UnwrappedLine."""
+    return len(self.buildFullLine()) - 1 # ignore line break
+
+  def rebuild(self):
+    """See UnwrappedLine."""
+    output = self.buildFullLine()
+    for remark in self.remarks:
+      output += "! REMARK: " + remark + "\n"
+    return output
+
+
+class CleanLine(BlockLine):
+  """Stand-in for a line which has no code to reformat.
+
+  Blank lines, preprocessor directives and comment lines are left as they are
+  (see Reformatter.cleanLine), so they are not tokenized into UnwrappedLines.
+  Only free-form comments are reindented. Like an UnwrappedLine without code,
+  they take no part in continuations and blocks.
+  """
+  __slots__ = ()
+
+  isContinued = False
+  freeContBeg = ""
+
+  def __init__(self, line, indented=False):
+    """
+    Args:
+      line (str): the line
+      indented (bool): whether the line is reindented
+
+    """
+    tail = line.lstrip(" ") if indented else line
+    BlockLine.__init__(self, (0, True, line, "", "", line[:len(line) - len(tail)],
+                              tail, indented, False, False, False, None))
+
+  def hasCode(self):
+    """See UnwrappedLine."""
+    return False
+
+  def addSpacesInCode(self):
+    """No code to change."""
+
+  convertFixedToFree = addOptAmpersandToCont = addSpacesInCode
+
+  def blockState(self, offset, reindent):
+    """See UnwrappedLine."""
+    return (self.lineNo + offset, self.enabled,
+            "" if self.enabled else self.origLine, "", self.head,
+            self.leftSpace, self.tail, self.hasText, False, False, False,
+            None)
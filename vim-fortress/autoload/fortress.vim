@@ -10,18 +10,133 @@
 "    map <leader>ff :call fortress#format()<cr>
 "    imap <leader>ff :call fortress#format()<cr>
 "
+" FORTRESS runs as a background job if Vim (8.0 or later) or Neovim supports
+" it, so the editor does not block. Only the lines up to the end of the range
+" are sent, as their indentation depends on the blocks opened before, and
+" only the lines which actually changed are written back to the buffer. If the
+" buffer is edited while FORTRESS is running, the result is discarded.
+"
+
+" Lines of the range, extended to the end of a continued statement
+function! s:range_end(last, fixed)
+  let l:end = a:last
+  while l:end < line('$')
+    let l:next = getline(l:end + 1)
+    if getline(l:end) =~# '&\s*\(!.*\)\=$'
+      " free form: continued by the trailing ampersand
+    elseif a:fixed && l:next =~# '^     [^ 0]'
+      " fixed form: continuation mark in column 6
+    else
+      break
+    endif
+    let l:end += 1
+  endwhile
+  return l:end
+endfunction
+
+" Write the lines which differ from the formatted ones back to the buffer
+function! s:apply(ctx, output)
+  if getbufvar(a:ctx.bufnr, 'changedtick') != a:ctx.changedtick
+    echomsg 'fortress: buffer changed while formatting, result discarded'
+    return
+  endif
+
+  " the formatter keeps every line, anything else means it failed
+  let l:formatted = a:output[a:ctx.firstline - 1 : a:ctx.lastline - 1]
+  if len(l:formatted) != a:ctx.lastline - a:ctx.firstline + 1
+    echomsg 'fortress: unexpected output, buffer left unchanged'
+    return
+  endif
+
+  let l:original = getbufline(a:ctx.bufnr, a:ctx.firstline, a:ctx.lastline)
+  let l:lnum = a:ctx.firstline
+  for l:line in l:formatted
+    if l:line !=# l:original[l:lnum - a:ctx.firstline]
+      call setbufline(a:ctx.bufnr, l:lnum, l:line)
+    endif
+    let l:lnum += 1
+  endfor
+endfunction
+
+" Called when the job finished, with its stdout, stderr and exit status
+function! s:finish(ctx, output, errors, status)
+  " 0: nothing changed, 2: reformatted
+  if a:status == 0
+    return
+  elseif a:status != 2
+    echohl ErrorMsg
+    echomsg 'fortress failed: ' . join(a:errors, ' ')
+    echohl None
+    return
+  endif
+  call s:apply(a:ctx, a:output)
+endfunction
+
+function! s:vim_close(ctx, channel)
+  " read what is left, then wait for the exit status
+  while ch_status(a:channel, {'part': 'out'}) ==# 'buffered'
+    call add(a:ctx.output, ch_read(a:channel))
+  endwhile
+  let l:job = ch_getjob(a:channel)
+  while job_status(l:job) ==# 'run'
+    sleep 1m
+  endwhile
+  call s:finish(a:ctx, a:ctx.output, a:ctx.errors,
+              \ job_info(l:job).exitval)
+endfunction
+
+function! s:nvim_exit(ctx, job, status, event)
+  " the last item of buffered output is an empty partial line
+  call s:finish(a:ctx, a:ctx.output[:-2], a:ctx.errors, a:status)
+endfunction
+
 function! fortress#format() range
-  " Determine range to format.
-  let l:line_ranges = a:firstline . '-' . a:lastline
-  let l:cmd = 'fortress -l ' . l:line_ranges . ' -s style.ini'
+  let l:fixed = get(b:, 'fortran_fixed_source',
+                  \ expand('%:e') =~? '^\(f\|for\|ftn\|f77\)$')
+  let l:ctx = {
+        \ 'bufnr': bufnr('%'),
+        \ 'changedtick': b:changedtick,
+        \ 'firstline': a:firstline,
+        \ 'lastline': a:lastline,
+        \ 'output': [],
+        \ 'errors': [],
+        \ }
 
-  " Call fortress with the current buffer
-  let l:formatted_text = system(l:cmd, join(getline(1, '$'), "\n") . "\n")
+  " Determine range to format and the lines it depends on.
+  let l:line_ranges = a:firstline . '-' . a:lastline
+  let l:cmd = ['fortress', '-l', l:line_ranges, '-s', 'style.ini']
+  let l:input = join(getline(1, s:range_end(a:lastline, l:fixed)), "\n") . "\n"
 
-  " Update the buffer.
-  execute '1,' . string(line('$')) . 'delete'
-  call setline(1, split(l:formatted_text, "\n"))
+  if has('nvim')
+    let l:job = jobstart(l:cmd, {
+          \ 'stdout_buffered': v:true,
+          \ 'stderr_buffered': v:true,
+          \ 'on_stdout': {j, data, e -> extend(l:ctx.output, data)},
+          \ 'on_stderr': {j, data, e -> extend(l:ctx.errors, data)},
+          \ 'on_exit': function('s:nvim_exit', [l:ctx]),
+          \ })
+    if l:job > 0
+      call chansend(l:job, l:input)
+      call chanclose(l:job, 'stdin')
+      return
+    endif
+  elseif exists('*job_start')
+    let l:job = job_start(l:cmd, {
+          \ 'mode': 'nl',
+          \ 'out_cb': {ch, line -> add(l:ctx.output, line)},
+          \ 'err_cb': {ch, line -> add(l:ctx.errors, line)},
+          \ 'close_cb': function('s:vim_close', [l:ctx]),
+          \ })
+    if job_status(l:job) !=# 'fail'
+      let l:channel = job_getchannel(l:job)
+      call ch_sendraw(l:channel, l:input)
+      call ch_close_in(l:channel)
+      return
+    endif
+  endif
 
-  " Reset cursor to first line of the formatted range.
-  call cursor(a:firstline, 1)
+  " No jobs available: call fortress and wait for it.
+  let l:output = systemlist(join(map(copy(l:cmd), 'shellescape(v:val)')),
+                          \ l:input)
+  call s:finish(l:ctx, l:output, l:output, v:shell_error)
 endfunction